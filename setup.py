@@ -30,6 +30,7 @@ setup(
     include_package_data=True,
     entry_points={
         'console_scripts': [
+            'system-image-bench = systemimage.bench:main',
             'system-image-cli = systemimage.main:main',
             'system-image-dbus = systemimage.service:main',
             ],
@@ -0,0 +1,436 @@
+# Copyright (C) 2014-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Download files via asyncio."""
+
+__all__ = [
+    'AsyncioDownloadManager',
+    ]
+
+
+import ssl
+import shutil
+import asyncio
+import hashlib
+import logging
+
+from contextlib import ExitStack
+from gi.repository import GLib
+from systemimage.config import config
+from systemimage.download import (
+    VALIDATORS, Canceled, DownloadManagerBase, get_validators)
+from systemimage.helpers import calculate_signature, safe_remove
+from urllib.parse import urljoin, urlsplit
+
+log = logging.getLogger('systemimage')
+
+
+CONNECTION_TIMEOUT = 120    # seconds
+# Give up on a download when no data arrives for this long.  This is the
+# same as the PyCURL downloader's LOW_SPEED_TIME.
+LOW_SPEED_TIME = 120        # seconds
+MAX_REDIRECTS = 5
+MAX_TOTAL_CONNECTIONS = 4
+CHUNK_SIZE = 64 * 1024
+# How often pending D-Bus events are dispatched while downloading.
+DISPATCH_INTERVAL = 0.05    # seconds
+NOT_MODIFIED = 304
+REDIRECTS = (301, 302, 303, 307, 308)
+DEFAULT_PORTS = dict(http=80, https=443)
+
+
+def make_ssl_context():
+    # The test suite needs to make the SSL context accept the testing
+    # server's self signed certificate.  It will mock this function.
+    return ssl.create_default_context()
+
+
+class _Download:
+    def __init__(self, record, pausable):
+        self.record = record
+        self.url = record.url
+        self.destination = record.destination
+        self.expected_checksum = record.checksum
+        self.cached = record.cached
+        self.pausable = pausable
+        # The validators of the cached copy, but only if it came from the
+        # same url.  These are used to make a conditional request.
+        self._cached_validators = get_validators(self.cached)
+        if (self._cached_validators is not None and
+                self._cached_validators.get('url') != self.url):
+            self._cached_validators = None
+        self.validators = None
+        self.not_modified = False
+        self.checksum = None
+        self._checksum = hashlib.sha256()
+
+    def request_headers(self):
+        """Return the extra headers of the request."""
+        if self._cached_validators is None:
+            return {}
+        return {
+            request_header: self._cached_validators[response_header]
+            for response_header, request_header in VALIDATORS.items()
+            if response_header in self._cached_validators
+            }
+
+    def write(self, fp, data):
+        """Update the checksum and write the data out to the file."""
+        self._checksum.update(data)
+        fp.write(data)
+
+    def finish(self, status, headers):
+        """Finish the download after the response has been received.
+
+        If the server said that the cached copy is not modified, the cached
+        copy is used as the destination file.
+
+        :raises FileNotFoundError: when the server said that a file which
+            wasn't requested conditionally is not modified.
+        """
+        self.checksum = self._checksum.hexdigest()
+        if status == NOT_MODIFIED and self._cached_validators is None:
+            # There's no cached copy to use instead of the response body.
+            safe_remove(self.destination)
+            raise FileNotFoundError(
+                'Not modified, but not cached: {}'.format(self.url))
+        if self.cached is None:
+            return
+        self.validators = {
+            name: value for name, value in headers.items()
+            if name in VALIDATORS
+            }
+        if status == NOT_MODIFIED and self._cached_validators is not None:
+            log.info('Not modified, using cached copy: {}', self.url)
+            self.not_modified = True
+            shutil.copy(self.cached, self.destination)
+            with open(self.destination, 'rb') as fp:
+                self.checksum = calculate_signature(fp)
+            # The server may have sent new validators, otherwise keep the old
+            # ones.
+            validators = {
+                key: value for key, value in self._cached_validators.items()
+                if key in VALIDATORS
+                }
+            validators.update(self.validators)
+            self.validators = validators
+
+
+class AsyncioDownloadManager(DownloadManagerBase):
+    """The asyncio based download manager.
+
+    All the files of a group are downloaded concurrently by coroutines on a
+    private event loop, over at most MAX_TOTAL_CONNECTIONS connections.  The
+    loop is never installed as the current event loop, so any other loop the
+    application uses is left alone.  This needs Python 3.5.3 or newer, where
+    asyncio always finds the running loop from within its coroutines.
+    Progress is reported as the data arrives, and each file is completed as
+    soon as all of it is on disk.  Pending D-Bus events are dispatched every
+    so often, so that the downloads can be paused, resumed, and canceled.
+    """
+
+    def __init__(self, callback=None):
+        super().__init__()
+        if callback is not None:
+            self.callbacks.append(callback)
+        self._paused = False
+        # While downloading, the event loop, the task running the group
+        # download, and the event which pausable downloads wait on.
+        self._loop = None
+        self._task = None
+        self._unpaused = None
+
+    def _call_soon(self, function):
+        # Pausing, resuming, and canceling may happen while D-Bus events
+        # are dispatched by the event loop, or from some other thread.
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(function)
+
+    def cancel(self):
+        super().cancel()
+        task = self._task
+        if task is not None:
+            self._call_soon(task.cancel)
+
+    def pause(self):
+        self._paused = True
+        unpaused = self._unpaused
+        if unpaused is not None:
+            self._call_soon(unpaused.clear)
+        if config.dbus_service is not None:
+            percentage = (int(self.received / self.total * 100.0)
+                          if self.total > 0 else 0)
+            config.dbus_service.UpdatePaused(percentage)
+
+    def resume(self):
+        self._paused = False
+        unpaused = self._unpaused
+        if unpaused is not None:
+            self._call_soon(unpaused.set)
+
+    def _get_files(self, records, pausable, signal_started):
+        # The sizes of the records which don't have one are added to the
+        # total as their responses arrive, so no HEAD requests are needed.
+        self.total = sum(
+            record.size for record in records if record.size is not None)
+        if signal_started and config.dbus_service is not None:
+            config.dbus_service.DownloadStarted()
+        downloads = [_Download(record, pausable) for record in records]
+        loop = asyncio.new_event_loop()
+        with ExitStack() as resources:
+            resources.callback(loop.close)
+            resources.callback(setattr, self, '_loop', None)
+            self._loop = loop
+            try:
+                loop.run_until_complete(self._download_all(downloads))
+            except:
+                # All or nothing.
+                for download in downloads:
+                    safe_remove(download.destination)
+                raise
+        # The API requires a FileNotFoundError to be raised when the
+        # checksums don't match.  Since it doesn't matter which one fails,
+        # they were all logged, and the first one is raised.
+        mismatches = [download for download in downloads
+                      if download.checksum != download.expected_checksum]
+        if len(mismatches) > 0:
+            for download in downloads:
+                safe_remove(download.destination)
+            # For backward compatibility with ubuntu-download_manager.
+            raise FileNotFoundError('HASH ERROR: {}'.format(
+                mismatches[0].destination))
+
+    async def _download_all(self, downloads):
+        self._unpaused = asyncio.Event()
+        if not self._paused:
+            self._unpaused.set()
+        self._task = asyncio.ensure_future(self._gather(downloads))
+        dispatcher = asyncio.ensure_future(self._dispatch())
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            if self._queued_cancel:
+                raise Canceled from None
+            raise
+        finally:
+            self._task = None
+            self._unpaused = None
+            dispatcher.cancel()
+            # Let the dispatcher finish being canceled.
+            await asyncio.gather(dispatcher, return_exceptions=True)
+
+    async def _gather(self, downloads):
+        connections = asyncio.Semaphore(MAX_TOTAL_CONNECTIONS)
+        tasks = [asyncio.ensure_future(self._download(download, connections))
+                 for download in downloads]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # If one download failed, or the whole group was canceled, the
+            # rest are abandoned.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _dispatch(self):
+        # While we're downloading, we need to periodically process D-Bus
+        # events, otherwise we won't be able to cancel downloads or handle
+        # other interruptive events.  See CurlDownloadManager._perform().
+        context = GLib.main_context_default()
+        while True:
+            while context.iteration(may_block=False):
+                pass
+            await asyncio.sleep(DISPATCH_INTERVAL)
+
+    async def _download(self, download, connections):
+        async with connections:
+            url = download.url
+            for redirect in range(MAX_REDIRECTS + 1):
+                reader, writer = await self._connect(url)
+                try:
+                    status, headers = await self._request(
+                        reader, writer, url, download.request_headers())
+                    location = headers.get('location')
+                    if status in REDIRECTS and location is not None:
+                        url = urljoin(url, location)
+                        continue
+                    if status >= 400:
+                        log.error('HTTP error {}: {}', status, url)
+                        raise FileNotFoundError(
+                            'HTTP error {}: {}'.format(status, url))
+                    await self._receive(download, status, headers, reader)
+                finally:
+                    writer.close()
+                break
+            else:
+                raise FileNotFoundError(
+                    'Too many redirects: {}'.format(download.url))
+        download.finish(status, headers)
+        self._complete(download)
+
+    def _complete(self, download):
+        # Only downloads with the expected checksum are reported as
+        # completed, so they can be used while the rest of the group is still
+        # downloading.
+        if download.validators is not None:
+            self.validators[download.destination] = download.validators
+        if download.not_modified:
+            self.not_modified.add(download.destination)
+        if download.expected_checksum == '':
+            # Pretend no checksum was gotten, to make the comparison simpler.
+            download.checksum = ''
+        elif download.checksum != download.expected_checksum:
+            log.error('Checksum mismatch.  got:{} != exp:{}: {}',
+                      download.checksum, download.expected_checksum,
+                      download.destination)
+            return
+        else:
+            self.checksums[download.destination] = download.checksum
+        self._do_completion_callback(download.record)
+
+    async def _connect(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in DEFAULT_PORTS:
+            raise FileNotFoundError('Unsupported url: {}'.format(url))
+        context = make_ssl_context() if parts.scheme == 'https' else None
+        port = parts.port or DEFAULT_PORTS[parts.scheme]
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(
+                    parts.hostname, port, ssl=context,
+                    server_hostname=(
+                        None if context is None else parts.hostname)),
+                CONNECTION_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as error:
+            log.error('Cannot connect: {}: {}', error, url)
+            raise FileNotFoundError('{}: {}'.format(error, url)) from None
+
+    async def _request(self, reader, writer, url, extra_headers):
+        # Send the GET request, and return the response's status and its
+        # headers, with lower case names.
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        host = parts.hostname
+        if parts.port is not None:
+            host = '{}:{}'.format(host, parts.port)
+        lines = [
+            'GET {} HTTP/1.1'.format(path),
+            'Host: {}'.format(host),
+            'User-Agent: {}'.format(config.user_agent),
+            'Connection: close',
+            ]
+        lines.extend('{}: {}'.format(name, value)
+                     for name, value in extra_headers.items())
+        lines.extend(['', ''])
+        writer.write('\r\n'.join(lines).encode('iso-8859-1'))
+        try:
+            await writer.drain()
+            # Header lines are ISO-8859-1 per RFC 2616.
+            line = (await reader.readline()).decode('iso-8859-1')
+            status = line.split()
+            if (len(status) < 2 or not status[0].startswith('HTTP/') or
+                    not status[1].isdigit()):
+                raise FileNotFoundError(
+                    'Bad response: {!r}: {}'.format(line, url))
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('iso-8859-1').strip()
+                if line == '':
+                    break
+                name, colon, value = line.partition(':')
+                if colon == ':':
+                    headers[name.strip().lower()] = value.strip()
+        except (OSError, ValueError) as error:
+            if isinstance(error, FileNotFoundError):
+                raise
+            raise FileNotFoundError('{}: {}'.format(error, url)) from None
+        return int(status[1]), headers
+
+    async def _read(self, download, reader, size):
+        # Read at most `size` bytes, waiting first if the download is paused.
+        # Give up on a stalled download rather than wait for it forever.
+        if download.pausable:
+            await self._unpaused.wait()
+        try:
+            data = await asyncio.wait_for(reader.read(size), LOW_SPEED_TIME)
+        except asyncio.TimeoutError:
+            log.error('Download timed out: {}', download.url)
+            raise FileNotFoundError(
+                'Timed out: {}'.format(download.url)) from None
+        self.received += len(data)
+        self._do_callback()
+        return data
+
+    async def _receive(self, download, status, headers, reader):
+        # Write the response body to the destination file.  A response
+        # saying the cached copy is not modified has no body.
+        if status == NOT_MODIFIED:
+            return
+        with open(download.destination, 'wb') as fp:
+            chunked = headers.get('transfer-encoding', '').lower().endswith(
+                'chunked')
+            try:
+                if chunked:
+                    await self._receive_chunked(download, reader, fp)
+                    return
+                length = headers.get('content-length')
+                if length is None:
+                    remaining = None
+                else:
+                    remaining = int(length)
+                    # Add in the size of a download that wasn't known up
+                    # front, as the server reports it.
+                    if download.record.size is None:
+                        self.total += remaining
+                while remaining is None or remaining > 0:
+                    data = await self._read(
+                        download, reader, CHUNK_SIZE if remaining is None
+                        else min(remaining, CHUNK_SIZE))
+                    if len(data) == 0:
+                        if remaining is None:
+                            break
+                        raise FileNotFoundError(
+                            'Incomplete response: {}'.format(download.url))
+                    download.write(fp, data)
+                    if remaining is not None:
+                        remaining -= len(data)
+            except (OSError, ValueError) as error:
+                if isinstance(error, FileNotFoundError):
+                    raise
+                raise FileNotFoundError(
+                    '{}: {}'.format(error, download.url)) from None
+
+    async def _receive_chunked(self, download, reader, fp):
+        while True:
+            line = await reader.readline()
+            size = int(line.split(b';')[0].strip(), 16)
+            if size == 0:
+                break
+            while size > 0:
+                data = await self._read(
+                    download, reader, min(size, CHUNK_SIZE))
+                if len(data) == 0:
+                    raise FileNotFoundError(
+                        'Incomplete response: {}'.format(download.url))
+                download.write(fp, data)
+                size -= len(data)
+            # The CRLF after the chunk.
+            await reader.readline()
+        # Skip any trailers.
+        while (await reader.readline()).strip() != b'':
+            pass
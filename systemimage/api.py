@@ -22,11 +22,16 @@ __all__ = [
     ]
 
 
+import os
+import time
 import logging
 
 from systemimage.apply import factory_reset, production_reset
+from systemimage.download import Record, get_cached_path
+from systemimage.helpers import temporary_directory
 from systemimage.state import State
 from systemimage.config import config
+from urllib.parse import urljoin
 
 
 log = logging.getLogger('systemimage')
@@ -85,6 +90,10 @@ class Mediator:
         self._update = None
         self._channels = None
         self._callback = callback
+        # When the last successful check was made or revalidated, as
+        # measured by time.monotonic(), and what it was made for.
+        self._checked_at = None
+        self._checked_for = None
 
     def __repr__(self): # pragma: no cover
         fmt = '<Mediator at 0x{:x} | State at 0x{:x} | Downloader at {}>'
@@ -103,12 +112,79 @@ class Mediator:
     def resume(self):
         self._state.downloader.resume()
 
+    def _check_key(self):
+        # The result of a check only holds for these.
+        return (self._config.channel, self._config.build_number,
+                self._config.device, self._config.phase_override)
+
+    def is_cached(self):
+        """Can the result of the last check be reused?
+
+        It can if the check succeeded, the update has not been downloaded
+        since, the channel, build number, device, and phase are unchanged, and
+        ``[dbus]check_ttl`` is not zero.  Once the result is older than that,
+        `check_for_update()` first asks the server whether anything changed.
+
+        :return: Whether `check_for_update()` can avoid a full check.
+        :rtype: bool
+        """
+        return (self._checked_at is not None
+                and self._config.dbus.check_ttl.total_seconds() > 0
+                and self._checked_for == self._check_key())
+
+    def _revalidate(self):
+        # Ask the server whether the channels.json and index.json files
+        # changed since they were last verified.  Whenever either file is
+        # published, it is signed again, so only their signatures are asked
+        # for, with a conditional request for each.  Nothing is transferred
+        # if they haven't changed.  Otherwise only the small signature files
+        # are, and they're thrown away, since the full check downloads
+        # everything it needs itself.  If the server gives no validators,
+        # the signatures have to be downloaded in full, and so they count as
+        # changed.
+        try:
+            device = self._state.channels[
+                self._config.channel].devices[self._config.device]
+        except (KeyError, TypeError):
+            return False
+        urls = [urljoin(self._config.https_base, path + '.asc')
+                for path in ('channels.json', device.index)]
+        downloader = self._state.downloader
+        with temporary_directory(dir=self._config.tempdir) as tmpdir:
+            downloads = [
+                Record(url, os.path.join(tmpdir, str(i)),
+                       cached=get_cached_path(url))
+                for i, url in enumerate(urls)]
+            try:
+                downloader.get_files(downloads)
+            except Exception:
+                log.exception('Revalidating the last check failed')
+                return False
+        return all(record.destination in downloader.not_modified
+                   for record in downloads)
+
     def check_for_update(self):
         """Is there an update available for this machine?
 
+        The result is cached, see `is_cached()`.
+
         :return: Flag indicating whether an update is available or not.
         :rtype: bool
         """
+        if self._update is not None and self.is_cached():
+            age = time.monotonic() - self._checked_at
+            if age < self._config.dbus.check_ttl.total_seconds():
+                log.info('Using the last check, from {:.1f}s ago'.format(age))
+                return self._update
+            if self._revalidate():
+                log.info('Server files not modified; using the last check')
+                self._checked_at = time.monotonic()
+                return self._update
+            log.info('Server files modified; checking again')
+            self._state = State()
+            self._update = None
+            self._channels = None
+            self._checked_at = None
         if self._update is None:
             try:
                 self._state.run_until('download_files')
@@ -128,10 +204,15 @@ class Mediator:
                         redirect=self._state.channels[key].get('redirect'),
                         name=key
                     ))
+                self._checked_at = time.monotonic()
+                self._checked_for = self._check_key()
         return self._update
 
     def download(self):
         """Download the available update."""
+        # The state machine moves on past the check, so its result can't be
+        # reused any more.
+        self._checked_at = None
         # We only want callback progress during the actual download.
         old_callbacks = self._state.downloader.callbacks[:]
         try:
@@ -145,6 +226,14 @@ class Mediator:
         # Transition through all remaining states.
         list(self._state)
 
+    def timings(self):
+        """The cost of each step the update has run so far.
+
+        :return: See `Timings.summary()`.
+        :rtype: dict
+        """
+        return self._state.timings.summary()
+
     def factory_reset(self):
         factory_reset()
 
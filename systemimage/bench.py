@@ -0,0 +1,340 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Simulate what a published index does to a fleet of clients.
+
+For every build a device could be at, and for each of a population of
+simulated devices, calculate the upgrade that the client would choose, using
+exactly the same candidate, scoring, and phasing code as the client does.
+"""
+
+__all__ = [
+    'Histogram',
+    'machine_ids',
+    'main',
+    'simulate',
+    'starting_builds',
+    ]
+
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from pkgutil import get_data
+from systemimage import helpers
+from systemimage.candidates import get_candidates, iter_path
+from systemimage.config import config
+from systemimage.helpers import MiB, temporary_directory
+from systemimage.index import Index
+
+
+__version__ = get_data('systemimage', 'version.txt').decode('utf-8').strip()
+
+COLON = ':'
+BAR_WIDTH = 40
+
+
+class Histogram:
+    """A histogram of timings, in power of two buckets of microseconds."""
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        """Record one timing.
+
+        :param seconds: The elapsed time.
+        :type seconds: float
+        """
+        microseconds = int(seconds * 1000000)
+        # Bucket n counts the timings below 2**n microseconds, and at or
+        # above the previous bucket's limit.
+        self.buckets[microseconds.bit_length()] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def summary(self):
+        """Return the histogram as a JSON serializable dictionary.
+
+        :return: A dictionary with the `count`, `total`, `mean`, and
+            `maximum` timings in seconds, and the `buckets`, a list of
+            2-tuples of the upper limit of each bucket in microseconds and the
+            number of timings in it.
+        :rtype: dict
+        """
+        return dict(
+            count=self.count,
+            total=self.total,
+            mean=(self.total / self.count if self.count > 0 else 0.0),
+            maximum=self.maximum,
+            buckets=[(1 << bucket, self.buckets[bucket])
+                     for bucket in sorted(self.buckets)],
+            )
+
+
+def machine_ids(count, seed=0):
+    """Return a reproducible population of machine ids.
+
+    :param count: The number of machine ids.
+    :param seed: The random seed, so that the same arguments always produce
+        the same population.
+    :return: The list of machine ids, which look like the ones in
+        /etc/machine-id.
+    """
+    r = random.Random(seed)
+    return ['{:032x}'.format(r.getrandbits(128)) for i in range(count)]
+
+
+def starting_builds(index):
+    """Return every build number a device could be at.
+
+    These are 0, i.e. a device which has never been updated, and the version
+    of every image in the index.
+
+    :param index: The index of available upgrades.
+    :type index: An `Index`
+    :return: The sorted list of build numbers.
+    """
+    builds = {0}
+    builds.update(image.version for image in index.images)
+    return sorted(builds)
+
+
+@contextmanager
+def _machine_id(directory, machine_id):
+    # Make phased_percentage() see this machine id.
+    path = os.path.join(directory, 'machine-id')
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(machine_id)
+    saved = helpers.UNIQUE_MACHINE_ID_FILES
+    helpers.UNIQUE_MACHINE_ID_FILES = [path]
+    try:
+        yield
+    finally:
+        helpers.UNIQUE_MACHINE_ID_FILES = saved
+
+
+def _describe(path):
+    # Full images are given by their version, and deltas by their base and
+    # version, since both can upgrade to the same version.
+    return [(str(image.version) if image.type == 'full'
+             else '{}-{}'.format(image.base, image.version))
+            for image in path]
+
+
+def _download_size(path):
+    # The bytes a device actually downloads for this upgrade path, which
+    # stops at the first image needing a reboot.
+    return sum(filerec.size for n, filerec in iter_path(path))
+
+
+def simulate(index, builds, machines, channel, scorer):
+    """Simulate the upgrades chosen from every build by every machine.
+
+    :param index: The index of available upgrades.
+    :type index: An `Index`
+    :param builds: The build numbers to upgrade from.
+    :param machines: The machine ids of the simulated devices.
+    :param channel: The channel being upgraded to.
+    :param scorer: The scorer which chooses the upgrade path.
+    :type scorer: A `Scorer`
+    :return: A dictionary with the `builds`, a list of dictionaries giving
+        for each build the number of candidate `paths` and the `winners`,
+        and the `timings`, a dictionary of the `candidates` and `choose`
+        histogram summaries.  Each winner gives the `path` of images, which
+        is empty for devices that stay where they are, its download `size`
+        in bytes, and the number of `machines` choosing it.  A full image in
+        the path is given by its version, e.g. '40', and a delta by its base
+        and version, e.g. '39-40'.
+    :rtype: dict
+    """
+    candidates_timings = Histogram()
+    choose_timings = Histogram()
+    winners = OrderedDict((build, Counter()) for build in builds)
+    paths = {}
+    for build in builds:
+        start = time.perf_counter()
+        candidates = get_candidates(index, build)
+        candidates_timings.add(time.perf_counter() - start)
+        paths[build] = len(candidates)
+    sizes = {}
+    with temporary_directory() as tmpdir:
+        for machine_id in machines:
+            with _machine_id(tmpdir, machine_id):
+                for build in builds:
+                    start = time.perf_counter()
+                    winner = scorer.choose_from_index(index, build, channel)
+                    choose_timings.add(time.perf_counter() - start)
+                    key = tuple(winner)
+                    winners[build][key] += 1
+                    if key not in sizes:
+                        sizes[key] = _download_size(winner)
+    return dict(
+        builds=[dict(build=build,
+                     paths=paths[build],
+                     winners=[dict(path=_describe(key),
+                                   size=sizes[key],
+                                   machines=count)
+                              for key, count in counts.most_common()])
+                for build, counts in winners.items()],
+        timings=dict(candidates=candidates_timings.summary(),
+                     choose=choose_timings.summary()),
+        )
+
+
+def _print_report(report, machines):
+    for result in report['builds']:
+        print('{:>8} {:>8} paths'.format(result['build'], result['paths']))
+        for winner in result['winners']:
+            if len(winner['path']) == 0:
+                description = 'no upgrade'
+            else:
+                description = '{} ({:.1f} MiB)'.format(
+                    COLON.join(winner['path']),
+                    winner['size'] / MiB)
+            print('{:>24.1f}% {}'.format(
+                100 * winner['machines'] / machines, description))
+    for name, summary in sorted(report['timings'].items()):
+        print()
+        print('{}: {} calls, {:.6f}s total, {:.6f}s mean, {:.6f}s max'.format(
+            name, summary['count'], summary['total'], summary['mean'],
+            summary['maximum']))
+        most = max((count for limit, count in summary['buckets']), default=0)
+        for limit, count in summary['buckets']:
+            print('{:>10}us {:>8} {}'.format(
+                '<' + str(limit), count, '#' * (BAR_WIDTH * count // most)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='system-image-bench',
+        description="""Simulate the upgrades a fleet of devices would choose
+                       from an index""")
+    parser.add_argument('--version',
+                        action='version',
+                        version='system-image-bench {}'.format(__version__))
+    parser.add_argument('-C', '--config',
+                        default=None, action='store',
+                        metavar='DIRECTORY',
+                        help="""Use the given configuration directory, e.g.
+                                for the scorer hook, instead of the
+                                defaults""")
+    parser.add_argument('-c', '--channel',
+                        default=None, action='store',
+                        help="""The channel being upgraded to, which seeds the
+                                phased percentages""")
+    parser.add_argument('-b', '--build',
+                        default=None, action='append', type=int,
+                        help="""Only simulate upgrades from this build; may be
+                                given multiple times""")
+    parser.add_argument('-m', '--machines',
+                        default=100, action='store', type=int,
+                        help="""The number of simulated devices""")
+    parser.add_argument('--seed',
+                        default=0, action='store', type=int,
+                        help="""The random seed for the machine ids and any
+                                synthetic index""")
+    parser.add_argument('--json',
+                        default=False, action='store_true',
+                        help="""Print the report as JSON""")
+    group = parser.add_argument_group(
+        'synthetic index',
+        """Instead of loading an index file, generate one.  This needs the
+           systemimage.testing package.""")
+    group.add_argument('--synthetic',
+                       default=None, action='store', type=int,
+                       metavar='BUILDS',
+                       help="""Generate an index with this many builds""")
+    group.add_argument('--full-every',
+                       default=10, action='store', type=int, metavar='N',
+                       help="""Publish a full image for every Nth build""")
+    group.add_argument('--fork',
+                       default=1, action='store', type=int, metavar='N',
+                       help="""The number of deltas for builds which fork""")
+    group.add_argument('--fork-every',
+                       default=1, action='store', type=int, metavar='N',
+                       help="""Only every Nth build forks""")
+    group.add_argument('--chain',
+                       default=None, action='store', type=int, metavar='N',
+                       help="""Only publish deltas for builds at most this
+                               many builds past the last full image""")
+    group.add_argument('--bootme-every',
+                       default=0, action='store', type=int, metavar='N',
+                       help="""Every Nth image needs a reboot""")
+    group.add_argument('--minversion-every',
+                       default=0, action='store', type=int, metavar='N',
+                       help="""Every Nth full image has a minimum version""")
+    group.add_argument('--phased-percentage',
+                       default=None, action='store', type=int, metavar='N',
+                       help="""The phased percentage of the newest build's
+                               images""")
+    parser.add_argument('index', nargs='?',
+                        help="""The index.json file""")
+
+    args = parser.parse_args(sys.argv[1:])
+    if (args.index is None) == (args.synthetic is None):
+        parser.error('Give either an index file or --synthetic')
+        assert 'parser.error() does not return' # pragma: no cover
+    if args.config is not None:
+        try:
+            config.load(args.config)
+        except (TypeError, FileNotFoundError):
+            parser.error('\nConfiguration directory not found: {}'.format(
+                args.config))
+            assert 'parser.error() does not return' # pragma: no cover
+    if args.index is None:
+        try:
+            from systemimage.testing.synthetic import synthetic_index
+        except ImportError:
+            parser.error('--synthetic needs the systemimage.testing package')
+            assert 'parser.error() does not return' # pragma: no cover
+        index = synthetic_index(
+            args.synthetic,
+            full_every=args.full_every,
+            fork=args.fork,
+            fork_every=args.fork_every,
+            chain=args.chain,
+            bootme_every=args.bootme_every,
+            minversion_every=args.minversion_every,
+            phased_percentage=args.phased_percentage,
+            seed=args.seed)
+    else:
+        with open(args.index, encoding='utf-8') as fp:
+            index = Index.from_json(fp.read())
+    builds = (starting_builds(index) if args.build is None
+              else sorted(set(args.build)))
+    machines = machine_ids(args.machines, args.seed)
+    channel = config.channel if args.channel is None else args.channel
+    report = simulate(
+        index, builds, machines, channel, config.hooks.scorer())
+    if args.json:
+        print(json.dumps(report))
+    else:
+        _print_report(report, len(machines))
+    return 0
+
+
+if __name__ == '__main__':                          # pragma: no cover
+    sys.exit(main())
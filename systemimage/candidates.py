@@ -24,24 +24,6 @@ __all__ = [
     ]
 
 
-from collections import deque
-
-
-class _Chaser:
-    def __init__(self):
-        # Paths are represented by lists, so we need to listify each element
-        # of the initial set of roots.
-        self._paths = deque()
-
-    def __iter__(self):
-        while self._paths:
-            yield self._paths.pop()
-
-    def push(self, new_path):
-        # new_path must be a list.
-        self._paths.appendleft(new_path)
-
-
 def get_candidates(index, build):
     """Calculate all the candidate upgrade paths.
 
@@ -65,61 +47,12 @@ def get_candidates(index, build):
     :type build: str
     :return: list-of-lists of upgrade paths.  The empty list is returned if
         there are no candidate paths.
+    :raises ValueError: if the index was pruned for some other build.
     """
-    # Start by splitting the images into fulls and delta.  Throw out any full
-    # updates which have a minimum version greater than our version.
-    fulls = set()
-    deltas = set()
-    for image in index.images:
-        if image.type == 'full':
-            if getattr(image, 'minversion', 0) <= build:
-                fulls.add(image)
-        elif image.type == 'delta':
-            deltas.add(image)
-        else: # pragma: no cover
-            # BAW 2013-04-30: log and ignore.
-            raise AssertionError('unknown image type: {}'.format(image.type))
-    # Load up the roots of candidate upgrade paths.
-    chaser = _Chaser()
-    # Each full version that is newer than our current version provides the
-    # start of an upgrade path.
-    for image in fulls:
-        if image.version > build:
-            chaser.push([image])
-    # Each delta with a base that matches our version also provides the start
-    # of an upgrade path.
-    for image in deltas:
-        if image.base == build:
-            chaser.push([image])
-    # Chase the back pointers from the deltas until we run out of newer
-    # versions.  It's possible to push new paths into the chaser if we find a
-    # fork in the road (i.e. two deltas with the same base).
-    paths = list()
-    for path in chaser:
-        current = path[-1]
-        while True:
-            # Find all the deltas that have this step as their base.
-            next_steps = [delta for delta in deltas
-                          if delta.base == current.version]
-            # If there is no next step, then we're done with this path.
-            if len(next_steps) == 0:
-                paths.append(path)
-                break
-            # If there's only one next step, append that to path and keep
-            # going, with this step as the current image.
-            elif len(next_steps) == 1:
-                current = next_steps[0]
-                path.append(current)
-            # Otherwise, we have a fork.  Take one fork now and push the other
-            # paths onto the chaser.
-            else:
-                current = next_steps.pop()
-                for fork in next_steps:
-                    new_path = path.copy()
-                    new_path.append(fork)
-                    chaser.push(new_path)
-                path.append(current)
-    return paths
+    # The index's upgrade graph keeps the deltas indexed by their base, so
+    # chasing each path is a lookup per step rather than a scan of all the
+    # deltas in the index.
+    return index.graph.candidates(build)
 
 
 def iter_path(winner):
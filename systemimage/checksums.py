@@ -0,0 +1,126 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A persistent record of the checksums of local files."""
+
+__all__ = [
+    'ChecksumCache',
+    ]
+
+
+import os
+import json
+import logging
+
+from systemimage.config import config
+from systemimage.helpers import atomic, calculate_signature, makedirs
+
+
+log = logging.getLogger('systemimage')
+
+CACHE_FILE = 'checksums.json'
+
+
+def _stat_key(path):
+    # A file whose size, modification time, and inode are unchanged is
+    # assumed to have unchanged contents.
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class ChecksumCache:
+    """The sha256 checksums of files, so they needn't be read again.
+
+    Each checksum is recorded along with the size, modification time, and
+    inode of the file at the time.  As long as those haven't changed, the
+    recorded checksum is used instead of reading the whole file again.
+    """
+
+    def __init__(self, path=None):
+        self.path = (
+            os.path.join(config.updater.data_partition, CACHE_FILE)
+            if path is None
+            else path)
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, encoding='utf-8') as fp:
+                    self._entries = json.load(fp)
+            except FileNotFoundError:
+                self._entries = {}
+            except ValueError:
+                log.exception('Discarding unreadable checksums: {}',
+                              self.path)
+                self._entries = {}
+        return self._entries
+
+    def get(self, path):
+        """Return the recorded checksum of a file.
+
+        :param path: The path to the file.
+        :return: The file's sha256 hex digest, or None if there is no record
+            of it or the file has changed since it was recorded.
+        """
+        entry = self._load().get(path)
+        if entry is None:
+            return None
+        try:
+            key = _stat_key(path)
+        except FileNotFoundError:
+            return None
+        return entry['sha256'] if entry['stat'] == key else None
+
+    def put(self, path, checksum):
+        """Record the checksum of a file.
+
+        The caller must know that the file's current contents have this
+        checksum, e.g. because it was calculated while writing the file.
+
+        :param path: The path to the file.
+        :param checksum: The file's sha256 hex digest.
+        """
+        self.update([(path, checksum)])
+
+    def update(self, checksums):
+        """Record the checksums of several files at once.
+
+        :param checksums: An iterable of 2-tuples of the path to a file and
+            its sha256 hex digest.
+        """
+        entries = self._load()
+        for path, checksum in checksums:
+            entries[path] = dict(stat=_stat_key(path), sha256=checksum)
+        # Forget about files which are gone.
+        for path in list(entries):
+            if not os.path.exists(path):
+                del entries[path]
+        makedirs(os.path.dirname(self.path))
+        with atomic(self.path) as fp:
+            json.dump(entries, fp)
+
+    def checksum(self, path):
+        """Return the checksum of a file, reading it only if necessary.
+
+        :param path: The path to the file.
+        :return: The file's sha256 hex digest.
+        """
+        checksum = self.get(path)
+        if checksum is None:
+            with open(path, 'rb') as fp:
+                checksum = calculate_signature(fp)
+            self.put(path, checksum)
+        return checksum
@@ -30,8 +30,8 @@ from pathlib import Path
 from systemimage.bag import Bag
 from systemimage.deviceStats import DeviceStats
 from systemimage.helpers import (
-    NO_PORT, as_loglevel, as_object, as_port, as_stripped, as_timedelta,
-    makedirs, temporary_directory)
+    NO_PORT, as_bool, as_loglevel, as_object, as_port, as_size, as_stripped,
+    as_timedelta, makedirs, temporary_directory)
 
 SECTIONS = ('service', 'system', 'gpg', 'updater', 'hooks', 'dbus')
 USER_AGENT = ('Ubuntu System Image Upgrade Client: '
@@ -101,6 +101,7 @@ class Configuration:
             https_port=443,
             channel='daily',
             build_number=0,
+            delta_indexes=False,
             )
         self.system = Bag(
             timeout=as_timedelta('1h'),
@@ -108,6 +109,13 @@ class Configuration:
             logfile='/var/log/system-image/client.log',
             loglevel=as_loglevel('info'),
             settings_db='/var/lib/system-image/settings.db',
+            segments=1,
+            segment_size=as_size('16M'),
+            prefetch=False,
+            downloader='auto',
+            progress_interval=as_timedelta('0.5s'),
+            progress_step=0,
+            payload_cache_size=as_size('1G'),
             )
         self.gpg = Bag(
             archive_master='/usr/share/system-image/archive-master.tar.xz',
@@ -120,6 +128,7 @@ class Configuration:
         self.updater = Bag(
             cache_partition='/android/cache/recovery',
             data_partition='/var/lib/system-image',
+            payload_cache='',
             )
         self.hooks = Bag(
             device=as_object('systemimage.device.SystemProperty'),
@@ -128,6 +137,7 @@ class Configuration:
             )
         self.dbus = Bag(
             lifetime=as_timedelta('10m'),
+            check_ttl=as_timedelta('1m'),
             )
 
     def _load_file(self, path):
@@ -139,20 +149,30 @@ class Configuration:
                                             https_port=as_port,
                                             build_number=int,
                                             device=as_stripped,
+                                            delta_indexes=as_bool,
                                             ),
                             **parser['service'])
         self.system.update(converters=dict(timeout=as_timedelta,
                                            loglevel=as_loglevel,
                                            settings_db=expand_path,
-                                           tempdir=expand_path),
+                                           tempdir=expand_path,
+                                           segments=int,
+                                           segment_size=as_size,
+                                           prefetch=as_bool,
+                                           downloader=as_stripped,
+                                           progress_interval=as_timedelta,
+                                           progress_step=int,
+                                           payload_cache_size=as_size),
                             **parser['system'])
         self.gpg.update(**parser['gpg'])
-        self.updater.update(**parser['updater'])
+        self.updater.update(converters=dict(payload_cache=as_stripped),
+                            **parser['updater'])
         self.hooks.update(converters=dict(device=as_object,
                                           scorer=as_object,
                                           apply=as_object),
                           **parser['hooks'])
-        self.dbus.update(converters=dict(lifetime=as_timedelta),
+        self.dbus.update(converters=dict(lifetime=as_timedelta,
+                                         check_ttl=as_timedelta),
                          **parser['dbus'])
 
     def load(self, directory):
@@ -20,14 +20,21 @@ __all__ = [
     ]
 
 
+import os
+import json
 import pycurl
+import shutil
 import hashlib
 import logging
+import tempfile
 
 from contextlib import ExitStack
 from gi.repository import GLib
 from systemimage.config import config
-from systemimage.download import Canceled, DownloadManagerBase
+from systemimage.download import (
+    JOURNAL_SUFFIX, VALIDATORS, Canceled, DownloadManagerBase, Record,
+    _Prefetched, get_cached_path, get_journal, get_validators)
+from systemimage.helpers import atomic, calculate_signature, safe_remove
 
 log = logging.getLogger('systemimage')
 
@@ -39,6 +46,12 @@ LOW_SPEED_TIME = 120        # seconds
 MAX_REDIRECTS = 5
 MAX_TOTAL_CONNECTIONS = 4
 SELECT_TIMEOUT = 0.05       # 20fps
+PARTIAL_CONTENT = 206
+NOT_MODIFIED = 304
+# How many more bytes of a resumable download must be written before its
+# journal is updated.
+JOURNAL_INTERVAL = 4 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
 
 
 def _curl_debug(debug_type, debug_msg):             # pragma: no cover
@@ -53,22 +66,111 @@ def make_testable(c):
     pass                                            # pragma: no cover
 
 
+def _make_debuggable(c):
+    """Add some additional debugging options."""
+    ## c.setopt(pycurl.VERBOSE, 1)
+    ## c.setopt(pycurl.DEBUGFUNCTION, _curl_debug)
+    pass
+
+
+def _make_curl(url):
+    # Create the basic PyCURL object, with the options common to all
+    # requests.
+    c = pycurl.Curl()
+    c.setopt(pycurl.URL, url)
+    c.setopt(pycurl.USERAGENT, config.user_agent)
+    # Set some limits.  XXX Pull these out of the configuration files.
+    c.setopt(pycurl.FOLLOWLOCATION, 1)
+    c.setopt(pycurl.MAXREDIRS, MAX_REDIRECTS)
+    c.setopt(pycurl.CONNECTTIMEOUT, CONNECTION_TIMEOUT)
+    # If the average transfer speed is below 10 bytes per second for 2
+    # minutes, libcurl will consider the connection too slow and abort.
+    ## c.setopt(pycurl.LOW_SPEED_LIMIT, LOW_SPEED_LIMIT)
+    ## c.setopt(pycurl.LOW_SPEED_TIME, LOW_SPEED_TIME)
+    # Fail on error codes >= 400.
+    c.setopt(pycurl.FAILONERROR, 1)
+    # Switch off the libcurl progress meters.  The multi that uses
+    # this handle will set the transfer info function.
+    c.setopt(pycurl.NOPROGRESS, 1)
+    # ssl: no need to set SSL_VERIFYPEER, SSL_VERIFYHOST, CAINFO
+    #      they all use sensible defaults
+    #
+    # Enable debugging.
+    _make_debuggable(c)
+    # For the test suite.
+    make_testable(c)
+    return c
+
+
+def _parse_status(line):
+    # Return the status code from a response's status line, otherwise None.
+    if line.startswith('HTTP/'):
+        status = line.split()
+        if len(status) > 1 and status[1].isdigit():
+            return int(status[1])
+    return None
+
+
 class SingleDownload:
-    def __init__(self, record):
-        self.url, self.destination, self.expected_checksum = record
+    def __init__(self, record, progress=None):
+        self.record = record
+        # Called with the number of bytes written to (or, when the download
+        # starts over, taken back from) the destination file.
+        self.progress = progress
+        self.url = record.url
+        self.destination = record.destination
+        self.expected_checksum = record.checksum
+        self.cached = record.cached
+        # Downloads with an expected checksum are journaled so that they can
+        # be resumed if they get interrupted.  Keep track of how many bytes
+        # were already on disk when the GET started, how many are on disk
+        # now, and how many of those the journal vouches for.
+        self.journaled = (self.expected_checksum != '')
+        self.resumed = 0
+        self._written = 0
+        self._journal_written = 0
+        self._status = None
+        self.finished = False
+        # The validators of the cached copy, but only if it came from the
+        # same url.  These are used to make a conditional request.
+        self._cached_validators = get_validators(self.cached)
+        if (self._cached_validators is not None and
+                self._cached_validators.get('url') != self.url):
+            self._cached_validators = None
+        # The validators of the response, and whether the server said the
+        # cached copy is not modified.
+        self.validators = None
+        self.not_modified = False
+        self._response_headers = {}
         self._checksum = None
+        self._cached_checksum = None
         self._fp = None
+        self._handle = None
         self._resources = ExitStack()
 
+    def make_handles(self):
+        """Return the handles which GET the file."""
+        self._handle = self.make_handle(HEAD=False)
+        return [self._handle]
+
     def make_handle(self, *, HEAD):
         # If we're doing GET, record some more information.
         if not HEAD:
             self._checksum = hashlib.sha256()
-        # Create the basic PyCURL object.
-        c = pycurl.Curl()
-        # Set the common options.
-        c.setopt(pycurl.URL, self.url)
-        c.setopt(pycurl.USERAGENT, config.user_agent)
+        c = _make_curl(self.url)
+        # Keep track of the response's status, and if the file can be
+        # cached, of its validators.  If it already is cached, only ask for it
+        # if it's been modified.
+        if self.cached is not None or not HEAD:
+            c.setopt(pycurl.HEADERFUNCTION, self._header)
+        if self.cached is not None:
+            if self._cached_validators is not None:
+                c.setopt(pycurl.HTTPHEADER, [
+                    '{}: {}'.format(request_header, self._cached_validators[
+                        response_header])
+                    for response_header, request_header in VALIDATORS.items()
+                    if response_header in self._cached_validators
+                    ])
         # If we're doing a HEAD, then we don't want the body of the
         # file.  Otherwise, set things up to write the body data to the
         # destination file.
@@ -76,44 +178,144 @@ class SingleDownload:
             c.setopt(pycurl.NOBODY, 1)
         else:
             c.setopt(pycurl.WRITEDATA, self)
-            self._fp = self._resources.enter_context(
-                open(self.destination, 'wb'))
-        # Set some limits.  XXX Pull these out of the configuration files.
-        c.setopt(pycurl.FOLLOWLOCATION, 1)
-        c.setopt(pycurl.MAXREDIRS, MAX_REDIRECTS)
-        c.setopt(pycurl.CONNECTTIMEOUT, CONNECTION_TIMEOUT)
-        # If the average transfer speed is below 10 bytes per second for 2
-        # minutes, libcurl will consider the connection too slow and abort.
-        ## c.setopt(pycurl.LOW_SPEED_LIMIT, LOW_SPEED_LIMIT)
-        ## c.setopt(pycurl.LOW_SPEED_TIME, LOW_SPEED_TIME)
-        # Fail on error codes >= 400.
-        c.setopt(pycurl.FAILONERROR, 1)
-        # Switch off the libcurl progress meters.  The multi that uses
-        # this handle will set the transfer info function.
-        c.setopt(pycurl.NOPROGRESS, 1)
-        # ssl: no need to set SSL_VERIFYPEER, SSL_VERIFYHOST, CAINFO
-        #      they all use sensible defaults
-        #
-        # Enable debugging.
-        self._make_debuggable(c)
-        # For the test suite.
-        make_testable(c)
+            self._fp = self._resources.enter_context(self._open())
+            if self.resumed > 0:
+                c.setopt(pycurl.RESUME_FROM_LARGE, self.resumed)
         return c
 
-    def _make_debuggable(self, c):
-        """Add some additional debugging options."""
-        ## c.setopt(pycurl.VERBOSE, 1)
-        ## c.setopt(pycurl.DEBUGFUNCTION, _curl_debug)
-        pass
+    def _open(self):
+        # Pick up where an interrupted download of the same file left off, as
+        # long as its journal says the partial file is what we expect.  Only
+        # the bytes the journal vouches for are kept, and the checksum of
+        # those is rebuilt from the file.
+        journal = get_journal(self.record) if self.journaled else None
+        offset = 0 if journal is None else journal['bytes']
+        if self.record.size is not None and offset >= self.record.size:
+            # There's nothing left to ask the server for, but the download
+            # didn't finish, so something is wrong.  Start over.
+            offset = 0
+        if offset == 0:
+            safe_remove(self.destination + JOURNAL_SUFFIX)
+            return open(self.destination, 'wb')
+        log.info('Resuming download at byte {}: {}'.format(offset, self.url))
+        fp = open(self.destination, 'r+b')
+        fp.truncate(offset)
+        while True:
+            data = fp.read(CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            self._checksum.update(data)
+        self.resumed = self._written = self._journal_written = offset
+        return fp
+
+    def _restart(self):
+        log.info('Server ignored the range, restarting download: {}'.format(
+            self.url))
+        self._fp.seek(0)
+        self._fp.truncate()
+        self._checksum = hashlib.sha256()
+        if self.progress is not None:
+            self.progress(-self.resumed)
+        self.resumed = self._written = self._journal_written = 0
 
     def write(self, data):
         """Update the checksum and write the data out to the file."""
+        if self.resumed > 0 and self._status != PARTIAL_CONTENT:
+            # We asked for the rest of the file, but got all of it.
+            self._restart()
         self._checksum.update(data)
         self._fp.write(data)
+        self._written += len(data)
+        if self.progress is not None:
+            self.progress(len(data))
+        if (self.journaled and
+                self._written - self._journal_written >= JOURNAL_INTERVAL):
+            self.write_journal()
         # Returning None implies that all bytes were written
         # successfully, so it's better to be explicit.
         return None
 
+    def write_journal(self):
+        """Record how much of the partial download is safely on disk."""
+        if self._fp.closed:
+            with open(self.destination, 'rb') as fp:
+                os.fsync(fp.fileno())
+        else:
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+        with atomic(self.destination + JOURNAL_SUFFIX) as fp:
+            json.dump(dict(url=self.url,
+                           checksum=self.expected_checksum,
+                           bytes=self._written),
+                      fp)
+        self._journal_written = self._written
+
+    def _header(self, line):
+        # Header lines are ISO-8859-1 per RFC 2616.  A status line starts the
+        # headers of a new response, e.g. after a redirect.
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+            self._response_headers = {}
+            self._status = _parse_status(line)
+        name, colon, value = line.partition(':')
+        if colon == ':':
+            name = name.strip().lower()
+            if name in VALIDATORS:
+                self._response_headers[name] = value.strip()
+
+    def finish(self):
+        """Finish the download after the GET has been performed.
+
+        If the server said that the cached copy is not modified, the cached
+        copy is used as the destination file.
+        """
+        self.close()
+        self.finished = True
+        # The download is complete, so it need never be resumed.
+        if self.journaled:
+            safe_remove(self.destination + JOURNAL_SUFFIX)
+        if self.cached is None:
+            return
+        self.validators = dict(self._response_headers)
+        if (self._handle.getinfo(pycurl.RESPONSE_CODE) == NOT_MODIFIED and
+                self._cached_validators is not None):
+            log.info('Not modified, using cached copy: {}'.format(self.url))
+            self.not_modified = True
+            shutil.copy(self.cached, self.destination)
+            with open(self.destination, 'rb') as fp:
+                self._cached_checksum = calculate_signature(fp)
+            # The server may have sent new validators, otherwise keep the old
+            # ones.
+            validators = {
+                key: value for key, value in self._cached_validators.items()
+                if key in VALIDATORS
+                }
+            validators.update(self.validators)
+            self.validators = validators
+
+    def abandon(self):
+        """Clean up after the group download failed or was canceled.
+
+        What has been downloaded so far is kept, and journaled, if the
+        download can be resumed.  Otherwise the destination file is removed.
+        """
+        # The server refusing the request, e.g. because the range can't be
+        # satisfied, must not lead to the same request being made next time.
+        # A download which already finished is kept too, since all of it
+        # is safely on disk.
+        resumable = (
+            self.journaled and
+            self._fp is not None and (self.finished or not self._fp.closed) and
+            self._written > 0 and
+            self._handle.getinfo(pycurl.RESPONSE_CODE) < 400)
+        if resumable:
+            self.write_journal()
+            self.close()
+        else:
+            self.close()
+            safe_remove(self.destination)
+            safe_remove(self.destination + JOURNAL_SUFFIX)
+
     def close(self):
         self._resources.close()
 
@@ -123,80 +325,336 @@ class SingleDownload:
         # makes the verification step below a wee bit simpler.
         if self.expected_checksum == '':
             return ''
+        if self._cached_checksum is not None:
+            return self._cached_checksum
         return self._checksum.hexdigest()
 
 
+class _Segment:
+    def __init__(self, download, first, last):
+        self.download = download
+        self.first = first
+        self.last = last
+        self.position = first
+        # If the server ignores the range, every segment would get the whole
+        # file.  Only the first one keeps it, and the others are superfluous.
+        self.superfluous = False
+        self.handle = None
+        self._status = None
+
+    def make_handle(self):
+        c = _make_curl(self.download.url)
+        c.setopt(pycurl.RANGE, '{}-{}'.format(self.first, self.last))
+        c.setopt(pycurl.HEADERFUNCTION, self._header)
+        c.setopt(pycurl.WRITEFUNCTION, self.write)
+        self.handle = c
+        return c
+
+    def _header(self, line):
+        status = _parse_status(line.decode('iso-8859-1'))
+        if status is not None:
+            self._status = status
+
+    def write(self, data):
+        """Write the data out at the segment's position in the file."""
+        if self._status != PARTIAL_CONTENT and self.first > 0:
+            # Returning a count other than the length of the data aborts the
+            # transfer.
+            self.superfluous = True
+            return 0
+        fd = self.download.fileno()
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.pwrite(fd, view, self.position)
+            self.position += written
+            view = view[written:]
+        self.download.progress(len(data))
+        return None
+
+
+class SegmentedDownload:
+    """Download a large file over several connections at once.
+
+    The file is split into byte range segments which are downloaded
+    concurrently, each one written at its offset into the preallocated
+    destination file.  The checksum of the whole file is calculated once all
+    the segments are downloaded.  Segmented downloads are not journaled, so
+    they cannot be resumed.
+    """
+
+    # Segmented downloads are never conditional, resumed, or cached.
+    validators = None
+    not_modified = False
+    resumed = 0
+
+    def __init__(self, record, count, progress):
+        self.record = record
+        self.progress = progress
+        self.url = record.url
+        self.destination = record.destination
+        self.expected_checksum = record.checksum
+        self.segments = []
+        size = record.size
+        step = -(-size // count)
+        for first in range(0, size, step):
+            self.segments.append(
+                _Segment(self, first, min(first + step, size) - 1))
+        self._checksum = None
+        self._fp = None
+        self._resources = ExitStack()
+        self.finished = False
+
+    def fileno(self):
+        return self._fp.fileno()
+
+    def make_handles(self):
+        """Return the handles which GET the segments of the file."""
+        self._fp = self._resources.enter_context(
+            open(self.destination, 'wb'))
+        try:
+            os.posix_fallocate(self._fp.fileno(), 0, self.record.size)
+        except OSError:
+            # Not all file systems support it, but the segments can still be
+            # written at their offsets.
+            os.ftruncate(self._fp.fileno(), self.record.size)
+        return [segment.make_handle() for segment in self.segments]
+
+    def finish(self):
+        """Finish the download after all the segments have been performed."""
+        self.close()
+        self.finished = True
+        with open(self.destination, 'rb') as fp:
+            self._checksum = calculate_signature(fp)
+
+    def abandon(self):
+        """Clean up after the group download failed or was canceled."""
+        self.close()
+        safe_remove(self.destination)
+
+    def close(self):
+        self._resources.close()
+
+    @property
+    def checksum(self):
+        if self.expected_checksum == '':
+            return ''
+        return self._checksum
+
+
 class CurlDownloadManager(DownloadManagerBase):
     """The PyCURL based download manager."""
 
+    resumable = True
+
     def __init__(self, callback=None):
         super().__init__()
         if callback is not None:
             self.callbacks.append(callback)
         self._pausables = []
         self._paused = False
+        # The handles whose sizes are only known once the server responds,
+        # and the total size of all the other downloads.
+        self._unsized = []
+        self._sized_total = 0
+        # The downloads in progress, which may have been resumed, the
+        # downloads which each handle in progress belongs to, and the
+        # completed downloads whose checksums didn't match.
+        self._downloads = []
+        self._owners = {}
+        self._mismatches = []
+        # While prefetching, the handles whose transfers failed.
+        self._failed = None
 
     def _get_files(self, records, pausable, signal_started):
-        # Start by doing a HEAD on all the URLs so that we can get the total
-        # target download size in bytes, at least as best as is possible.
+        # Records can carry the expected size of their file, in which case
+        # the total target download size is known up front.  Only if none of
+        # them do, start by doing a HEAD on all the URLs so that we can get
+        # the total target download size in bytes, at least as best as is
+        # possible.  Otherwise, the few records without a size (e.g. the
+        # signature files) are small, so rather than paying for a round trip
+        # to the server, their size is added to the total as soon as their
+        # GET response says what it is.
+        self._sized_total = sum(
+            record.size for record in records if record.size is not None)
+        unsized = all(record.size is None for record in records)
+        if unsized:
+            self._head(records)
+        else:
+            self.total = self._sized_total
+        # Now do a GET on all the URLs.  This will write the data to the
+        # destination file and collect the checksums.
+        if signal_started and config.dbus_service is not None:
+            config.dbus_service.DownloadStarted()
         with ExitStack() as resources:
-            handles = []
+            resources.callback(setattr, self, '_handles', None)
+            resources.callback(setattr, self, '_unsized', [])
+            resources.callback(setattr, self, '_downloads', [])
+            resources.callback(setattr, self, '_owners', {})
+            resources.callback(setattr, self, '_mismatches', [])
+            downloads = self._downloads
             multi = pycurl.CurlMulti()
             multi.setopt(
                 pycurl.M_MAX_TOTAL_CONNECTIONS, MAX_TOTAL_CONNECTIONS)
             for record in records:
-                download = SingleDownload(record)
+                download = self._make_download(record)
+                downloads.append(download)
                 resources.callback(download.close)
-                handle = download.make_handle(HEAD=True)
-                handles.append(handle)
-                multi.add_handle(handle)
-                # .add_handle() does not bump the reference count, so we
-                # need to keep the PyCURL object alive for the duration
-                # of this download.
-                resources.callback(multi.remove_handle, handle)
-            self._perform(multi, handles)
-            self.total = sum(
-                handle.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)
-                for handle in handles)
-        # Now do a GET on all the URLs.  This will write the data to the
-        # destination file and collect the checksums.
-        if signal_started and config.dbus_service is not None:
-            config.dbus_service.DownloadStarted()
+                for handle in download.make_handles():
+                    self._owners[handle] = download
+                    self._pausables.append(handle)
+                    if record.size is None and not unsized:
+                        self._unsized.append(handle)
+                    multi.add_handle(handle)
+                    # .add_handle() does not bump the reference count, so we
+                    # need to keep the PyCURL object alive for the duration
+                    # of this download.
+                    resources.callback(multi.remove_handle, handle)
+            try:
+                self._perform(multi, self._pausables)
+            except:
+                # Keep what can be resumed next time, and throw the rest
+                # away.
+                for download in downloads:
+                    download.abandon()
+                self._pausables = []
+                raise
+            # Most downloads were already completed as soon as their
+            # transfers were done.
+            for download in downloads:
+                if not download.finished:
+                    self._complete(download)
+            # The API requires a FileNotFoundError to be raised when the
+            # checksums don't match.  Since it doesn't matter which one
+            # fails, they were all logged, and the first one is raised.
+            for download in downloads:
+                if download in self._mismatches:
+                    # For backward compatibility with ubuntu-download_manager.
+                    raise FileNotFoundError('HASH ERROR: {}'.format(
+                        download.destination))
+        self._pausables = []
+
+    def _complete(self, download):
+        # Finish the download and verify its internally calculated checksum.
+        # Only downloads with the expected checksum are reported as
+        # completed, so they can be used while the rest of the group is still
+        # downloading.
+        download.finish()
+        if download.validators is not None:
+            self.validators[download.destination] = download.validators
+        if download.not_modified:
+            self.not_modified.add(download.destination)
+        if download.checksum != download.expected_checksum:
+            log.error('Checksum mismatch.  got:{} != exp:{}: {}',
+                      download.checksum, download.expected_checksum,
+                      download.destination)
+            self._mismatches.append(download)
+            return
+        if download.expected_checksum != '':
+            self.checksums[download.destination] = download.checksum
+        self._do_completion_callback(download.record)
+
+    def _transfer_done(self, c):
+        # A download is complete once all of its handles are done.
+        download = self._owners.pop(c, None)
+        if download is None:
+            # E.g. a HEAD request.
+            return
+        if download not in self._owners.values():
+            self._complete(download)
+
+    def _prefetch(self, urls):
+        # Download whichever of the files can be downloaded.  The transfers
+        # which fail are noted rather than failing the whole group.  None of
+        # the sizes are known up front.
+        prefetched = {}
+        self._sized_total = 0
+        self.total = 0
         with ExitStack() as resources:
-            resources.callback(setattr, self, '_handles', None)
-            downloads = []
+            resources.callback(setattr, self, '_unsized', [])
+            resources.callback(setattr, self, '_downloads', [])
+            resources.callback(setattr, self, '_failed', None)
+            self._failed = set()
+            downloads = self._downloads
+            handles = []
+            multi = pycurl.CurlMulti()
+            multi.setopt(
+                pycurl.M_MAX_TOTAL_CONNECTIONS, MAX_TOTAL_CONNECTIONS)
+            for url in urls:
+                fd, path = tempfile.mkstemp(
+                    prefix='si-prefetch', dir=config.tempdir)
+                os.close(fd)
+                download = SingleDownload(
+                    Record(url, path, cached=get_cached_path(url)),
+                    self._progress)
+                downloads.append(download)
+                resources.callback(download.close)
+                handles.extend(download.make_handles())
+                multi.add_handle(handles[-1])
+                # See _get_files().
+                resources.callback(multi.remove_handle, handles[-1])
+            self._unsized.extend(handles)
+            try:
+                self._perform(multi, handles)
+            except:
+                for download in downloads:
+                    download.abandon()
+                raise
+            for download, handle in zip(downloads, handles):
+                if handle in self._failed:
+                    download.abandon()
+                    continue
+                download.finish()
+                prefetched[download.url] = _Prefetched(
+                    download.destination, download.cached,
+                    download.validators, download.not_modified)
+        return prefetched
+
+    def _make_download(self, record):
+        # Large files whose size is known can be split into segments which
+        # are downloaded concurrently, but no segment is smaller than the
+        # configured segment size.  A file with a partial download to resume
+        # is downloaded over a single connection.
+        segments = min(config.system.segments, MAX_TOTAL_CONNECTIONS)
+        if segments > 1 and record.size is not None:
+            count = min(segments,
+                        record.size // max(config.system.segment_size, 1))
+            if count > 1 and get_journal(record) is None:
+                log.info('Downloading in {} segments: {}'.format(
+                    count, record.url))
+                return SegmentedDownload(record, count, self._progress)
+        return SingleDownload(record, self._progress)
+
+    def _is_superfluous(self, c):
+        # Segments of a file from a server which ignores byte ranges abort
+        # their transfers on purpose.
+        return any(
+            segment.handle is c and segment.superfluous
+            for download in self._downloads
+            if isinstance(download, SegmentedDownload)
+            for segment in download.segments)
+
+    def _head(self, records):
+        with ExitStack() as resources:
+            handles = []
             multi = pycurl.CurlMulti()
             multi.setopt(
                 pycurl.M_MAX_TOTAL_CONNECTIONS, MAX_TOTAL_CONNECTIONS)
             for record in records:
                 download = SingleDownload(record)
-                downloads.append(download)
                 resources.callback(download.close)
-                handle = download.make_handle(HEAD=False)
-                self._pausables.append(handle)
+                handle = download.make_handle(HEAD=True)
+                handles.append(handle)
                 multi.add_handle(handle)
                 # .add_handle() does not bump the reference count, so we
                 # need to keep the PyCURL object alive for the duration
                 # of this download.
                 resources.callback(multi.remove_handle, handle)
-            self._perform(multi, self._pausables)
-            # Verify internally calculated checksums.  The API requires
-            # a FileNotFoundError to be raised when they don't match.
-            # Since it doesn't matter which one fails, log them all and
-            # raise the first one.
-            first_mismatch = None
-            for download in downloads:
-                if download.checksum != download.expected_checksum:
-                    log.error('Checksum mismatch.  got:{} != exp:{}: {}',
-                              download.checksum, download.expected_checksum,
-                              download.destination)
-                    if first_mismatch is None:
-                        first_mismatch = download
-            if first_mismatch is not None:
-                # For backward compatibility with ubuntu-download_manager.
-                raise FileNotFoundError('HASH ERROR: {}'.format(
-                    first_mismatch.destination))
-        self._pausables = []
+            self._perform(multi, handles)
+            # The content length is -1 when it is unknown, e.g. because the
+            # cached copy was not modified.
+            self.total = sum(
+                max(0, handle.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD))
+                for handle in handles)
 
     def _do_once(self, multi, handles):
         status, active_count = multi.perform()
@@ -212,6 +670,17 @@ class CurlDownloadManager(DownloadManagerBase):
         # The multi is okay, but it's possible there are errors pending on
         # the individual downloads; check those now.
         queued_count, ok_list, error_list = multi.info_read()
+        for c in ok_list:
+            self._transfer_done(c)
+        error_list = [error for error in error_list
+                      if not self._is_superfluous(error[0])]
+        if self._failed is not None:
+            # Prefetching tolerates failures.
+            for c, code, message in error_list:
+                log.info('Not prefetched: {} ({}): {}'.format(
+                    message, code, c.getinfo(pycurl.EFFECTIVE_URL)))
+                self._failed.add(c)
+            error_list = []
         if len(error_list) > 0:
             # It helps to have at least one URL in the FileNotFoundError.
             first_url = None
@@ -234,17 +703,14 @@ class CurlDownloadManager(DownloadManagerBase):
         # once in a while.  It turns out that even if we're not running a D-Bus
         # main loop (i.e. during the in-process tests) periodically dispatching
         # into GLib doesn't hurt, so just do it unconditionally.
-        self.received = 0
+        #
+        # The bytes received are counted as the downloads write them.  Bytes
+        # of resumed downloads which were received by an earlier attempt
+        # count too, since the total is for the whole files.
+        self.received = sum(download.resumed for download in self._downloads)
         context = GLib.main_context_default()
         while True:
-            # Do the progress callback, but only if the current received size
-            # is different than the last one.  Don't worry about in which
-            # direction it's different.
-            received = int(
-                sum(c.getinfo(pycurl.SIZE_DOWNLOAD) for c in handles))
-            if received != self.received:
-                self._do_callback()
-                self.received = received
+            self._update_total()
             if not self._do_once(multi, handles):
                 break
             multi.select(SELECT_TIMEOUT)
@@ -254,11 +720,21 @@ class CurlDownloadManager(DownloadManagerBase):
                 pass
             if self._queued_cancel:
                 raise Canceled
-        # One last callback, unconditionally.
-        self.received = int(
-            sum(c.getinfo(pycurl.SIZE_DOWNLOAD) for c in handles))
+        self._update_total()
+
+    def _progress(self, count):
+        # A download wrote some bytes.
+        self.received += count
         self._do_callback()
 
+    def _update_total(self):
+        # Add in the sizes of the downloads that weren't known up front, as
+        # the server reports them.  The content length is -1 until then.
+        if len(self._unsized) > 0:
+            self.total = self._sized_total + sum(
+                max(0, c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD))
+                for c in self._unsized)
+
     def pause(self):
         for c in self._pausables:
             c.pause(pycurl.PAUSE_ALL)
@@ -24,6 +24,7 @@ __all__ = [
 
 import os
 import sys
+import json
 import logging
 
 from datetime import datetime
@@ -32,6 +33,7 @@ from functools import wraps
 from gi.repository import GLib
 from systemimage.api import Mediator
 from systemimage.config import config
+from systemimage.download import ETA
 from systemimage.helpers import last_update_date
 from systemimage.settings import Settings
 from threading import Lock
@@ -97,6 +99,7 @@ class Service(Object):
         self.loop = loop
         self._api = Mediator(self._progress_callback)
         log.info('Mediator created {}', self._api)
+        self._eta = ETA()
         self._checking = Lock()
         self._downloading = Lock()
         self._update = None
@@ -179,9 +182,13 @@ class Service(Object):
             return
         log.info('CheckForUpdate(): checking lock acquired')
         # We've now acquired the lock.  Reset any failure or in-progress
-        # state.  Get a new mediator to reset any of its state.
-        self._api = Mediator(self._progress_callback)
-        log.info('Mediator recreated {}', self._api)
+        # state.  Unless the last check can be reused, get a new mediator to
+        # reset any of its state.
+        if self._api.is_cached():
+            log.info('Reusing the last check of {}', self._api)
+        else:
+            self._api = Mediator(self._progress_callback)
+            log.info('Mediator recreated {}', self._api)
         self._failure_count = 0
         self._last_error = ''
         # Arrange for the actual check to happen in a little while, so that
@@ -191,15 +198,19 @@ class Service(Object):
     #@log_and_exit
     def _progress_callback(self, received, total):
         # Plumb the progress through our own D-Bus API.  Our API is defined as
-        # signalling a percentage and an eta.  We can calculate the percentage
-        # easily, but the eta is harder.  For now, we just send 0 as the eta.
-        percentage = received * 100 // total
-        eta = 0
+        # signalling a percentage and an eta.  The eta is estimated from the
+        # smoothed transfer rate.  The download managers already limit how
+        # often this is called.
+        percentage = received * 100 // total if total > 0 else 0
+        eta = self._eta.update(received, total)
         self.UpdateProgress(percentage, eta)
 
     @log_and_exit
     def _download(self):
         if self._downloading.locked() and self._paused:
+            # Nothing was transferred while paused, so that time mustn't
+            # count against the transfer rate.
+            self._eta.reset()
             self._api.resume()
             self._paused = False
             log.info('Download previously paused')
@@ -222,6 +233,7 @@ class Service(Object):
             try:
                 # Always start by sending a UpdateProgress(0, 0).  This is
                 # enough to get the u/i's attention.
+                self._eta.reset()
                 self.UpdateProgress(0, 0)
                 self._api.download()
             except Exception:
@@ -345,6 +357,13 @@ class Service(Object):
             response['target_version_detail'] = self._update.version_detail
         return response
 
+    @log_and_exit
+    @method('com.canonical.SystemImage', out_signature='s')
+    def GetTimings(self):
+        """Return the cost of each step of the update, as JSON."""
+        self.loop.keepalive()
+        return json.dumps(self._api.timings())
+
     @log_and_exit
     @method('com.canonical.SystemImage', in_signature='ss')
     def SetSetting(self, key, value):
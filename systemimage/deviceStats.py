@@ -19,8 +19,7 @@ def getSerial():
 # Hash the serial number
 def hashSerial(serial):
     md5 = hashlib.md5()
-    print(getSerial())
-    md5.update(getSerial())
+    md5.update(serial)
     return md5.hexdigest()
 
 # retrun hashed the serial number
@@ -42,7 +41,7 @@ class DeviceStats(object):
         self.sessionId = None
         self.instanceId = None
         self.createSessionIdIfNull()
-        self.createInstanceIdIfNull()
+        # The instance id runs getprop, so it's only created when needed.
 
     def createSessionIdIfNull(self):
         if not self.sessionId:
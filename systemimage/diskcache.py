@@ -0,0 +1,135 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent caches of files, keeping the most recently used entries."""
+
+__all__ = [
+    'DiskCache',
+    ]
+
+
+import os
+import logging
+
+from systemimage.config import config
+from systemimage.helpers import safe_remove
+
+
+log = logging.getLogger('systemimage')
+
+
+class DiskCache:
+    """A directory of cache entries, evicting the least recently used.
+
+    Each entry is a set of files named after the entry's key, one for each of
+    the class's `suffixes`.  The file with the last suffix is the entry's
+    marker.  It is written last, since it marks a complete entry, and its
+    modification time records when the entry was last used.  Files of other
+    entries may live in the same directory as long as their names don't end
+    with the marker's suffix.
+
+    Subclasses set `suffixes`, `name` (the directory's name in the data
+    partition), and `kind` (what an entry holds, for the log).
+    """
+
+    suffixes = ()
+    name = None
+    kind = 'entry'
+
+    def __init__(self, directory=None, max_entries=None, max_size=None):
+        """
+        :param directory: The cache directory, by default `name` in the data
+            partition.
+        :param max_entries: If not None, keep at most this many entries.
+        :param max_size: If not None, keep the entries only up to this many
+            bytes in total, as given by `entry_size()`.
+        """
+        self.directory = (
+            os.path.join(config.updater.data_partition, self.name)
+            if directory is None
+            else directory)
+        self.max_entries = max_entries
+        self.max_size = max_size
+
+    def paths(self, key, directory=None):
+        """Return the paths of an entry's files, with the marker last.
+
+        :param key: The entry's key.
+        :param directory: The directory holding the entry, by default the
+            cache directory.
+        """
+        base = os.path.join(
+            self.directory if directory is None else directory, key)
+        return [base + suffix for suffix in self.suffixes]
+
+    def is_complete(self, key, directory=None):
+        """Return whether all of an entry's files exist."""
+        return all(os.path.exists(path)
+                   for path in self.paths(key, directory))
+
+    def touch(self, key, directory=None):
+        """Mark an entry as just used."""
+        os.utime(self.paths(key, directory)[-1])
+
+    def discard(self, key, directory=None):
+        """Remove an entry, if it exists."""
+        # The marker goes first, since it marks a complete entry.
+        for path in reversed(self.paths(key, directory)):
+            safe_remove(path)
+
+    def discard_unreadable(self, key, directory=None):
+        """Remove an entry which can't be used, logging the exception."""
+        log.exception('Discarding unreadable cached {}: {}', self.kind, key)
+        self.discard(key, directory)
+
+    def entry_size(self, key, directory):
+        """Return the size of an entry in bytes.
+
+        This is only used when there is a maximum size.  If it raises
+        ValueError, KeyError, or TypeError, the entry is unreadable and is
+        discarded.
+        """
+        return sum(os.path.getsize(path)
+                   for path in self.paths(key, directory))
+
+    def evict(self, directory=None):
+        """Evict the least recently used entries which don't fit.
+
+        :param directory: The directory holding the entries, by default the
+            cache directory.
+        """
+        directory = self.directory if directory is None else directory
+        marker = self.suffixes[-1]
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith(marker):
+                key = name[:-len(marker)]
+                path = os.path.join(directory, name)
+                entries.append((os.stat(path).st_mtime, key))
+        entries.sort(reverse=True)
+        count = 0
+        total = 0
+        for mtime, key in entries:
+            if self.max_size is not None:
+                try:
+                    total += self.entry_size(key, directory)
+                except (ValueError, KeyError, TypeError):
+                    self.discard_unreadable(key, directory)
+                    continue
+            count += 1
+            if ((self.max_entries is not None and count > self.max_entries)
+                    or (self.max_size is not None and total > self.max_size)):
+                log.info('Evicting cached {}: {}', self.kind, key)
+                self.discard(key, directory)
@@ -18,18 +18,30 @@
 __all__ = [
     'Canceled',
     'DuplicateDestinationError',
+    'ETA',
     'Record',
+    'get_cached_path',
     'get_download_manager',
+    'get_journal',
+    'get_validators',
     ]
 
 
 import os
+import sys
 import dbus
+import json
+import time
+import shutil
 import logging
 
 from collections import namedtuple
+from hashlib import sha256
 from io import StringIO
 from pprint import pformat
+from systemimage.config import config
+from systemimage.helpers import atomic, makedirs, safe_remove
+from urllib.parse import urlparse
 
 try:
     import pycurl
@@ -39,6 +51,31 @@ except ImportError:                                 # pragma: no cover
 
 log = logging.getLogger('systemimage')
 
+# The HTTP validators of a locally cached copy of a download are kept in a
+# file next to that copy, with this suffix.
+VALIDATORS_SUFFIX = '.validators'
+# The response headers which are kept for making conditional requests, and
+# the request headers they are sent back in.
+VALIDATORS = {
+    'etag': 'If-None-Match',
+    'last-modified': 'If-Modified-Since',
+    }
+# The subdirectory of the data partition where verified copies of the
+# metadata files are kept.
+CACHE_DIRECTORY = 'metadata'
+# A partial download which can be resumed is described by a journal file next
+# to it, with this suffix.
+JOURNAL_SUFFIX = '.journal'
+# How much weight the most recent transfer rate gets in the smoothed rate
+# which the estimated time remaining is based on.
+ETA_SMOOTHING = 0.3
+
+
+# A file which was downloaded ahead of time, along with what the server said
+# about it.
+_Prefetched = namedtuple(
+    '_Prefetched', 'path cached validators not_modified')
+
 
 class Canceled(Exception):
     """Raised when the download was canceled."""
@@ -60,17 +97,139 @@ class DuplicateDestinationError(Exception):
 # to the empty string.  We do this by creating a prototypical record type and
 # using _replace() to replace non-default values.  See the namedtuple
 # documentation for details.
-_Record = namedtuple('Record', 'url destination checksum')('', '', '')
+#
+# The cached attribute optionally names a local copy of a previous, verified
+# download of the url.  Download managers which support it will make a
+# conditional request and, if the url has not been modified, copy the cached
+# file to the destination instead of downloading it again.
+#
+# The size attribute is the expected size of the file in bytes, if known, so
+# that download managers need not ask the server for it up front.
+_Record = namedtuple('Record', 'url destination checksum cached size')(
+    '', '', '', None, None)
 _RecordType = type(_Record)
 
-def Record(url, destination, checksum=''):
+def Record(url, destination, checksum='', cached=None, size=None):
     return _Record._replace(
-        url=url, destination=destination, checksum=checksum)
+        url=url, destination=destination, checksum=checksum, cached=cached,
+        size=size)
+
+
+class ETA:
+    """Estimate the time remaining to complete a download.
+
+    The estimate is based on an exponentially weighted moving average of the
+    transfer rate, so that it doesn't jump around with every burst or stall
+    of the connection.
+    """
+
+    def __init__(self, smoothing=ETA_SMOOTHING):
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        """Forget the transfer rate, e.g. when the download is resumed."""
+        self._last = None
+        self._rate = None
+
+    def update(self, received, total, now=None):
+        """Account for the progress of the download.
+
+        :param received: The number of bytes received so far.
+        :param total: The total number of bytes to be downloaded.
+        :param now: The monotonic time of the progress report, defaulting to
+            the current time.
+        :return: The estimated number of seconds remaining, or 0 if there is
+            no reasonable estimate yet.
+        :rtype: float
+        """
+        if now is None:
+            now = time.monotonic()
+        if self._last is not None:
+            last_received, last_time = self._last
+            elapsed = now - last_time
+            if received < last_received:
+                # A new download has started.
+                self._rate = None
+            elif elapsed > 0:
+                rate = (received - last_received) / elapsed
+                if self._rate is None:
+                    self._rate = rate
+                else:
+                    self._rate = (self.smoothing * rate +
+                                  (1 - self.smoothing) * self._rate)
+        self._last = (received, now)
+        if not self._rate or received >= total:
+            return 0.0
+        return (total - received) / self._rate
+
+
+def get_cached_path(url):
+    """Return the path for a verified local copy of a metadata file.
+
+    :param url: The url of the metadata file.
+    :return: The path in the data partition for the cached copy.  The
+        file name includes a hash of the url, so different urls with the same
+        base name are kept apart.
+    """
+    basename = os.path.basename(urlparse(url).path)
+    digest = sha256(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(
+        config.updater.data_partition, CACHE_DIRECTORY,
+        '{}-{}'.format(digest, basename))
+
+
+def get_validators(cached):
+    """Return the HTTP validators of a locally cached copy of a download.
+
+    :param cached: The path to the cached copy.
+    :return: None if there is no usable cached copy, otherwise a dictionary
+        containing the `url` the copy was downloaded from, its `etag` and
+        `last-modified` response headers if the server gave them, and the
+        `fingerprint` of the keyrings it was verified with.
+    """
+    if cached is None or not os.path.exists(cached):
+        return None
+    try:
+        with open(cached + VALIDATORS_SUFFIX, encoding='utf-8') as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def get_journal(record):
+    """Return the journal of an interrupted download, if it can be resumed.
+
+    :param record: The download record.
+    :return: None if the partial destination file cannot be resumed,
+        otherwise a dictionary containing the `url` and expected `checksum` it
+        is being downloaded with, and the number of `bytes` which were safely
+        written to it.  Only downloads with an expected checksum are resumed,
+        and only from the same url with the same checksum.
+    """
+    if record.checksum == '' or not os.path.exists(record.destination):
+        return None
+    try:
+        with open(record.destination + JOURNAL_SUFFIX, encoding='utf-8') as fp:
+            journal = json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (journal.get('url') != record.url or
+            journal.get('checksum') != record.checksum or
+            not isinstance(journal.get('bytes'), int) or
+            os.path.getsize(record.destination) < journal['bytes']):
+        return None
+    return journal
 
 
 class DownloadManagerBase:
     """Base class for all download managers."""
 
+    # Download managers which can resume interrupted downloads keep the
+    # journaled partial files around when a download fails or is canceled.
+    # Those files must not be deleted before the next download.
+    resumable = False
+
     def __init__(self):
         """
         :param callback: If given, a function that is called every so often
@@ -84,9 +243,34 @@ class DownloadManagerBase:
         # of bytes received so far, and the total amount of bytes to be
         # downloaded.
         self.callbacks = []
+        # This is a list of functions that are called as each file of a
+        # group download is completed, possibly before the rest of the group
+        # is.  Functions in this list take one argument, the download record.
+        self.completion_callbacks = []
+        self._completed = set()
+        # Files downloaded by prefetch(), keyed by url.
+        self._prefetched = {}
         self.total = 0
         self.received = 0
+        # The monotonic time, received bytes, and total bytes of the last
+        # progress report, and how often progress is reported.
+        self._last_progress = None
+        self._progress_interval = 0
+        self._progress_step = 0
+        # The number of bytes received by all downloads so far, including
+        # prefetches.
+        self.bytes_received = 0
         self._queued_cancel = False
+        # Download managers which support conditional requests record the
+        # validators of each response here, keyed by destination, and the
+        # destinations which were copied from their cached file because the
+        # server said they were not modified.
+        self.validators = {}
+        self.not_modified = set()
+        # Download managers which calculate the checksums of the files as
+        # they download them record the verified checksums here, keyed by
+        # destination, so that the files needn't be read again.
+        self.checksums = {}
 
     def __repr__(self): # pragma: no cover
         return '<{} at 0x{:x}>'.format(self.__class__.__name__, id(self))
@@ -122,14 +306,43 @@ class DownloadManagerBase:
                 if len(seen) > 1:
                     # Tuples will look better in the pretty-printed output.
                     duplicates.append(
-                        (dst, sorted(tuple(dup) for dup in seen)))
+                        (dst, sorted(tuple(dup[:3]) for dup in seen)))
             if len(duplicates) > 0:
                 raise DuplicateDestinationError(sorted(duplicates))
             # Uniquify the downloads.
             records = list(unique_downloads)
         return records
 
-    def _do_callback(self):
+    def _start_progress(self):
+        # Reset the progress accounting at the start of a group download.
+        self.received = 0
+        self._last_progress = None
+        self._progress_interval = (
+            config.system.progress_interval.total_seconds())
+        self._progress_step = config.system.progress_step
+
+    def _do_callback(self, force=False):
+        # Download managers account for the bytes as they arrive and call
+        # this each time, so the callbacks are rate limited.  They are called
+        # at most once per configured interval, and only when at least the
+        # configured percentage of the total has arrived since the last call.
+        # The first report of a group download is always made, and a forced
+        # report is made unless nothing changed since the last one.
+        now = time.monotonic()
+        if self._last_progress is not None:
+            last_time, last_received, last_total = self._last_progress
+            if force:
+                if (self.received, self.total) == (last_received,
+                                                   last_total):
+                    return
+            else:
+                if now - last_time < self._progress_interval:
+                    return
+                if (self.total > 0 and
+                        (self.received - last_received) * 100 <
+                        self._progress_step * self.total):
+                    return
+        self._last_progress = (now, self.received, self.total)
         # Be defensive, so yes, use a bare except.  If an exception occurs in
         # the callback, log it, but continue onward.
         for callback in self.callbacks:
@@ -138,6 +351,17 @@ class DownloadManagerBase:
             except:
                 log.exception('Exception in progress callback')
 
+    def _do_completion_callback(self, record):
+        # Each record is only completed once.  Be defensive here too.
+        if record.destination in self._completed:
+            return
+        self._completed.add(record.destination)
+        for callback in self.completion_callbacks:
+            try:
+                callback(record)
+            except:
+                log.exception('Exception in completion callback')
+
     def cancel(self):
         """Cancel any current downloads."""
         self._queued_cancel = True
@@ -153,10 +377,76 @@ class DownloadManagerBase:
     def _get_files(self, records, pausable, signal_started):
         raise NotImplementedError                   # pragma: no cover
 
+    def _prefetch(self, urls):
+        # Download managers which can't download just some of a group of
+        # files don't prefetch anything.
+        return {}
+
+    def prefetch(self, urls):
+        """Speculatively download files which will probably be needed soon.
+
+        The files are downloaded concurrently, conditionally on their
+        verified cached copies (see `get_cached_path()`), as `get_files()`
+        would.  Unlike `get_files()`, this downloads whichever of the files
+        it can, ignoring any which fail.  A later `get_files()` call uses a
+        prefetched file instead of downloading its url again, as long as the
+        record has the url's cached path and no checksum.  Each prefetched
+        file is used at most once.
+
+        :param urls: The urls of the files to download.
+        :type urls: Sequence of str.
+        """
+        if self._queued_cancel:
+            raise Canceled
+        urls = [url for url in urls if url not in self._prefetched]
+        if len(urls) == 0:
+            return
+        log.info('[0x{:x}] Prefetching:\n\t{}'.format(
+            id(self), '\n\t'.join(urls)))
+        self._start_progress()
+        try:
+            self._prefetched.update(self._prefetch(urls))
+            # Always report where the downloads ended up.
+            self._do_callback(force=True)
+        finally:
+            self.bytes_received += self.received
+
+    def is_prefetched(self, url):
+        """Whether the url was prefetched and its file is still unused."""
+        return url in self._prefetched
+
+    def discard_prefetched(self):
+        """Throw away all the prefetched files which weren't used."""
+        for prefetched in self._prefetched.values():
+            safe_remove(prefetched.path)
+        self._prefetched.clear()
+
+    def _use_prefetched(self, records):
+        # Move the prefetched files into place, and return the records which
+        # still need to be downloaded.
+        remaining = []
+        for record in records:
+            prefetched = self._prefetched.pop(record.url, None)
+            if prefetched is None:
+                remaining.append(record)
+                continue
+            if record.checksum != '' or record.cached != prefetched.cached:
+                safe_remove(prefetched.path)
+                remaining.append(record)
+                continue
+            log.info('Using prefetched: {}'.format(record.url))
+            shutil.move(prefetched.path, record.destination)
+            if prefetched.validators is not None:
+                self.validators[record.destination] = prefetched.validators
+            if prefetched.not_modified:
+                self.not_modified.add(record.destination)
+        return remaining
+
     def get_files(self, downloads, *, pausable=False, signal_started=False):
         """Download a bunch of files concurrently.
 
-        Occasionally, the callback is called to report on progress.
+        Occasionally, the callback is called to report on progress.  See
+        the `progress_interval` and `progress_step` configuration variables.
         This function blocks until all files have been downloaded or an
         exception occurs.  In the latter case, the download directory
         will be cleared of the files that succeeded and the exception
@@ -170,8 +460,14 @@ class DownloadManagerBase:
         :params downloads: A list of `download records`, each of which may
             either be a 2-tuple where the first item is the url to download,
             and the second item is the destination file, or an instance of a
-            `Record` namedtuple with attributes `url`, `destination`, and
-            `checksum`.  The checksum may be the empty string.
+            `Record` namedtuple with attributes `url`, `destination`,
+            `checksum`, `cached`, and `size`.  The checksum may be the empty
+            string, and the cached path and size may be None.  Afterward,
+            `not_modified` is the set of destinations which were copied from
+            their cached paths, and `checksums` maps destinations to the
+            checksums which were verified while downloading them.  Each
+            destination is in `checksums` by the time the completion
+            callbacks are called for it.
         :type downloads: List of 2-tuples or `Record`s.
         :param pausable: A flag specifying whether this download can be paused
             or not.  In general, data file downloads are pausable, but
@@ -184,7 +480,11 @@ class DownloadManagerBase:
             metadata files).
         :type signal_started: bool
         :raises: FileNotFoundError if any download error occurred.  In
-            this case, all download files are deleted.
+            this case, all download files are deleted, except that resumable
+            download managers keep the partial files of downloads with a
+            checksum, along with their journals (see `get_journal()`).  The
+            completion callbacks may already have been called for some of
+            the files.
         :raises: DuplicateDestinationError if more than one source url is
             downloaded to the same destination file.
         """
@@ -204,9 +504,85 @@ class DownloadManagerBase:
             if record.checksum == '':
                 print('\t{} -> {}'.format(*record[:2]), file=fp)
             else:
-                print('\t{} [{}] -> {}'.format(*record), file=fp)
+                print('\t{} [{}] -> {}'.format(*record[:3]), file=fp)
         log.info('{}'.format(fp.getvalue()))
-        self._get_files(records, pausable, signal_started)
+        self.validators.clear()
+        self.not_modified.clear()
+        self.checksums.clear()
+        self._completed.clear()
+        remaining = self._use_prefetched(records)
+        if len(remaining) > 0:
+            self._start_progress()
+            try:
+                self._get_files(remaining, pausable, signal_started)
+                # Always report where the downloads ended up.
+                self._do_callback(force=True)
+            except:
+                # All or nothing, so the prefetched files go too.
+                for record in records:
+                    if record not in remaining:
+                        safe_remove(record.destination)
+                raise
+            finally:
+                self.bytes_received += self.received
+        # Download managers which can't tell when each file is completed
+        # complete them all at the end.
+        for record in records:
+            self._do_completion_callback(record)
+
+    def is_verified(self, downloads, fingerprint):
+        """Are these downloads unmodified copies of verified files?
+
+        :param downloads: The download records previously passed to
+            `get_files()`.
+        :param fingerprint: The fingerprint of the keyrings which the
+            downloads would be verified with.
+        :return: True if the server said that none of the downloads was
+            modified since their cached copies were verified with keyrings
+            having the same fingerprint, in which case they do not need to be
+            verified again.
+        """
+        for record in self._get_download_records(downloads):
+            if record.destination not in self.not_modified:
+                return False
+            validators = get_validators(record.cached)
+            if (validators is None or
+                    validators.get('fingerprint') != fingerprint):
+                return False
+        return True
+
+    def cache_verified(self, downloads, fingerprint):
+        """Keep copies of verified downloads for conditional requests.
+
+        Call this only after the downloads have been verified.  Each
+        destination is copied to its record's cached path, along with the
+        validators the server gave for it.  Records with no cached path are
+        ignored.  When the server gave no validators, any previously cached
+        copy is removed since it could never be used.
+
+        :param downloads: The download records previously passed to
+            `get_files()`.
+        :param fingerprint: The fingerprint of the keyrings which the
+            downloads were verified with.
+        """
+        for record in self._get_download_records(downloads):
+            if record.cached is None:
+                continue
+            validators = self.validators.get(record.destination)
+            if not validators:
+                safe_remove(record.cached)
+                safe_remove(record.cached + VALIDATORS_SUFFIX)
+                continue
+            makedirs(os.path.dirname(record.cached))
+            if record.destination not in self.not_modified:
+                with atomic(record.cached, encoding=None) as fp:
+                    with open(record.destination, 'rb') as src:
+                        shutil.copyfileobj(src, fp)
+            validators = dict(validators)
+            validators['url'] = record.url
+            validators['fingerprint'] = fingerprint
+            with atomic(record.cached + VALIDATORS_SUFFIX) as fp:
+                json.dump(validators, fp)
 
     @staticmethod
     def allow_gsm():
@@ -223,19 +599,26 @@ class DownloadManagerBase:
 
 def get_download_manager(*args):
     # We have to avoid circular imports since both download managers import
-    # various things from this module.
-    from systemimage.curl import CurlDownloadManager
+    # various things from this module.  PyCURL is only needed by its own
+    # download manager.
     from systemimage.udm import DOWNLOADER_INTERFACE, UDMDownloadManager
-    # Detect if we have ubuntu-download-manager.
-    #
-    # Use PyCURL based downloader if no udm is found, or if the environment
-    # variable is set.  However, if we're told to use PyCURL and it's
-    # unavailable, throw an exception.
-    cls = None
-    use_pycurl = os.environ.get('SYSTEMIMAGE_PYCURL')
-    if use_pycurl is None:
-        # Auto-detect.  For backward compatibility, use udm if it's available,
-        # otherwise use PyCURL.
+    # The download manager can be chosen by name, with the environment
+    # taking precedence over the configuration.  For backward compatibility,
+    # the older environment variable says whether to use PyCURL or udm.
+    choice = os.environ.get('SYSTEMIMAGE_DOWNLOADER')
+    if choice is None:
+        use_pycurl = os.environ.get('SYSTEMIMAGE_PYCURL')
+        if use_pycurl is None:
+            choice = config.system.downloader
+        elif use_pycurl.lower() in ('1', 'yes', 'true'):
+            choice = 'curl'
+        else:
+            choice = 'udm'
+    choice = choice.strip().lower()
+    if choice == 'auto':
+        # Detect if we have ubuntu-download-manager.  For backward
+        # compatibility, use udm if it's available, otherwise use PyCURL.
+        # However, if PyCURL is unavailable too, throw an exception.
         try:
             bus = dbus.SystemBus()
             bus.get_object(DOWNLOADER_INTERFACE, '/')
@@ -247,9 +630,21 @@ def get_download_manager(*args):
         elif pycurl is None:
             raise ImportError('No module named {}'.format('pycurl'))
         else:
+            from systemimage.curl import CurlDownloadManager
             cls = CurlDownloadManager
+    elif choice == 'curl':
+        from systemimage.curl import CurlDownloadManager
+        cls = CurlDownloadManager
+    elif choice == 'udm':
+        cls = UDMDownloadManager
+    elif choice == 'asyncio':
+        # The asyncio download manager uses async and await, and relies on
+        # asyncio finding the running loop from within its coroutines.
+        if sys.version_info < (3, 5, 3):
+            raise ValueError(
+                'The asyncio download manager needs Python 3.5.3 or newer')
+        from systemimage.aio import AsyncioDownloadManager
+        cls = AsyncioDownloadManager
     else:
-        cls = (CurlDownloadManager
-               if use_pycurl.lower() in ('1', 'yes', 'true')
-               else UDMDownloadManager)
+        raise ValueError('Unknown download manager: {}'.format(choice))
     return cls(*args)
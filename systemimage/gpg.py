@@ -18,17 +18,34 @@
 __all__ = [
     'Context',
     'SignatureError',
+    'fingerprint',
     ]
 
 
 import os
 import gnupg
+import shutil
 import hashlib
-import tarfile
+import logging
+import tempfile
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from systemimage.config import config
-from systemimage.helpers import calculate_signature, temporary_directory
+from systemimage.helpers import (
+    DEFAULT_DIRMODE, calculate_signature)
+from systemimage.keyringcache import KeyringCache
+from systemimage.timings import gpg_invocations
+from threading import Lock
+
+
+log = logging.getLogger('systemimage')
+
+# How many unused verification contexts the pool keeps around.
+MAX_IDLE_CONTEXTS = 8
+# How many gpg processes verify a batch of signatures at the same time.
+MAX_VERIFY_WORKERS = 4
 
 
 class SignatureError(Exception):
@@ -87,10 +104,163 @@ class SignatureError(Exception):
 
 
 
+def fingerprint(keyrings, blacklist=None):
+    """Return a fingerprint of the keyrings used for verification.
+
+    The fingerprint changes whenever any of the keyring files, or the
+    blacklist, changes, appears, or disappears.  It can be stored alongside
+    the result of a verification, to know when that result is still valid.
+
+    :param keyrings: The paths to the keyrings which can sign the file.
+    :param blacklist: The optional path to the blacklist keyring.
+    :return: The hex digest fingerprint.
+    :rtype: str
+    """
+    checksum = hashlib.sha256()
+    paths = list(keyrings)
+    # The position of the blacklist must not be confused with that of a
+    # signing keyring.
+    paths.append(blacklist)
+    for path in paths:
+        if path is None or not os.path.exists(path):
+            checksum.update(b'-')
+        else:
+            with open(path, 'rb') as fp:
+                checksum.update(calculate_signature(fp).encode('ascii'))
+        checksum.update(b'\n')
+    return checksum.hexdigest()
+
+
+def _unpack(path):
+    # The keyrings must be .tar.xz files, which need to be unpacked to get
+    # at the keyring.gpg files inside them.  If we already have a copy of the
+    # .gpg file in the temporary directory, using its actual name (based on
+    # the .tar.xz file name), use that.  Otherwise, the keyring cache has the
+    # contained .gpg file, unpacking the .tar.xz file only if it's never
+    # seen these exact contents before.  Note that this does *not* validate
+    # the .tar.xz files.  That must be done elsewhere.
+    base, dot, tarxz = os.path.basename(path).partition('.')
+    assert dot == '.' and tarxz == 'tar.xz', (
+        'Expected a .tar.xz path, got: {}'.format(path))
+    keyring_path = os.path.join(config.tempdir, base + '.gpg')
+    if os.path.exists(keyring_path):
+        return keyring_path
+    return KeyringCache().get(path).gpg_path
+
+
+class _PooledContext:
+    def __init__(self, home, keyrings):
+        self.home = home
+        # python-gnupg runs gpg to find out its version.
+        gpg_invocations.increment()
+        self.gpg = gnupg.GPG(gnupghome=home, keyring=keyrings)
+        self.refcount = 0
+        self._fingerprints = None
+
+    @property
+    def fingerprints(self):
+        if self._fingerprints is None:
+            gpg_invocations.increment()
+            self._fingerprints = frozenset(
+                info['fingerprint'] for info in self.gpg.list_keys())
+        return self._fingerprints
+
+
+class _ContextPool:
+    """A pool of GPG verification contexts, reused across verifications.
+
+    Creating a context means creating a $GNUPGHOME and importing keyrings, and
+    listing its fingerprints means running gpg, so these are only done once
+    for any set of keyrings.  Contexts are keyed by the checksums of their
+    keyring files, and each context uses its own copies of its keyring files,
+    so a context can never see a keyring which has since changed.  Contexts
+    in use are reference counted, and only a few unused ones are kept.  All
+    of this lives in the process's temporary directory.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._contexts = OrderedDict()
+        self._directory = None
+
+    def _check_directory(self):
+        # The pool lives in the temporary directory, which goes away with the
+        # configuration it belongs to, e.g. during the test suite.
+        if (self._directory is None or
+                os.path.dirname(self._directory) != config.tempdir or
+                not os.path.exists(self._directory)):
+            self._contexts.clear()
+            self._directory = tempfile.mkdtemp(
+                prefix='si-gpgpool', dir=config.tempdir)
+            os.chmod(self._directory, DEFAULT_DIRMODE)
+
+    def acquire(self, keyrings):
+        """Return the context for the keyrings, and take a reference to it.
+
+        :param keyrings: The paths to the .gpg keyring files.
+        :return: The pooled context.
+        """
+        # Keyrings are small, so read them in one go.  This way the copies
+        # are guaranteed to have the checksums the context is keyed by.
+        contents = []
+        for path in keyrings:
+            with open(path, 'rb') as fp:
+                contents.append(fp.read())
+        key = tuple(hashlib.sha256(data).hexdigest() for data in contents)
+        with self._lock:
+            self._check_directory()
+            context = self._contexts.get(key)
+            if context is None:
+                home = tempfile.mkdtemp(
+                    prefix='si-gnupghome', dir=self._directory)
+                os.chmod(home, DEFAULT_DIRMODE)
+                copies = []
+                for data, checksum in zip(contents, key):
+                    copy = os.path.join(home, checksum + '.gpg')
+                    with open(copy, 'wb') as fp:
+                        fp.write(data)
+                    copies.append(copy)
+                context = _PooledContext(home, copies)
+                self._contexts[key] = context
+            else:
+                self._contexts.move_to_end(key)
+            context.refcount += 1
+            return context
+
+    def release(self, context):
+        """Drop a reference to a context returned by `acquire()`."""
+        with self._lock:
+            context.refcount -= 1
+            idle = [key for key, pooled in self._contexts.items()
+                    if pooled.refcount == 0]
+            # The least recently used contexts come first.
+            for key in idle[:-MAX_IDLE_CONTEXTS]:
+                pooled = self._contexts.pop(key)
+                shutil.rmtree(pooled.home, ignore_errors=True)
+
+    def fingerprints(self, keyrings):
+        """Return the fingerprints of all the keys in the keyrings.
+
+        :param keyrings: The paths to the .gpg keyring files.
+        :return: The set of fingerprints.
+        """
+        context = self.acquire(keyrings)
+        try:
+            return context.fingerprints
+        finally:
+            self.release(context)
+
+
+_pool = _ContextPool()
+
+
 class Context:
     def __init__(self, *keyrings, blacklist=None):
         """Create a GPG signature verification context.
 
+        The underlying contexts are pooled, so creating one for the same
+        keyrings again is cheap.
+
         :param keyrings: The list of keyrings to use for validating the
             signature on data files.
         :type keyrings: Sequence of .tar.xz keyring files, which will be
@@ -103,26 +273,9 @@ class Context:
         self.keyring_paths = keyrings
         self.blacklist_path = blacklist
         self._ctx = None
+        self._context = None
         self._stack = ExitStack()
-        self._keyrings = []
-        # The keyrings must be .tar.xz files, which need to be unpacked and
-        # the keyring.gpg files inside them cached, using their actual name
-        # (based on the .tar.xz file name).  If we don't already have a cache
-        # of the .gpg file, do the unpackaging and use the contained .gpg file
-        # as the keyring.  Note that this class does *not* validate the
-        # .tar.xz files.  That must be done elsewhere.
-        for path in keyrings:
-            base, dot, tarxz = os.path.basename(path).partition('.')
-            assert dot == '.' and tarxz == 'tar.xz', (
-                'Expected a .tar.xz path, got: {}'.format(path))
-            keyring_path = os.path.join(config.tempdir, base + '.gpg')
-            if not os.path.exists(keyring_path):
-                with tarfile.open(path, 'r:xz') as tf:
-                    tf.extract('keyring.gpg', config.tempdir)
-                    os.rename(
-                        os.path.join(config.tempdir, 'keyring.gpg'),
-                        os.path.join(config.tempdir, keyring_path))
-            self._keyrings.append(keyring_path)
+        self._keyrings = [_unpack(path) for path in keyrings]
         # Since python-gnupg doesn't do this for us, verify that all the
         # keyrings and blacklist files exist.  Yes, this introduces a race
         # condition, but I don't see any good way to eliminate this given
@@ -134,19 +287,17 @@ class Context:
             if not os.path.exists(blacklist):
                 raise FileNotFoundError(blacklist)
             # Extract all the blacklisted fingerprints.
-            with Context(blacklist) as ctx:
-                self._blacklisted_fingerprints = ctx.fingerprints
+            self._blacklisted_fingerprints = _pool.fingerprints(
+                [_unpack(blacklist)])
         else:
-            self._blacklisted_fingerprints = set()
+            self._blacklisted_fingerprints = frozenset()
 
     def __enter__(self):
         try:
-            # Use a temporary directory for the $GNUPGHOME, but be sure to
-            # arrange for the tempdir to be deleted no matter what.
-            home = self._stack.enter_context(
-                temporary_directory(prefix='si-gnupghome',
-                                    dir=config.tempdir))
-            self._ctx = gnupg.GPG(gnupghome=home, keyring=self._keyrings)
+            self._context = _pool.acquire(self._keyrings)
+            self._stack.callback(_pool.release, self._context)
+            self._stack.callback(setattr, self, '_context', None)
+            self._ctx = self._context.gpg
             self._stack.callback(setattr, self, '_ctx', None)
         except:              # pragma: no cover
             # Restore all context and re-raise the exception.
@@ -162,14 +313,16 @@ class Context:
 
     @property
     def keys(self):
+        gpg_invocations.increment()
         return self._ctx.list_keys()
 
     @property
     def fingerprints(self):
-        return set(info['fingerprint'] for info in self._ctx.list_keys())
+        return self._context.fingerprints
 
     @property
     def key_ids(self):
+        gpg_invocations.increment()
         return set(info['keyid'] for info in self._ctx.list_keys())
 
     def verify(self, signature_path, data_path):
@@ -193,14 +346,51 @@ class Context:
         # disable all GPG checks.
         if config.skip_gpg_verification:
             return True
-        with open(signature_path, 'rb') as sig_fp:
-            verified = self._ctx.verify_file(sig_fp, data_path)
+        return self._verify(signature_path, data_path, self._allowed())
+
+    def _allowed(self):
         # If the file is properly signed, we'll be able to get back a set of
         # fingerprints that signed the file.   From here we do a set operation
         # to see if the fingerprints are in the list of keys from all the
         # loaded-up keyrings.  If so, the signature succeeds.
-        return verified.fingerprint in (self.fingerprints -
-                                        self._blacklisted_fingerprints)
+        return self.fingerprints - self._blacklisted_fingerprints
+
+    def _verify(self, signature_path, data_path, allowed):
+        gpg_invocations.increment()
+        with open(signature_path, 'rb') as sig_fp:
+            verified = self._ctx.verify_file(sig_fp, data_path)
+        return verified.fingerprint in allowed
+
+    def verify_all(self, pairs, max_workers=None):
+        """Verify a batch of GPG signatures.
+
+        This is like calling `.verify()` on each pair, except that up to
+        `max_workers` gpg processes run at the same time.
+
+        :param pairs: The signatures to verify.
+        :type pairs: Sequence of 2-tuples of the signature path and the data
+            file path, in the order of `.verify()`'s arguments.
+        :param max_workers: The maximum number of gpg processes to run at
+            once.  Defaults to MAX_VERIFY_WORKERS.
+        :type max_workers: int
+        :return: The result of verifying each pair, in the order of `pairs`.
+        :rtype: list of bool
+        """
+        pairs = list(pairs)
+        if config.skip_gpg_verification:
+            return [True] * len(pairs)
+        # Calculate the fingerprints once, up front, rather than racing to
+        # calculate them in every worker.
+        allowed = self._allowed()
+        if max_workers is None:
+            max_workers = MAX_VERIFY_WORKERS
+        max_workers = min(max_workers, len(pairs))
+        if max_workers <= 1:
+            return [self._verify(signature_path, data_path, allowed)
+                    for signature_path, data_path in pairs]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(
+                lambda pair: self._verify(*pair, allowed=allowed), pairs))
 
     def validate(self, signature_path, data_path):
         """Like .verify() but raises a SignatureError when invalid.
@@ -219,3 +409,28 @@ class Context:
         if not self.verify(signature_path, data_path):
             raise SignatureError(signature_path, data_path,
                                  self.keyring_paths, self.blacklist_path)
+
+    def validate_all(self, pairs, max_workers=None):
+        """Like .verify_all() but raises a SignatureError when any is invalid.
+
+        All of the signatures are verified, and only then is the exception
+        raised, for the first invalid pair.
+
+        :param pairs: The signatures to verify.
+        :type pairs: Sequence of 2-tuples of the signature path and the data
+            file path, in the order of `.validate()`'s arguments.
+        :param max_workers: The maximum number of gpg processes to run at
+            once.  Defaults to MAX_VERIFY_WORKERS.
+        :type max_workers: int
+        :return: The result of verifying each pair, which are all True.
+        :rtype: list of bool
+        :raises SignatureError: when any signature cannot be verified.  The
+            exception describes the first pair which failed.
+        """
+        pairs = list(pairs)
+        results = self.verify_all(pairs, max_workers)
+        for (signature_path, data_path), verified in zip(pairs, results):
+            if not verified:
+                raise SignatureError(signature_path, data_path,
+                                     self.keyring_paths, self.blacklist_path)
+        return results
@@ -0,0 +1,172 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The upgrade graph of an index."""
+
+__all__ = [
+    'UpgradeGraph',
+    ]
+
+
+from collections import deque
+
+
+NO_SUCCESSORS = ()
+
+
+class _Chaser:
+    def __init__(self):
+        # Paths are represented by lists, so we need to listify each element
+        # of the initial set of roots.
+        self._paths = deque()
+
+    def __iter__(self):
+        while self._paths:
+            yield self._paths.pop()
+
+    def push(self, new_path):
+        # new_path must be a list.
+        self._paths.appendleft(new_path)
+
+
+class UpgradeGraph:
+    """An adjacency index over the images of an `Index`.
+
+    Images are the edges of the graph and build numbers are its vertices.  A
+    full image is an edge from any build at or above its minimum version to
+    its own version, while a delta image is an edge from its base to its
+    version.  The deltas are indexed by their base once, so that following
+    an upgrade path is a dictionary lookup per step instead of a scan over
+    every delta in the index.
+    """
+
+    def __init__(self, images, pruned=None):
+        """
+        :param images: The images of the index.
+        :param pruned: For an index which was pruned for some build while it
+            was parsed, the `Pruned` record of that.  The graph then only
+            answers for that build, but its answers are in exactly the same
+            order as the graph of the whole index would give them.
+        """
+        # Split the images into fulls and deltas.  The order in which the
+        # deltas are added to the set, and thus the order in which the set
+        # iterates, is the same order that a scan over the index's deltas
+        # would see, so the adjacency lists built from it preserve the order
+        # in which forks in the road are discovered.
+        self.fulls = []
+        self.deltas = set()
+        for image in images:
+            if image.type == 'full':
+                self.fulls.append(image)
+            elif image.type == 'delta':
+                self.deltas.add(image)
+            else: # pragma: no cover
+                # BAW 2013-04-30: log and ignore.
+                raise AssertionError(
+                    'unknown image type: {}'.format(image.type))
+        self._pruned = pruned
+        ordered = self.deltas
+        if pruned is not None:
+            # A set's iteration order depends on everything which was ever
+            # added to it, so replay the hashes of the whole index's deltas
+            # into a set.  An image's hash is its identity, so this set
+            # iterates in the same order as the whole index's set of images
+            # would.
+            by_hash = {}
+            for image in self.deltas:
+                by_hash[hash(image)] = image
+            ordered = [by_hash[key] for key in set(pruned.delta_keys)
+                       if key in by_hash]
+        self._by_base = {}
+        for image in ordered:
+            self._by_base.setdefault(image.base, []).append(image)
+
+    def successors(self, version):
+        """Return the deltas which can be applied on top of a build.
+
+        :param version: The build number the device would be at.
+        :type version: int
+        :return: The sequence of delta `Image` objects whose base is the
+            given version.  The caller must not mutate this sequence.
+        """
+        return self._by_base.get(version, NO_SUCCESSORS)
+
+    def roots(self, build):
+        """Return the images which can start an upgrade path.
+
+        :param build: The build version number that the device is currently
+            at.
+        :type build: int
+        :return: The list of full images newer than `build` whose minimum
+            version is satisfied, followed by the deltas whose base is
+            `build`.
+        :raises ValueError: if the graph was pruned for some other build.
+        """
+        # Building the set of eligible fulls, rather than filtering the
+        # list, keeps the order in which the roots are returned identical to
+        # that of the original candidate algorithm.
+        if self._pruned is None:
+            fulls = set()
+            for image in self.fulls:
+                if getattr(image, 'minversion', 0) <= build:
+                    fulls.add(image)
+            roots = [image for image in fulls if image.version > build]
+        else:
+            if build != self._pruned.build:
+                raise ValueError('Index was pruned for build {}, not {}'.format(
+                    self._pruned.build, build))
+            # All the remaining fulls are roots, but see above about order.
+            by_hash = {}
+            for image in self.fulls:
+                by_hash.setdefault(hash(image), image)
+            roots = [by_hash[key] for key in set(self._pruned.full_keys)
+                     if key in by_hash]
+        roots.extend(self.successors(build))
+        return roots
+
+    def candidates(self, build):
+        """Calculate all the candidate upgrade paths.
+
+        See `systemimage.candidates.get_candidates()` for details.
+
+        :param build: The build version number that the device is currently
+            at.
+        :type build: int
+        :return: list-of-lists of upgrade paths.
+        """
+        chaser = _Chaser()
+        for image in self.roots(build):
+            chaser.push([image])
+        # Chase the back pointers from the deltas until we run out of newer
+        # versions.  It's possible to push new paths into the chaser if we
+        # find a fork in the road (i.e. two deltas with the same base).
+        paths = []
+        for path in chaser:
+            current = path[-1]
+            while True:
+                next_steps = self.successors(current.version)
+                # If there is no next step, then we're done with this path.
+                if len(next_steps) == 0:
+                    paths.append(path)
+                    break
+                # Otherwise, take the last fork now and push the other paths
+                # onto the chaser.
+                *forks, current = next_steps
+                for fork in forks:
+                    new_path = path.copy()
+                    new_path.append(fork)
+                    chaser.push(new_path)
+                path.append(current)
+        return paths
@@ -18,9 +18,11 @@
 __all__ = [
     'DEFAULT_DIRMODE',
     'MiB',
+    'as_bool',
     'as_loglevel',
     'as_object',
     'as_port',
+    'as_size',
     'as_stripped',
     'as_timedelta',
     'atomic',
@@ -204,6 +206,20 @@ def as_loglevel(value):
     return main_level, dbus_level
 
 
+def as_bool(value):
+    """Convert a value string to a boolean.
+
+    The value is one of the case-insensitive strings ``yes``, ``true``,
+    ``on``, or ``1``, or ``no``, ``false``, ``off``, or ``0``.
+    """
+    value = value.strip().lower()
+    if value in ('yes', 'true', 'on', '1'):
+        return True
+    if value in ('no', 'false', 'off', '0'):
+        return False
+    raise ValueError(value)
+
+
 def as_port(value):
     if value.lower() in ('disabled', 'disable'):
         return NO_PORT
@@ -213,6 +229,19 @@ def as_port(value):
     return result
 
 
+def as_size(value):
+    """Convert a value string to the equivalent number of bytes.
+
+    The value is an integer optionally followed by a case-insensitive ``K``,
+    ``M``, or ``G`` marker for kibibytes, mebibytes, and gibibytes.
+    """
+    mo = re.fullmatch(r'(\d+)([kmg]?)', value.strip().lower())
+    if mo is None:
+        raise ValueError(value)
+    number, unit = mo.groups()
+    return int(number) << {'': 0, 'k': 10, 'm': 20, 'g': 30}[unit]
+
+
 def as_stripped(value):
     return value.strip()
 
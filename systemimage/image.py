@@ -13,27 +13,145 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Images are like Bags but are hashable and sortable."""
+"""Images are like Bags but are hashable and sortable.
+
+Unlike Bags, images and their file records store their attributes in slots
+and are immutable, since a large index can contain many thousands of them.
+"""
 
 
 __all__ = [
+    'FileRecord',
     'Image',
+    'hash_key',
     ]
 
 
-from systemimage.bag import Bag
+import keyword
+
 
 COMMASPACE = ', '
 
 
-class Image(Bag):
+def hash_key(version, base=0):
+    """Return the hash of the image with this version and base.
+
+    This is the same as `Image.__hash__()` would return, but without having
+    to create the image, or checking that the numbers fit.  Use a base of 0
+    for full images.
+    """
+    return (version << 16) + base
+
+
+def _normalize_key(key):
+    # The same key munging that Bags do.
+    key = key.replace('-', '_')
+    if keyword.iskeyword(key):
+        key += '_'
+    return key
+
+
+class _Record:
+    # Attributes named in a subclass's __slots__ are stored compactly.  Any
+    # other keys are stored in the _extra dictionary, which for the index
+    # records we know about is almost always None.
+    __slots__ = ('_extra',)
+
+    # Subclasses can provide default values and converters for their slots.
+    _defaults = {}
+    _converters = {}
+
     def __init__(self, **kws):
-        converters = {'phased-percentage': int}
-        super().__init__(converters=converters, **kws)
+        fields = self._fields()
+        extra = None
+        for name, value in self._defaults.items():
+            object.__setattr__(self, name, value)
+        for key, value in kws.items():
+            name = _normalize_key(key)
+            converter = self._converters.get(name)
+            if converter is not None:
+                value = converter(value)
+            if name in fields:
+                object.__setattr__(self, name, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[name] = value
+        object.__setattr__(self, '_extra', extra)
+
+    @classmethod
+    def _fields(cls):
+        return cls.__slots__
+
+    def __getattr__(self, name):
+        # This is only called when the attribute is not a set slot.
+        extra = object.__getattribute__(self, '_extra')
+        if extra is not None and name in extra:
+            return extra[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Attributes are immutable: {}'.format(name))
+
+    def __delattr__(self, name):
+        raise AttributeError('Attributes are immutable: {}'.format(name))
+
+    def _items(self):
+        for name in self._fields():
+            try:
+                yield name, object.__getattribute__(self, name)
+            except AttributeError:
+                # The slot was never set.
+                pass
+        if self._extra is not None:
+            yield from self._extra.items()
+
+    def __repr__(self): # pragma: no cover
+        return '<{}: {}>'.format(
+            self.__class__.__name__,
+            COMMASPACE.join(sorted(name for name, value in self._items())))
+
+    # Pickle protocol.
+
+    def __getstate__(self):
+        return dict(self._items())
+
+    def __setstate__(self, state):
+        fields = self._fields()
+        extra = None
+        for name, value in state.items():
+            if name in fields:
+                object.__setattr__(self, name, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[name] = value
+        object.__setattr__(self, '_extra', extra)
+
+
+class FileRecord(_Record):
+    """A file record of an image in the index."""
+
+    __slots__ = ('checksum', 'order', 'path', 'signature', 'size')
+
+
+class Image(_Record):
+    """An image in the index."""
+
+    __slots__ = ('type', 'version', 'base', 'minversion', 'bootme', 'files',
+                 'descriptions', 'phased_percentage', 'version_detail')
+
+    _defaults = {
+        'phased_percentage': 100,
+        'version_detail': '',
+        }
+    _converters = {
+        'phased_percentage': int,
+        }
 
     def __hash__(self):
-        # BAW 2013-04-30: We don't currently enforce immutability of attribute
-        # values.  See Bag.__init__().
+        # Attributes cannot be rebound after construction, so the hash is
+        # stable for the lifetime of the image.
         #
         # Full images must be unique on the version, but delta images are
         # unique on the version and base.  We need to turn these two values
@@ -59,22 +177,10 @@ class Image(Bag):
         # supported.  Still, even if we release 10 images every day, that
         # gives us nearly 17 years of running room.  I sure hope we'll have 64
         # bit phones by then.
-        return (self.version << 16) + base
+        return hash_key(self.version, base)
 
     def __eq__(self, other):
         return hash(self) == hash(other)
 
     def __ne__(self, other):
         return not self.__eq__(other)
-
-    def __repr__(self): # pragma: no cover
-        return '<Image: {}>'.format(COMMASPACE.join(sorted(
-            key for key in self.__dict__ if not key.startswith('_'))))
-
-    @property
-    def phased_percentage(self):
-        return self.__untranslated__.get('phased-percentage', 100)
-
-    @property
-    def version_detail(self):
-        return self.__untranslated__.get('version_detail', '')
@@ -20,53 +20,247 @@ __all__ = [
     ]
 
 
+import re
 import json
 
+from array import array
+from collections import namedtuple
 from datetime import datetime, timezone
 from systemimage.bag import Bag
-from systemimage.image import Image
+from systemimage.graph import UpgradeGraph
+from systemimage.image import FileRecord, Image, hash_key
 
 
 IN_FMT = '%a %b %d %H:%M:%S %Z %Y'
 OUT_FMT = '%a %b %d %H:%M:%S UTC %Y'
 
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+# The record of how an index was pruned while it was parsed: the build it was
+# pruned for, and the hashes of all the index's full images whose minimum
+# version that build satisfies, and of all its delta images, in index order.
+Pruned = namedtuple('Pruned', 'build full_keys delta_keys')
+
 
 class Index(Bag):
+    @property
+    def graph(self):
+        """The `UpgradeGraph` of this index's images.
+
+        The graph is built the first time it is needed and then cached for
+        the lifetime of the index.  If the index was pruned for a build, the
+        graph only answers for that build, and raises ValueError for any
+        other.
+        """
+        graph = self.__dict__.get('_graph')
+        if graph is None:
+            graph = self._graph = UpgradeGraph(
+                self.images, self.__dict__.get('pruned'))
+        return graph
+
     @classmethod
-    def from_json(cls, data):
-        """Parse the JSON data and produce an index."""
+    def from_json(cls, data, build=None):
+        """Parse the JSON data and produce an index.
+
+        The images are decoded one at a time, so the whole document is never
+        held as Python objects.  If a build number is given, images which
+        can never be part of an upgrade path from that build are dropped as
+        soon as they are decoded.  Those are the full images at or below the
+        build or whose minimum version is above it, and the deltas whose base
+        is below it, since deltas always lead to a newer version.  The
+        index's upgrade graph then only answers for that build, but it gives
+        exactly the same answers, in the same order, as the graph of the
+        whole index would.  Asking it, e.g. through `get_candidates()`, about
+        any other build raises ValueError, so callers which look at more
+        than one build, such as the fleet simulator, must not give one.
+
+        :param data: The JSON data.
+        :param build: The build number the device is at, or None to keep
+            every image.
+        :return: The index.
+        :raises ValueError: if the data isn't a valid index.
+        """
+        pruner = _Pruner(build)
+        images = []
+        def add_image(image_data):
+            if pruner.keep(image_data):
+                images.append(_parse_image(image_data))
+        mapping = _decode(data, add_image)
+        generated_at = _parse_timestamp(mapping['global']['generated_at'])
+        global_ = Bag(generated_at=generated_at)
+        if build is None:
+            return cls(global_=global_, images=images)
+        return cls(global_=global_, images=images, pruned=pruner.pruned())
+
+    def merge_json(self, data):
+        """Apply a delta index to this index, producing a new index.
+
+        A delta index describes how the index changed since it was generated
+        at some earlier time.  It looks like an index, except that its
+        `global` section also has a `since` timestamp, which must be this
+        index's `generated_at` timestamp.  Its images are added to this
+        index's images, replacing any with the same type, version, and base.
+        It may also have a `removed` list of mappings giving the type,
+        version, and base of images which are no longer in the index.
+
+        :param data: The JSON data of the delta index.
+        :return: The new index.
+        :raises ValueError: if the delta index is for some other index.
+        """
         mapping = json.loads(data)
-        # Parse the global data, of which there is only the timestamp.  Even
-        # though the string will contain 'UTC' (which we assert is so since we
-        # can only handle UTC timestamps), strptime() will return a naive
-        # datetime.  We'll turn it into an aware datetime in UTC, which is the
-        # only thing that can possibly make sense.
-        timestamp_str = mapping['global']['generated_at']
-        assert 'UTC' in timestamp_str.split(), 'timestamps must be UTC'
-        naive_generated_at = datetime.strptime(timestamp_str, IN_FMT)
-        generated_at=naive_generated_at.replace(tzinfo=timezone.utc)
+        since = _parse_timestamp(mapping['global']['since'])
+        if since != self.global_.generated_at:
+            raise ValueError('Delta index is since {}, not {}'.format(
+                since.strftime(OUT_FMT),
+                self.global_.generated_at.strftime(OUT_FMT)))
+        generated_at = _parse_timestamp(mapping['global']['generated_at'])
         global_ = Bag(generated_at=generated_at)
-        # Parse the images.
-        images = []
-        for image_data in mapping['images']:
-            # Descriptions can be any of:
-            #
-            # * description
-            # * description-xx (e.g. description-en)
-            # * description-xx_CC (e.g. description-en_US)
-            #
-            # We want to preserve the keys exactly as given, and because the
-            # extended forms are not Python identifiers, we'll pull these out
-            # into a separate, non-Bag dictionary.
-            descriptions = {}
-            # We're going to mutate the dictionary during iteration.
-            for key in list(image_data):
-                if key.startswith('description'):
-                    descriptions[key] = image_data.pop(key)
-            files = image_data.pop('files', [])
-            bundles = [Bag(**bundle_data) for bundle_data in files]
-            image = Image(files=bundles,
-                          descriptions=descriptions,
-                          **image_data)
-            images.append(image)
-        return cls(global_=global_, images=images)
+        replaced = set(
+            _image_key(image_data['type'], image_data['version'],
+                       image_data.get('base'))
+            for image_data in mapping.get('removed', []) + mapping['images'])
+        images = [image for image in self.images
+                  if _image_key(image.type, image.version,
+                                getattr(image, 'base', None))
+                  not in replaced]
+        pruned = self.__dict__.get('pruned')
+        if pruned is None:
+            images.extend(_parse_image(image_data)
+                          for image_data in mapping['images'])
+            return self.__class__(global_=global_, images=images)
+        # A pruned index stays pruned for the same build, and the hashes of
+        # the images it no longer has must be kept up to date too.
+        pruner = _Pruner(
+            pruned.build,
+            (key for key in pruned.full_keys
+             if _image_key('full', key >> 16, None) not in replaced),
+            (key for key in pruned.delta_keys
+             if _image_key('delta', key >> 16, key & 0xffff)
+             not in replaced))
+        images.extend(_parse_image(image_data)
+                      for image_data in mapping['images']
+                      if pruner.keep(image_data))
+        return self.__class__(
+            global_=global_, images=images, pruned=pruner.pruned())
+
+
+class _Pruner:
+    # Decide which images to keep while an index is parsed, recording the
+    # hashes which the upgrade graph needs to reproduce the order of the
+    # whole index's graph.  See Index.from_json().
+    def __init__(self, build, full_keys=(), delta_keys=()):
+        self.build = build
+        self.full_keys = array('q', full_keys)
+        self.delta_keys = array('q', delta_keys)
+
+    def keep(self, image_data):
+        if self.build is None:
+            return True
+        type_ = image_data.get('type')
+        if type_ == 'full':
+            if image_data.get('minversion', 0) > self.build:
+                return False
+            self.full_keys.append(hash_key(image_data['version']))
+            return image_data['version'] > self.build
+        elif type_ == 'delta':
+            self.delta_keys.append(
+                hash_key(image_data['version'], image_data['base']))
+            return image_data['base'] >= self.build
+        # Let the upgrade graph complain about it.
+        return True
+
+    def pruned(self):
+        return Pruned(self.build, self.full_keys, self.delta_keys)
+
+
+def _skip(data, index):
+    return _whitespace.match(data, index).end()
+
+
+def _decode(data, add_image):
+    # Decode the JSON object in data, passing each element of its `images`
+    # array to add_image() as soon as it's decoded instead of collecting
+    # them.  Everything else is decoded as usual and returned in a
+    # dictionary.
+    decode = _decoder.raw_decode
+    def expect(index, chars):
+        char = data[index:index + 1]
+        if char == '' or char not in chars:
+            # json.JSONDecodeError is new in Python 3.5, and is a ValueError.
+            raise ValueError('Expecting one of {!r}: char {}'.format(
+                chars, index))
+        return char
+    mapping = {}
+    index = _skip(data, 0)
+    expect(index, '{')
+    index = _skip(data, index + 1)
+    if data[index:index + 1] == '}':
+        index += 1
+    else:
+        while True:
+            expect(index, '"')
+            key, index = decode(data, index)
+            index = _skip(data, index)
+            expect(index, ':')
+            index = _skip(data, index + 1)
+            if key == 'images' and data[index:index + 1] == '[':
+                index = _skip(data, index + 1)
+                if data[index:index + 1] == ']':
+                    index += 1
+                else:
+                    while True:
+                        image_data, index = decode(data, index)
+                        add_image(image_data)
+                        index = _skip(data, index)
+                        if expect(index, ',]') == ']':
+                            index += 1
+                            break
+                        index = _skip(data, index + 1)
+            else:
+                mapping[key], index = decode(data, index)
+            index = _skip(data, index)
+            if expect(index, ',}') == '}':
+                index += 1
+                break
+            index = _skip(data, index + 1)
+    if _skip(data, index) != len(data):
+        raise ValueError('Extra data: char {}'.format(index))
+    return mapping
+
+
+def _parse_timestamp(timestamp_str):
+    # Even though the string will contain 'UTC' (which we assert is so since
+    # we can only handle UTC timestamps), strptime() will return a naive
+    # datetime.  We'll turn it into an aware datetime in UTC, which is the
+    # only thing that can possibly make sense.
+    assert 'UTC' in timestamp_str.split(), 'timestamps must be UTC'
+    naive_generated_at = datetime.strptime(timestamp_str, IN_FMT)
+    return naive_generated_at.replace(tzinfo=timezone.utc)
+
+
+def _parse_image(image_data):
+    # Descriptions can be any of:
+    #
+    # * description
+    # * description-xx (e.g. description-en)
+    # * description-xx_CC (e.g. description-en_US)
+    #
+    # We want to preserve the keys exactly as given, and because the extended
+    # forms are not Python identifiers, we'll pull these out into a separate,
+    # non-Bag dictionary.
+    descriptions = {}
+    # We're going to mutate the dictionary during iteration.
+    for key in list(image_data):
+        if key.startswith('description'):
+            descriptions[key] = image_data.pop(key)
+    files = image_data.pop('files', [])
+    bundles = tuple(FileRecord(**bundle_data) for bundle_data in files)
+    return Image(files=bundles, descriptions=descriptions, **image_data)
+
+
+def _image_key(type_, version, base):
+    # Full images are unique on the version, but delta images are unique on
+    # the version and base.
+    return version, (base if type_ == 'delta' else None)
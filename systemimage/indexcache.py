@@ -0,0 +1,174 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A persistent cache of verified, parsed indexes."""
+
+__all__ = [
+    'IndexCache',
+    ]
+
+
+import os
+import pickle
+import shutil
+import logging
+
+from hashlib import sha256
+from systemimage.diskcache import DiskCache
+from systemimage.gpg import fingerprint
+from systemimage.helpers import (
+    atomic, calculate_signature, makedirs, safe_remove)
+
+
+log = logging.getLogger('systemimage')
+
+CACHE_DIRECTORY = 'index-cache'
+MAX_ENTRIES = 4
+SUFFIX = '.pickle'
+LATEST_SUFFIX = '.latest'
+
+
+def _file_checksum(path):
+    with open(path, 'rb') as fp:
+        return calculate_signature(fp)
+
+
+class IndexCache(DiskCache):
+    """A cache of parsed indexes whose signatures have been verified.
+
+    Entries are keyed by the checksums of the index.json file's bytes and of
+    its detached signature, so an entry can only be found for exactly the
+    bytes that were verified.  Entries live in a subdirectory named after the
+    fingerprint of the keyrings and blacklist which were used to verify them.
+    Whenever any of those files changes, the fingerprint changes and all the
+    entries verified under the old fingerprint are thrown away.  Within a
+    fingerprint, only the most recently used entries are kept.
+
+    Separately, the latest index for each index url is kept, as the base to
+    which delta indexes are applied.  These aren't subject to eviction.
+    """
+
+    suffixes = (SUFFIX,)
+    name = CACHE_DIRECTORY
+    kind = 'index'
+
+    def __init__(self, directory=None, max_entries=MAX_ENTRIES):
+        super().__init__(directory, max_entries=max_entries)
+
+    @staticmethod
+    def key(index_path, asc_path, build=None):
+        """Return the cache key for an index file and its signature.
+
+        :param index_path: The path to the downloaded index.json file.
+        :param asc_path: The path to the index.json file's signature.
+        :param build: The build number the index was pruned for, if any.
+        :return: The hex digest key.
+        :rtype: str
+        """
+        checksum = sha256()
+        for path in (index_path, asc_path):
+            checksum.update(_file_checksum(path).encode('ascii'))
+        if build is not None:
+            checksum.update(':{}'.format(build).encode('ascii'))
+        return checksum.hexdigest()
+
+    # The fingerprint of the keyrings and blacklist used for verification.
+    fingerprint = staticmethod(fingerprint)
+
+    def _invalidate(self, fingerprint):
+        # Throw away every entry verified with other keyrings.
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name != fingerprint:
+                log.info('Invalidating cached indexes: {}', name)
+                shutil.rmtree(os.path.join(self.directory, name),
+                              ignore_errors=True)
+
+    def _load(self, path):
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)
+
+    def _store(self, path, index):
+        makedirs(os.path.dirname(path))
+        with atomic(path, encoding=None) as fp:
+            pickle.dump(index, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get(self, key, fingerprint):
+        """Return the cached index, or None if it isn't cached.
+
+        :param key: The key as returned by `key()`.
+        :param fingerprint: The fingerprint as returned by `fingerprint()`.
+        :return: The cached `Index` or None.
+        """
+        self._invalidate(fingerprint)
+        directory = os.path.join(self.directory, fingerprint)
+        try:
+            index = self._load(self.paths(key, directory)[-1])
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # The entry is unusable, so just discard it.
+            self.discard_unreadable(key, directory)
+            return None
+        self.touch(key, directory)
+        log.info('Using cached index: {}', key)
+        return index
+
+    def put(self, key, fingerprint, index):
+        """Cache an index which has been verified.
+
+        :param key: The key as returned by `key()`.
+        :param fingerprint: The fingerprint as returned by `fingerprint()`.
+        :param index: The `Index` to cache.
+        """
+        self._invalidate(fingerprint)
+        directory = os.path.join(self.directory, fingerprint)
+        self._store(self.paths(key, directory)[-1], index)
+        self.evict(directory)
+
+    def _latest_path(self, url, fingerprint):
+        name = sha256(url.encode('utf-8')).hexdigest() + LATEST_SUFFIX
+        return os.path.join(self.directory, fingerprint, name)
+
+    def get_latest(self, url, fingerprint):
+        """Return the latest index from the url, or None if there isn't one.
+
+        :param url: The url of the index.json file.
+        :param fingerprint: The fingerprint as returned by `fingerprint()`.
+        :return: The latest `Index` or None.
+        """
+        self._invalidate(fingerprint)
+        path = self._latest_path(url, fingerprint)
+        try:
+            return self._load(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            log.exception('Discarding unreadable latest index: {}', url)
+            safe_remove(path)
+            return None
+
+    def put_latest(self, url, fingerprint, index):
+        """Record the latest verified index from the url.
+
+        :param url: The url of the index.json file.
+        :param fingerprint: The fingerprint as returned by `fingerprint()`.
+        :param index: The `Index`, which may have had delta indexes applied.
+        """
+        self._invalidate(fingerprint)
+        self._store(self._latest_path(url, fingerprint), index)
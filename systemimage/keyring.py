@@ -23,16 +23,16 @@ __all__ = [
 
 
 import os
-import json
 import shutil
-import tarfile
 
 from contextlib import ExitStack
 from datetime import datetime, timezone
 from systemimage.config import config
-from systemimage.download import get_download_manager
-from systemimage.gpg import Context
+from systemimage.download import (
+    Record, get_cached_path, get_download_manager)
+from systemimage.gpg import Context, fingerprint
 from systemimage.helpers import makedirs, safe_remove
+from systemimage.keyringcache import KeyringCache
 from urllib.parse import urljoin
 
 
@@ -43,7 +43,8 @@ class KeyringError(Exception):
         self.message = message
 
 
-def get_keyring(keyring_type, urls, sigkr, blacklist=None):
+def get_keyring(keyring_type, urls, sigkr, blacklist=None, *,
+                downloader=None):
     """Download, verify, and unpack a keyring.
 
     The keyring .tar.xz file and its signature file are downloaded.  The
@@ -76,6 +77,8 @@ def get_keyring(keyring_type, urls, sigkr, blacklist=None):
     :param sigkr: The local keyring file that should be used to verify the
         downloaded signature.
     :param blacklist: When given, this is the signature blacklist file.
+    :param downloader: The download manager to use, e.g. because it has
+        prefetched the keyring.  When not given, a new one is used.
     :raises SignatureError: when the keyring signature does not match.
     :raises KeyringError: when any of the other verifying attributes of the
         downloaded keyring fails.
@@ -100,40 +103,40 @@ def get_keyring(keyring_type, urls, sigkr, blacklist=None):
     # will raise an exception if it finds a file already there.
     safe_remove(tarxz_dst)
     safe_remove(ascxz_dst)
+    downloads = [
+        Record(tarxz_src, tarxz_dst, cached=get_cached_path(tarxz_src)),
+        Record(ascxz_src, ascxz_dst, cached=get_cached_path(ascxz_src)),
+        ]
+    if downloader is None:
+        downloader = get_download_manager()
     with ExitStack() as stack:
         # Let FileNotFoundError percolate up.
-        get_download_manager().get_files([
-            (tarxz_src, tarxz_dst),
-            (ascxz_src, ascxz_dst),
-            ])
+        downloader.get_files(downloads)
         stack.callback(os.remove, tarxz_dst)
         stack.callback(os.remove, ascxz_dst)
         signing_keyring = getattr(config.gpg, sigkr.replace('-', '_'))
-        with Context(signing_keyring, blacklist=blacklist) as ctx:
-            ctx.validate(ascxz_dst, tarxz_dst)
-        # The signature is good, so now unpack the tarball, load the json file
-        # and verify its contents.
-        keyring_gpg = os.path.join(config.tempdir, 'keyring.gpg')
-        keyring_json = os.path.join(config.tempdir, 'keyring.json')
-        with tarfile.open(tarxz_dst, 'r:xz') as tf:
-            tf.extractall(config.tempdir)
-        stack.callback(os.remove, keyring_gpg)
-        stack.callback(os.remove, keyring_json)
-        with open(keyring_json, 'r', encoding='utf-8') as fp:
-            data = json.load(fp)
+        # There's no need to verify the signature again if the server says
+        # the files haven't changed since they were verified with the same
+        # keys.  The contents still have to be checked since, e.g. the
+        # keyring may have expired in the meantime.
+        keys = fingerprint([signing_keyring], blacklist)
+        if not downloader.is_verified(downloads, keys):
+            with Context(signing_keyring, blacklist=blacklist) as ctx:
+                ctx.validate(ascxz_dst, tarxz_dst)
+        # The signature is good, so now unpack the tarball, or rather, get
+        # it from the keyring cache, and verify the contents of its json file.
+        info = KeyringCache().get(tarxz_dst)
         # Check the mandatory keys first.
-        json_type = data['type']
-        if keyring_type != json_type:
+        if keyring_type != info.type:
             raise KeyringError(
                 'keyring type mismatch; wanted: {}, got: {}'.format(
-                    keyring_type, json_type))
+                    keyring_type, info.type))
         # Check the optional keys next.
-        json_model = data.get('model')
-        if json_model not in (config.device, None):
+        if info.model not in (config.device, None):
             raise KeyringError(
                 'keyring model mismatch; wanted: {}, got: {}'.format(
-                    config.device, json_model))
-        expiry = data.get('expiry')
+                    config.device, info.model))
+        expiry = info.expiry
         if expiry is not None:
             # Get our current timestamp in UTC.
             timestamp = datetime.now(tz=timezone.utc).timestamp()
@@ -165,4 +168,5 @@ def get_keyring(keyring_type, urls, sigkr, blacklist=None):
         # will always fallback to this path to avoid unpacking the .tar.xz
         # file every single time.
         gpg_path = os.path.join(config.tempdir, keyring_type + '.gpg')
-        shutil.copy(keyring_gpg, gpg_path)
+        shutil.copy(info.gpg_path, gpg_path)
+        downloader.cache_verified(downloads, keys)
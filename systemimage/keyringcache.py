@@ -0,0 +1,108 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A persistent cache of unpacked keyrings."""
+
+__all__ = [
+    'KeyringCache',
+    'KeyringInfo',
+    ]
+
+
+import os
+import json
+import logging
+import tarfile
+
+from collections import namedtuple
+from systemimage.diskcache import DiskCache
+from systemimage.helpers import atomic, calculate_signature, makedirs
+
+
+log = logging.getLogger('systemimage')
+
+CACHE_DIRECTORY = 'keyring-cache'
+MAX_ENTRIES = 16
+
+
+KeyringInfo = namedtuple('KeyringInfo', 'gpg_path type model expiry')
+
+
+class KeyringCache(DiskCache):
+    """The unpacked contents of keyring .tar.xz files.
+
+    Entries are keyed by the checksum of the .tar.xz file, so an entry can
+    only be found for exactly the bytes which were unpacked.  Each entry is
+    the keyring.gpg file from the tarball, along with the type, model, and
+    expiry from its keyring.json file.  Once a keyring has been unpacked,
+    neither its .gpg file nor its metadata need decompressing it again.  Only
+    the most recently used entries are kept.
+
+    Note that this does *not* validate the .tar.xz files.  That must be done
+    elsewhere.
+    """
+
+    suffixes = ('.gpg', '.json')
+    name = CACHE_DIRECTORY
+    kind = 'keyring'
+
+    def __init__(self, directory=None, max_entries=MAX_ENTRIES):
+        super().__init__(directory, max_entries=max_entries)
+
+    def get(self, path):
+        """Return the unpacked keyring, unpacking it if it isn't cached.
+
+        :param path: The path to the keyring .tar.xz file.
+        :return: The path to the keyring's .gpg file and its metadata.
+        :rtype: KeyringInfo
+        """
+        with open(path, 'rb') as fp:
+            key = calculate_signature(fp)
+        gpg_path, json_path = self.paths(key)
+        try:
+            with open(json_path, 'r', encoding='utf-8') as fp:
+                metadata = json.load(fp)
+        except FileNotFoundError:
+            metadata = None
+        except ValueError:
+            self.discard_unreadable(key)
+            metadata = None
+        if metadata is None or not os.path.exists(gpg_path):
+            metadata = self._unpack(path, gpg_path, json_path)
+            self.evict()
+        else:
+            self.touch(key)
+        return KeyringInfo(gpg_path, metadata.get('type'),
+                           metadata.get('model'), metadata.get('expiry'))
+
+    def _unpack(self, path, gpg_path, json_path):
+        log.info('Unpacking keyring: {}', path)
+        with tarfile.open(path, 'r:xz') as tf:
+            keyring_gpg = tf.extractfile('keyring.gpg').read()
+            try:
+                member = tf.extractfile('keyring.json')
+            except KeyError:
+                data = {}
+            else:
+                data = json.loads(member.read().decode('utf-8'))
+        metadata = dict(type=data.get('type'),
+                        model=data.get('model'),
+                        expiry=data.get('expiry'))
+        makedirs(self.directory)
+        with atomic(gpg_path, encoding=None) as fp:
+            fp.write(keyring_gpg)
+        with atomic(json_path) as fp:
+            json.dump(metadata, fp)
+        return metadata
@@ -21,26 +21,26 @@ __all__ = [
     ]
 
 
+# Startup time matters for the quick commands, e.g. --info and the settings
+# commands, so only what every command needs is imported here.  D-Bus, gpg,
+# the state machine, and the download managers are imported by the commands
+# which use them.
 import sys
 import json
 import logging
 import argparse
 
-from dbus.mainloop.glib import DBusGMainLoop
-from pkg_resources import resource_string as resource_bytes
-from systemimage.apply import factory_reset, production_reset
+from pkgutil import get_data
 from systemimage.candidates import delta_filter, full_filter, version_filter
 from systemimage.config import config
 from systemimage.helpers import (
     last_update_date, makedirs, phased_percentage, version_detail)
 from systemimage.logging import initialize
-from systemimage.settings import Settings
-from systemimage.state import State
 from textwrap import dedent
 
 
-__version__ = resource_bytes(
-    'systemimage', 'version.txt').decode('utf-8').strip()
+# pkg_resources is much slower to import.
+__version__ = get_data('systemimage', 'version.txt').decode('utf-8').strip()
 
 DEFAULT_CONFIG_D = '/etc/system-image/config.d'
 COLON = ':'
@@ -82,6 +82,14 @@ def _json_progress(received, total):
     sys.stdout.flush()
 
 
+def _print_timings(state):
+    # For use with --timings.
+    message = json.dumps(dict(type='timings', **state.timings.summary()))
+    sys.stdout.write(message)
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog='system-image-cli',
@@ -164,6 +172,11 @@ def main():
                         default=None, action='store', metavar='CHANNEL',
                         help="""Switch to the given channel.  This is
                                 equivalent to `-c CHANNEL -b 0`.""")
+    parser.add_argument('--timings',
+                        default=False, action='store_true',
+                        help="""Print the time taken, bytes downloaded, and
+                                number of gpg invocations of each step of the
+                                update as a JSON record, when done.""")
     # Settings options.
     parser.add_argument('--show-settings',
                         default=False, action='store_true',
@@ -216,11 +229,13 @@ Your upgrades are INSECURE.""", file=sys.stderr)
 
     # Perform factory and production resets.
     if args.factory_reset:
+        from systemimage.apply import factory_reset
         factory_reset()
         # We should never get here, except possibly during the testing
         # process, so just return as normal.
         return 0
     if args.production_reset:
+        from systemimage.apply import production_reset
         production_reset()
         # We should never get here, except possibly during the testing
         # process, so just return as normal.
@@ -232,6 +247,8 @@ Your upgrades are INSECURE.""", file=sys.stderr)
         parser.error('Cannot mix and match settings arguments')
         assert 'parser.error() does not return' # pragma: no cover
 
+    if args.set or args.get or args.delete or args.show_settings:
+        from systemimage.settings import Settings
     if args.show_settings:
         rows = sorted(Settings())
         for row in rows:
@@ -243,10 +260,12 @@ Your upgrades are INSECURE.""", file=sys.stderr)
             print(settings.get(key))
         return 0
     if args.set:
-        settings = Settings()
+        items = []
         for keyval in args.set:
             key, val = keyval.split('=', 1)
-            settings.set(key, val)
+            items.append((key, val))
+        # Set them all in one transaction.
+        Settings().update(items)
         return 0
     if args.delete:
         settings = Settings()
@@ -323,6 +342,8 @@ Your upgrades are INSECURE.""", file=sys.stderr)
             print('version {}: {}'.format(key, details[key]))
         return 0
 
+    from dbus.mainloop.glib import DBusGMainLoop
+    from systemimage.state import State
     DBusGMainLoop(set_as_default=True)
 
     if args.list_channels:
@@ -369,6 +390,9 @@ Your upgrades are INSECURE.""", file=sys.stderr)
                   file=sys.stderr)
             log.exception('system-image-cli exception')
             return 1
+        finally:
+            if args.timings:
+                _print_timings(state)
         # Say -c <no-such-channel> was given.  This will fail.
         if state.winner is None or len(state.winner) == 0:
             print('Already up-to-date')
@@ -418,6 +442,8 @@ Your upgrades are INSECURE.""", file=sys.stderr)
             return 0
         finally:
             log.info('state machine finished')
+            if args.timings:
+                _print_timings(state)
 
 
 if __name__ == '__main__':                          # pragma: no cover
@@ -0,0 +1,161 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A persistent, content-addressed store of update files."""
+
+__all__ = [
+    'PayloadCache',
+    'link_or_copy',
+    ]
+
+
+import os
+import json
+import fcntl
+import shutil
+import logging
+
+from systemimage.config import config
+from systemimage.diskcache import DiskCache
+from systemimage.helpers import atomic, makedirs, safe_remove
+
+
+log = logging.getLogger('systemimage')
+
+CACHE_DIRECTORY = 'payload-cache'
+# From <linux/fs.h>; the fcntl module only has it in newer Pythons.
+FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+
+
+def link_or_copy(src, dst):
+    """Give `dst` the same contents as `src`, as cheaply as possible.
+
+    The file is hard linked if both paths are on the same file system,
+    otherwise it is cloned if the file system supports reflinks, otherwise
+    it is copied.  Any existing `dst` is atomically replaced.  Since a hard
+    link shares its contents with the original, neither file may be modified
+    in place afterward.
+
+    :param src: The path to the existing file.
+    :param dst: The path to the new file.
+    """
+    tmp = dst + '.tmp'
+    safe_remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        with open(src, 'rb') as in_fp, open(tmp, 'wb') as out_fp:
+            try:
+                fcntl.ioctl(out_fp.fileno(), FICLONE, in_fp.fileno())
+            except OSError:
+                shutil.copyfileobj(in_fp, out_fp)
+    os.replace(tmp, dst)
+
+
+class PayloadCache(DiskCache):
+    """Verified update files and their signatures, keyed by checksum.
+
+    The same file may be referenced by different paths, e.g. in different
+    channels, so each entry is keyed by the sha256 checksum of the data file
+    rather than by its name.  An entry is the data file, its signature file,
+    and a .json file recording their size, which is written last since it
+    marks a complete entry.  Files are hard linked in and out of the cache
+    when it is on the same file system as the cache partition, so entries
+    cost no extra space while the same files are also there, and otherwise
+    they are reflinked or copied.  Only the most recently used entries are
+    kept, up to the configured total size.
+
+    Note that this does *not* validate the files.  Entries must only be
+    added once they have been verified, and they must be verified again
+    after they are retrieved.
+    """
+
+    suffixes = ('', '.asc', '.json')
+    name = CACHE_DIRECTORY
+    kind = 'payload'
+
+    def __init__(self, directory=None, max_size=None):
+        if directory is None and config.updater.payload_cache:
+            directory = config.updater.payload_cache
+        super().__init__(
+            directory,
+            max_size=(config.system.payload_cache_size
+                      if max_size is None
+                      else max_size))
+
+    def get(self, checksum, dst, asc):
+        """Retrieve a cached data file and its signature file.
+
+        :param checksum: The sha256 checksum of the data file.
+        :param dst: Where to put the data file.
+        :param asc: Where to put the signature file.
+        :return: True if the files are cached and were put in place,
+            otherwise False, in which case nothing was changed.
+        :rtype: bool
+        """
+        if self.max_size == 0 or not self.is_complete(checksum):
+            return False
+        log.info('Using cached payload {}: {}', checksum, dst)
+        data_path, asc_path, json_path = self.paths(checksum)
+        link_or_copy(data_path, dst)
+        link_or_copy(asc_path, asc)
+        # The other files may be linked to the cache partition, so only the
+        # .json file is touched.
+        self.touch(checksum)
+        return True
+
+    def update(self, entries):
+        """Add verified data files and their signature files.
+
+        Entries which are already cached are only marked as used.  The least
+        recently used entries are then evicted until the cache fits in its
+        maximum size.
+
+        :param entries: An iterable of 3-tuples of the sha256 checksum of a
+            data file, the path to the data file, and the path to its
+            signature file.
+        """
+        if self.max_size == 0:
+            return
+        makedirs(self.directory)
+        for checksum, dst, asc in entries:
+            if self.is_complete(checksum):
+                self.touch(checksum)
+                continue
+            data_path, asc_path, json_path = self.paths(checksum)
+            safe_remove(json_path)
+            link_or_copy(dst, data_path)
+            link_or_copy(asc, asc_path)
+            size = os.path.getsize(data_path) + os.path.getsize(asc_path)
+            with atomic(json_path) as fp:
+                json.dump(dict(size=size), fp)
+        self.evict()
+
+    def entry_size(self, key, directory):
+        json_path = self.paths(key, directory)[-1]
+        with open(json_path, encoding='utf-8') as fp:
+            return json.load(fp)['size']
+
+    def evict(self, directory=None):
+        names = set(os.listdir(self.directory))
+        for name in names:
+            checksum = name.split('.', 1)[0]
+            if (checksum + '.json' not in names or
+                    name not in (checksum, checksum + '.asc',
+                                 checksum + '.json')):
+                # Throw away incomplete entries and temporary files, e.g.
+                # from an interrupted update().
+                safe_remove(os.path.join(self.directory, name))
+        super().evict(directory)
@@ -20,13 +20,16 @@ Choose which upgrade path to use based on the available candidates.
 
 __all__ = [
     'Scorer',
+    'ShortestPathScorer',
     'WeightedScorer',
     ]
 
 
+import heapq
 import logging
 
-from itertools import count
+from array import array
+from systemimage.candidates import get_candidates
 from systemimage.helpers import MiB, phased_percentage
 
 
@@ -55,48 +58,66 @@ class Scorer:
         if len(candidates) == 0:
             log.debug('No candidates, so no winner')
             return []
-        # We want to zip together the score for each candidate path, plus the
-        # candidate path, so that when we sort the sequence, we'll always get
-        # the lowest scoring upgrade path first.  The problem is that when two
-        # paths have the same score, sorted()'s comparison will find the first
-        # element of the tuple is the same and fall back to the second item.
-        # If that item is a list of Image objects, then it will try to compare
-        # Image objects, which are not comparable.
-        #
-        # We solve this by zipping in a second element which is guaranteed to
-        # be a monotomically increasing integer.  Thus if two paths score the
-        # same, we'll just end up picking the first one we saw, and comparison
-        # will never fall back to the list of Images.
-        #
-        # Be sure that after all is said and done we return the list of Images
-        # though!
-        scores = sorted(zip(self.score(candidates), count(), candidates))
+        # Sort the indexes of the candidate paths by their scores, so that
+        # the lowest scoring upgrade path comes first.  Since the sort is
+        # stable, when two paths score the same, we'll just end up picking the
+        # first one we saw.  This never has to compare the paths themselves,
+        # and it's much cheaper than sorting tuples when there are many
+        # candidates.
+        scores = self.score(candidates)
+        order = sorted(range(len(candidates)), key=scores.__getitem__)
         # Calculate the phase percentage for the device.  Use the highest
         # available build number as input into the random seed.
         max_target_number = -1
-        for score, i, path in scores:
+        for path in candidates:
             # The last image will be the target image.
             assert len(path) > 0, 'Empty upgrade candidate path?'
             max_target_number = max(max_target_number, path[-1].version)
         assert max_target_number != -1, 'No max target version?'
         device_percentage = phased_percentage(channel, max_target_number)
-        log.debug('Device phased percentage: {}%'.format(device_percentage))
-        log.debug('{} path scores:'.format(self.__class__.__name__))
-        # Log the candidate paths, their scores, and their phases.
-        for score, i, path in reversed(scores):
-            log.debug('\t[{:4d}] -> {} ({}%)'.format(
-                score,
-                COLON.join(str(image.version) for image in path),
-                (path[-1].phased_percentage if len(path) > 0 else '--')
-                ))
-        for score, i, path in scores:
-            image_percentage = path[-1].phased_percentage
+        # Formatting every candidate path is expensive, so only do it when
+        # it's going to be logged.
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Device phased percentage: {}%'.format(
+                device_percentage))
+            log.debug('{} path scores:'.format(self.__class__.__name__))
+            # Log the candidate paths, their scores, and their phases.
+            for i in reversed(order):
+                path = candidates[i]
+                log.debug('\t[{:4d}] -> {} ({}%)'.format(
+                    scores[i],
+                    COLON.join(str(image.version) for image in path),
+                    (path[-1].phased_percentage if len(path) > 0 else '--')
+                    ))
+        for i in order:
+            image_percentage = candidates[i][-1].phased_percentage
             # An image percentage of 0 means that it's been pulled.
             if image_percentage > 0 and device_percentage <= image_percentage:
-                return path
+                return candidates[i]
         # No upgrade path.
         return []
 
+    def choose_from_index(self, index, build, channel):
+        """Choose the upgrade path directly from an index.
+
+        The default implementation calculates every candidate upgrade path
+        and passes them to `choose()`.  Subclasses may override this to
+        search the index's upgrade graph instead.
+
+        :param index: The index of available upgrades.
+        :type index: An `Index`
+        :param build: The build version number that the device is currently
+            at.
+        :type build: int
+        :param channel: The channel being upgraded to.
+        :type channel: str
+        :return: The chosen path.
+        :rtype: list
+        """
+        candidates = get_candidates(index, build)
+        log.debug('Candidates from build# {}: {}', build, len(candidates))
+        return self.choose(candidates, channel)
+
     def score(self, candidates): # pragma: no cover
         """Like `choose()` except returns the candidate path scores.
 
@@ -139,35 +160,149 @@ class WeightedScorer(Scorer):
     Path B wins.
     """
     def score(self, candidates):
-        # Iterate over every path, calculating the total download size of the
-        # path, the number of extra reboots required, and the destination
-        # build number.  Remember the smallest size seen and highest build
-        # number.
-        max_build = 0
-        min_size = None
-        candidate_data = []
+        if len(candidates) == 0:
+            return []
+        # Collect the destination build number, total download size, and
+        # number of extra reboots of each path into compact arrays.  The
+        # paths share most of their images, so the download size of each
+        # image, and whether it needs a reboot, are calculated only the first
+        # time the image is seen.  The images are keyed on their id() since
+        # that's much cheaper than hashing them, and they all outlive this
+        # call.  A path never contains the same image twice, since every step
+        # upgrades to a newer version.
+        image_sizes = {}
+        reboot_images = set()
+        size_of = image_sizes.__getitem__
+        builds = array('q')
+        sizes = array('q')
+        reboots = array('q')
         for path in candidates:
-            build = path[-1].version
-            size = 0
-            for image in path:
-                image_size = sum(filerec.size for filerec in image.files)
-                size += image_size
-            reboots = sum(1 for image in path
-                          if getattr(image, 'bootme', False))
-            candidate_data.append((build, size, reboots, path))
-            max_build = max(build, max_build)
-            min_size = (size if (min_size is None or size < min_size)
-                        else min_size)
+            keys = list(map(id, path))
+            try:
+                size = sum(map(size_of, keys))
+            except KeyError:
+                for key, image in zip(keys, path):
+                    if key not in image_sizes:
+                        image_sizes[key] = sum(
+                            filerec.size for filerec in image.files)
+                        if getattr(image, 'bootme', False):
+                            reboot_images.add(key)
+                size = sum(map(size_of, keys))
+            builds.append(path[-1].version)
+            sizes.append(size)
+            reboots.append(len(reboot_images.intersection(keys)))
         # Score the candidates.  Any path that doesn't leave you at the
-        # maximum build number gets a ridiculously high score so it won't
-        # possibly be chosen.
+        # maximum build number gets a ridiculously high score, 9001 per build
+        # short of it, which essentially prevents it from winning.
+        max_build = max(builds)
+        min_size = min(sizes)
+        return [(100 * path_reboots) + ((size - min_size) // MiB) +
+                (9001 * (max_build - build))
+                for build, size, path_reboots in zip(builds, sizes, reboots)]
+
+
+class ShortestPathScorer(WeightedScorer):
+    """Choose the same winner as `WeightedScorer` without listing every path.
+
+    The number of candidate paths grows combinatorially with the number of
+    forks in the delta graph.  Instead of materializing every candidate path,
+    this scorer runs a shortest path search over the index's upgrade graph,
+    visiting each build number in increasing order and remembering, for each
+    number of extra reboots, only the smallest download which reaches that
+    build.  Memory use is thus proportional to the number of images rather
+    than the number of paths.
+
+    The costs are exactly those of `WeightedScorer`, and the phased
+    percentage fallback of `Scorer.choose()` is applied to the best path
+    ending at each target image.  When two paths score the same, the one
+    which is found first wins, which may not be the one that
+    `WeightedScorer` would pick.
+    """
+
+    def choose_from_index(self, index, build, channel):
+        graph = index.graph
+        # Cache the download size of each image, since the same image may be
+        # reached along paths with different numbers of reboots.
+        sizes = {}
+        def cost(image):
+            size = sizes.get(image)
+            if size is None:
+                size = sizes[image] = sum(
+                    filerec.size for filerec in image.files)
+            return size, (1 if getattr(image, 'bootme', False) else 0)
+        # best maps a build number to a dictionary mapping reboot counts to
+        # the smallest (size, image, predecessor) reaching that build.  The
+        # predecessor is the (build, reboots) key of the previous step, or
+        # None for the first image in the path.  Since a path only ends at
+        # builds with no further deltas, and the phased percentage depends on
+        # the last image of a path, the ends of the paths are kept separately,
+        # keyed on (image, reboots).
+        best = {}
+        endings = {}
+        queue = []
+        def relax(image, reboots, size, predecessor):
+            image_size, image_reboots = cost(image)
+            size += image_size
+            reboots += image_reboots
+            if len(graph.successors(image.version)) == 0:
+                states, key = endings, (image, reboots)
+            else:
+                states = best.get(image.version)
+                if states is None:
+                    states = best[image.version] = {}
+                    heapq.heappush(queue, image.version)
+                key = reboots
+            state = states.get(key)
+            if state is None or size < state[0]:
+                states[key] = (size, image, predecessor)
+        for image in graph.roots(build):
+            relax(image, 0, 0, None)
+        # Deltas always upgrade to a newer build, so by the time a build is
+        # popped off the queue, all the paths reaching it have been seen.
+        while queue:
+            version = heapq.heappop(queue)
+            states = best[version]
+            # Throw away any state which needs more reboots for at least as
+            # large a download as another state; it can never win.
+            smallest = None
+            for reboots in sorted(states):
+                size = states[reboots][0]
+                if smallest is not None and size >= smallest:
+                    del states[reboots]
+                else:
+                    smallest = size
+            for reboots, (size, image, predecessor) in states.items():
+                for delta in graph.successors(version):
+                    relax(delta, reboots, size, (version, reboots))
+        if len(endings) == 0:
+            log.debug('No candidates, so no winner')
+            return []
+        # Score the best path ending at each target image, as in
+        # WeightedScorer.score().
+        max_build = max(image.version for image, reboots in endings)
+        min_size = min(size for size, image, predecessor in endings.values())
         scores = []
-        for build, size, reboots, path in candidate_data:
-            score = (100 * reboots) + ((size - min_size) // MiB)
-            # If the path does not leave you at the maximum build number, add
-            # a ridiculously high value which essentially prevents that
-            # candidate path from winning.
-            distance = max_build - build
-            score += (9000 * distance) + distance
-            scores.append(score)
-        return scores
+        for (image, reboots), (size, last, predecessor) in endings.items():
+            distance = max_build - image.version
+            score = ((100 * reboots) + ((size - min_size) // MiB) +
+                     (9000 * distance) + distance)
+            scores.append((score, len(scores), image, predecessor))
+        scores.sort()
+        device_percentage = phased_percentage(channel, max_build)
+        log.debug('Device phased percentage: {}%', device_percentage)
+        log.debug('{} scored {} target paths',
+                  self.__class__.__name__, len(scores))
+        for score, i, image, predecessor in scores:
+            image_percentage = image.phased_percentage
+            # An image percentage of 0 means that it's been pulled.
+            if image_percentage > 0 and device_percentage <= image_percentage:
+                # Follow the predecessors back to the start of the path.
+                path = [image]
+                while predecessor is not None:
+                    version, reboots = predecessor
+                    size, image, predecessor = best[version][reboots]
+                    path.append(image)
+                path.reverse()
+                return path
+        # No upgrade path.
+        return []
@@ -17,18 +17,129 @@
 
 __all__ = [
     'Settings',
+    'remove_database',
     ]
 
 
+import os
 import sqlite3
 
 from contextlib import contextmanager
 from pathlib import Path
 from systemimage.config import config
+from systemimage.helpers import safe_remove
+from threading import RLock
 from xdg.BaseDirectory import xdg_cache_home
 
-SCHEMA_VERSION = '1'
+# Version 1 had no constraints on the key column, so it could hold
+# duplicates.  Version 2 makes the key the primary key.
+SCHEMA_VERSION = '2'
 AUTO_DOWNLOAD_DEFAULT = '1'
+# The write-ahead log files which sqlite keeps next to the database file.
+SIDECAR_SUFFIXES = ('-wal', '-shm')
+
+
+class _Database:
+    # An open connection to a settings database, shared by all the Settings
+    # instances using the same file, along with the identity of that file.
+    def __init__(self, path):
+        self.path = path
+        self.lock = RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self.conn.execute('pragma journal_mode=wal')
+            self._migrate()
+            self.identity = _identity(path)
+        except Exception:
+            self.conn.close()
+            raise
+
+    def _migrate(self):
+        version = None
+        tables = self.conn.execute(
+            "select tbl_name from sqlite_master "
+            "where type = 'table' and tbl_name = 'settings'").fetchall()
+        if len(tables) > 0:
+            row = self.conn.execute(
+                "select value from settings where key = '__version__'"
+                ).fetchone()
+            version = (None if row is None else row[0])
+        if version == SCHEMA_VERSION:
+            return
+        # The whole migration is one transaction, so another process never
+        # sees it half done.  Version 1 tables are copied into a table with
+        # a primary key, and where a key is duplicated, the last row inserted
+        # wins.
+        script = ['begin immediate;']
+        if len(tables) == 0:
+            script.append(
+                'create table if not exists settings '
+                '(key text primary key, value);')
+        else:
+            script.extend([
+                'create table settings_new (key text primary key, value);',
+                'insert or replace into settings_new '
+                'select key, value from settings order by rowid;',
+                'drop table settings;',
+                'alter table settings_new rename to settings;',
+                ])
+        script.extend([
+            "insert or replace into settings values ('__version__', '{}');"
+            .format(SCHEMA_VERSION),
+            'commit;',
+            ])
+        try:
+            self.conn.executescript('\n'.join(script))
+        except sqlite3.Error:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            raise
+
+
+def _identity(path):
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return info.st_dev, info.st_ino
+
+
+_lock = RLock()
+_databases = {}
+
+
+def _database(path):
+    # Return the shared connection to the database file, opening it if
+    # necessary.  A connection whose file has since been removed or replaced,
+    # e.g. because its temporary directory went away during the test suite,
+    # is closed.
+    with _lock:
+        database = _databases.get(path)
+        if database is not None and database.identity == _identity(path):
+            return database
+        for stale in list(_databases.values()):
+            if stale.identity != _identity(stale.path):
+                stale.conn.close()
+                del _databases[stale.path]
+        database = _databases[path] = _Database(path)
+        return database
+
+
+def remove_database(path):
+    """Remove a settings database file, along with its write-ahead log.
+
+    The shared connection to the file, if any, is closed first.
+
+    :param path: The path to the settings database file.
+    """
+    path = str(path)
+    with _lock:
+        database = _databases.pop(path, None)
+        if database is not None:
+            database.conn.close()
+        safe_remove(path)
+        for suffix in SIDECAR_SUFFIXES:
+            safe_remove(path + suffix)
 
 
 class Settings:
@@ -44,15 +155,6 @@ class Settings:
                 pass             # pragma: no branch
         except sqlite3.OperationalError:
             self._check_fallback()
-        with self._cursor() as c:
-            c.execute('select tbl_name from sqlite_master')
-            if len(c.fetchall()) == 0:
-                # The database file has no tables.
-                c.execute('create table settings (key, value)''')
-            # Hopefully we won't ever need to migrate this schema, but just in
-            # case we do, set a version value.
-            c.execute('insert into settings values ("__version__", ?)',
-                      (SCHEMA_VERSION,))
 
     def _check_fallback(self):
         # This is refactored into a separate method for testing purposes.
@@ -67,23 +169,29 @@ class Settings:
 
     @contextmanager
     def _cursor(self):
+        # The connection is shared, so the cursor is used under its lock, in
+        # a transaction which is committed when the block exits normally.
         if self._dbpath is None:
             self._dbpath = (config.system.settings_db
                             if self._use_config is None
                             else self._use_config.system.settings_db)
-        with sqlite3.connect(str(self._dbpath)) as conn:
+        database = _database(str(self._dbpath))
+        with database.lock, database.conn as conn:
             yield conn.cursor()
 
     def set(self, key, value):
         with self._cursor() as c:
-            c.execute('select value from settings where key = ?', (key,))
-            row = c.fetchone()
-            if row is None:
-                c.execute('insert into settings values (?, ?)',
-                          (key, value))
-            else:
-                c.execute('update settings set value = ? where key = ?',
-                          (value, key))
+            c.execute('insert or replace into settings values (?, ?)',
+                      (key, value))
+
+    def update(self, items):
+        """Set several keys at once, in a single transaction.
+
+        :param items: An iterable of (key, value) 2-tuples.
+        """
+        with self._cursor() as c:
+            c.executemany('insert or replace into settings values (?, ?)',
+                          items)
 
     def get(self, key):
         with self._cursor() as c:
@@ -100,8 +208,11 @@ class Settings:
             c.execute('delete from settings where key = ?', (key,))
 
     def __iter__(self):
-        # Iterate over all rows, ignoring implementation details.
+        # Iterate over all rows, ignoring implementation details.  The rows
+        # are fetched up front so that the connection isn't held while the
+        # caller works through them.
         with self._cursor() as c:
-            for row in c.execute('select * from settings'):
-                if not row[0].startswith('_'):
-                    yield row
+            rows = c.execute('select * from settings').fetchall()
+        for row in rows:
+            if not row[0].startswith('_'):
+                yield row
@@ -22,31 +22,48 @@ __all__ = [
 
 
 import os
-import json
 import shutil
 import logging
-import tarfile
+import posixpath
 
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from datetime import datetime, timezone
 from functools import partial
 from itertools import islice
 from systemimage.candidates import get_candidates, iter_path
 from systemimage.channel import Channels
+from systemimage.checksums import ChecksumCache
 from systemimage.config import config
-from systemimage.download import Record, get_download_manager
-from systemimage.gpg import Context, SignatureError
+from systemimage.download import (
+    JOURNAL_SUFFIX, Record, get_cached_path, get_download_manager,
+    get_journal)
+from systemimage.gpg import (
+    MAX_VERIFY_WORKERS, Context, SignatureError, fingerprint)
 from systemimage.helpers import (
-    atomic, calculate_signature, makedirs, safe_remove, temporary_directory)
+    atomic, calculate_signature, makedirs, safe_remove)
 from systemimage.index import Index
+from systemimage.indexcache import IndexCache
 from systemimage.keyring import KeyringError, get_keyring
+from systemimage.keyringcache import KeyringCache
+from systemimage.payloadcache import PayloadCache, link_or_copy
+from systemimage.timings import Timings
 from urllib.parse import urljoin
 
 
 log = logging.getLogger('systemimage')
 COMMASPACE = ', '
 COLON = ':'
+# Delta indexes live next to the index they apply to, and are named after the
+# generated_at timestamp of the index they start from.
+DELTA_FMT = '%Y%m%dT%H%M%SZ'
+
+
+def _delta_url(index_url, generated_at):
+    # E.g. /stable/nexus7/index-since-20130429T184527Z.json
+    base, ext = posixpath.splitext(index_url)
+    return '{}-since-{}{}'.format(base, generated_at.strftime(DELTA_FMT), ext)
 
 
 class ChecksumError(Exception):
@@ -68,7 +85,8 @@ def _copy_if_missing(src, dstdir):
         shutil.copy(src, dstdir)
 
 
-def _use_cached(txt, asc, keyrings, checksum=None, blacklist=None):
+def _use_cached(txt, asc, keyrings, checksum=None, blacklist=None,
+                checksums=None):
     if not os.path.exists(txt) or not os.path.exists(asc):
         return False
     with Context(*keyrings, blacklist=blacklist) as ctx:
@@ -76,29 +94,115 @@ def _use_cached(txt, asc, keyrings, checksum=None, blacklist=None):
             return False
     if checksum is None:
         return True
-    with open(txt, 'rb') as fp:
-        got = calculate_signature(fp)
-        return got == checksum
+    if checksums is None:
+        checksums = ChecksumCache()
+    return checksums.checksum(txt) == checksum
+
+
+def _use_cached_payload(payload_cache, txt, asc, keyrings, checksum,
+                        blacklist, checksums):
+    if not payload_cache.get(checksum, txt, asc):
+        return False
+    # The cached copy replaced any partial download of the file.
+    safe_remove(txt + JOURNAL_SUFFIX)
+    if _use_cached(txt, asc, keyrings, checksum, blacklist, checksums):
+        return True
+    # A cached copy which doesn't verify is of no use.
+    payload_cache.discard(checksum)
+    return False
 
 
 def _use_cached_keyring(txz, asc, signing_key):
     if not _use_cached(txz, asc, (signing_key,)):
         return False
-    # Do one additional check: unpack the .tar.xz file, grab the keyring.json
-    # and if it has an expiry key, make sure that the keyring has not expired.
-    with temporary_directory(dir=config.tempdir) as tmp:
-        with tarfile.open(txz, 'r:xz') as tf:
-            tf.extractall(tmp)
-        json_path = os.path.join(tmp, 'keyring.json')
-        with open(json_path, 'r', encoding='utf-8') as fp:
-            data = json.load(fp)
-    expiry = data.get('expiry')
+    # Do one additional check: if the keyring.json has an expiry key, make
+    # sure that the keyring has not expired.  The keyring cache knows this
+    # without unpacking the .tar.xz file again.
+    expiry = KeyringCache().get(txz).expiry
     timestamp = datetime.now(tz=timezone.utc).timestamp()
     # We can use this keyring if it never expires, or if the expiration date
     # is some time in the future.
     return expiry is None or expiry > timestamp
 
 
+class _PipelinedVerifier:
+    """Verify downloaded files while the rest are still downloading.
+
+    Once both a data file and its signature file are completely downloaded,
+    the signature is verified on a worker thread, and unless the downloader
+    already verified the data file's checksum, its checksum is calculated
+    there too.  All the pairs completed by the same downloaded file are
+    verified together, with `Context.verify_all()`.  The results are only
+    acted upon once they are all in.
+    """
+
+    def __init__(self, ctx, executor, downloader, signatures):
+        self._ctx = ctx
+        self._executor = executor
+        self._downloader = downloader
+        self._signatures = signatures
+        # For each pair, the future of the batch it's verified in, and its
+        # position in that batch.
+        self._futures = [None] * len(signatures)
+        # The files which each pair is still waiting for, and the pairs
+        # which are waiting for each file.
+        self._pending = []
+        self._waiting = {}
+        for i, (dst, asc) in enumerate(signatures):
+            self._pending.append(set((dst, asc)))
+            for path in (dst, asc):
+                self._waiting.setdefault(path, []).append(i)
+
+    def completed(self, record):
+        """The downloader's completion callback."""
+        ready = []
+        for i in self._waiting.pop(record.destination, []):
+            pending = self._pending[i]
+            pending.discard(record.destination)
+            if len(pending) == 0:
+                ready.append(i)
+        self._submit(ready)
+
+    def _submit(self, indexes):
+        batch = [i for i in indexes if self._futures[i] is None]
+        if len(batch) == 0:
+            return
+        future = self._executor.submit(
+            self._verify, [self._signatures[i] for i in batch])
+        for position, i in enumerate(batch):
+            self._futures[i] = (future, position)
+
+    def _verify(self, pairs):
+        results = self._ctx.verify_all([(asc, dst) for dst, asc in pairs])
+        for i, (dst, asc) in enumerate(pairs):
+            checksum = None
+            if dst not in self._downloader.checksums:
+                with open(dst, 'rb') as fp:
+                    checksum = calculate_signature(fp)
+            results[i] = (results[i], checksum)
+        return results
+
+    def cancel(self):
+        """Cancel the verifications which haven't started yet."""
+        for entry in self._futures:
+            if entry is not None:
+                entry[0].cancel()
+
+    def results(self):
+        """Wait for all the verifications to complete.
+
+        Any pairs which were never completed by the downloader are verified
+        now, as one batch.
+
+        :return: A list of 2-tuples, one for each pair, of whether the
+            signature was verified and the data file's checksum, which is
+            None if it wasn't calculated.
+        """
+        self._submit(range(len(self._signatures)))
+        return [future.result()[position]
+                for future, position in self._futures]
+
+
 class State:
     def __init__(self):
         # Variables which manage state transitions.
@@ -115,6 +219,8 @@ class State:
         self.channel_switch = None
         # Other public attributes.
         self.downloader = get_download_manager()
+        # The cost of each step which has been run.
+        self.timings = Timings(self.downloader)
         self._next.append(self._cleanup)
 
     def __iter__(self):
@@ -127,11 +233,15 @@ class State:
         log.debug('-> [{:2}] {}'.format(self._debug_step, name))
         return step, name
 
+    def _run(self, step, name):
+        with self.timings.measure(name[1:]):
+            step()
+        self._debug_step += 1
+
     def __next__(self):
         try:
             step, name = self._pop()
-            step()
-            self._debug_step += 1
+            self._run(step, name)
         except IndexError:
             # Do not chain the exception.
             raise StopIteration from None
@@ -152,8 +262,7 @@ class State:
             except (StopIteration, IndexError):
                 # We're done.
                 break
-            step()
-            self._debug_step += 1
+            self._run(step, name)
             if name[1:] == stop_after:
                 break
 
@@ -176,8 +285,7 @@ class State:
                 # skip this step.
                 self._next.appendleft(step)
                 break
-            step()
-            self._debug_step += 1
+            self._run(step, name)
 
     def _cleanup(self):
         """Clean up the destination directories.
@@ -193,8 +301,40 @@ class State:
         safe_remove(os.path.join(data_dir, 'blacklist.tar.xz.asc'))
         safe_remove(os.path.join(data_dir, 'keyring.tar.xz'))
         safe_remove(os.path.join(data_dir, 'keyring.tar.xz.asc'))
+        if config.system.prefetch:
+            self._next.append(self._prefetch_metadata)
         self._next.append(self._get_blacklist_1)
 
+    def _get_keyring(self, *args):
+        # Only our own downloader knows about the keyrings it prefetched.
+        downloader = self.downloader if config.system.prefetch else None
+        return get_keyring(*args, downloader=downloader)
+
+    def _prefetch_metadata(self):
+        """Speculatively download the metadata files whose urls are known.
+
+        The following steps still verify the files in the same order as
+        always, and any files they don't ask for are thrown away.
+        """
+        paths = []
+        # Only keyrings which will probably have to be downloaded are worth
+        # downloading.
+        image_master = config.gpg.image_master
+        if not _use_cached_keyring(image_master, image_master + '.asc',
+                                   config.gpg.archive_master):
+            paths.append('gpg/image-master.tar.xz')
+        paths.append('gpg/blacklist.tar.xz')
+        image_signing = config.gpg.image_signing
+        if not _use_cached_keyring(image_signing, image_signing + '.asc',
+                                   image_master):
+            paths.append('gpg/image-signing.tar.xz')
+        paths.append('channels.json')
+        urls = []
+        for path in paths:
+            url = urljoin(config.https_base, path)
+            urls.extend((url, url + '.asc'))
+        self.downloader.prefetch(urls)
+
     def _get_blacklist_1(self):
         """First try to get the blacklist."""
         # If there is no image master key, or if the signature on the key is
@@ -206,7 +346,7 @@ class State:
         if not _use_cached_keyring(image_master, image_master + '.asc',
                                    config.gpg.archive_master):
             log.info('No valid image master key found, downloading')
-            get_keyring(
+            self._get_keyring(
                 'image-master', 'gpg/image-master.tar.xz', 'archive-master')
         # The only way to know whether there is a blacklist or not is to try
         # to download it.  If it fails, there isn't one.
@@ -216,7 +356,7 @@ class State:
             # downloading a blacklist file.
             log.info('Looking for blacklist: {}'.format(
                      urljoin(config.https_base, url)))
-            get_keyring('blacklist', url, 'image-master')
+            self._get_keyring('blacklist', url, 'image-master')
         except SignatureError:
             log.exception('No signed blacklist found')
             # The blacklist wasn't signed by the system image master.  Maybe
@@ -252,7 +392,7 @@ class State:
         try:
             log.info('Looking for blacklist again: {}',
                      urljoin(config.https_base, url))
-            get_keyring('blacklist', url, 'image-master')
+            self._get_keyring('blacklist', url, 'image-master')
         except FileNotFoundError:
             log.info('No blacklist found on second attempt')
         else:
@@ -274,7 +414,7 @@ class State:
         if not _use_cached_keyring(image_signing, image_signing + '.asc',
                                    config.gpg.image_master):
             log.info('No valid image signing key found, downloading')
-            get_keyring(
+            self._get_keyring(
                 'image-signing', 'gpg/image-signing.tar.xz', 'image-master',
                 self.blacklist)
         channels_url = urljoin(config.https_base, 'channels.json')
@@ -282,35 +422,49 @@ class State:
         asc_url = urljoin(config.https_base, 'channels.json.asc')
         asc_path = os.path.join(config.tempdir, 'channels.json.asc')
         log.info('Looking for: {}', channels_url)
+        downloads = [
+            Record(channels_url, channels_path,
+                   cached=get_cached_path(channels_url)),
+            Record(asc_url, asc_path, cached=get_cached_path(asc_url)),
+            ]
         with ExitStack() as stack:
-            self.downloader.get_files([
-                (channels_url, channels_path),
-                (asc_url, asc_path),
-                ])
+            self.downloader.get_files(downloads)
             # Once we're done with them, we can remove these files.
             stack.callback(safe_remove, channels_path)
             stack.callback(safe_remove, asc_path)
             # The channels.json file must be signed with the SYSTEM IMAGE
-            # SIGNING key.  There may or may not be a blacklist.
-            ctx = stack.enter_context(
-                Context(config.gpg.image_signing, blacklist=self.blacklist))
-            try:
-                ctx.validate(asc_path, channels_path)
-            except SignatureError:
-                # The signature on the channels.json file did not match.
-                # Maybe there's a new image signing key on the server.  If
-                # we've already downloaded a new image signing key, then
-                # there's nothing more to do but raise an exception.
-                # Otherwise, if a new key *is* found, retry the current step.
-                if count > 0:
-                    raise
-                self._next.appendleft(self._get_signing_key)
-                log.info('channels.json not properly signed')
-                return
+            # SIGNING key.  There may or may not be a blacklist.  If the
+            # server says the files haven't changed since they were verified
+            # with the same keys, there's no need to verify them again.
+            keys = fingerprint([config.gpg.image_signing], self.blacklist)
+            if self.downloader.is_verified(downloads, keys):
+                log.info('channels.json not modified')
+            else:
+                ctx = stack.enter_context(
+                    Context(config.gpg.image_signing,
+                            blacklist=self.blacklist))
+                try:
+                    ctx.validate(asc_path, channels_path)
+                except SignatureError:
+                    # The signature on the channels.json file did not match.
+                    # Maybe there's a new image signing key on the server.  If
+                    # we've already downloaded a new image signing key, then
+                    # there's nothing more to do but raise an exception.
+                    # Otherwise, if a new key *is* found, retry the current
+                    # step.
+                    if count > 0:
+                        raise
+                    self._next.appendleft(self._get_signing_key)
+                    log.info('channels.json not properly signed')
+                    return
+                self.downloader.cache_verified(downloads, keys)
             # The signature was good.
             log.info('Local channels file: {}', channels_path)
             with open(channels_path, encoding='utf-8') as fp:
                 self.channels = Channels.from_json(fp.read())
+        # Whatever was prefetched along with the channels.json file isn't
+        # needed any more.
+        self.downloader.discard_prefetched()
         # Locate the index file for the channel/device.
         try:
             channel = self.channels[config.channel]
@@ -328,6 +482,17 @@ class State:
         # The next step will depend on whether there is a device keyring
         # available or not.  If there is, download and verify it now.
         keyring = getattr(device, 'keyring', None)
+        if config.system.prefetch:
+            # The device keyring and the index can be downloaded together,
+            # even though the index is only verified after the keyring.  The
+            # index's signature file is always next to it.
+            urls = []
+            if keyring:
+                urls.append(urljoin(config.https_base, keyring.path))
+                urls.append(urljoin(config.https_base, keyring.signature))
+            index_url = urljoin(config.https_base, device.index)
+            urls.extend((index_url, index_url + '.asc'))
+            self.downloader.prefetch(urls)
         if keyring:
             self._next.append(partial(self._get_device_keyring, keyring))
         self._next.append(partial(self._get_index, device.index))
@@ -336,7 +501,7 @@ class State:
         keyring_url = urljoin(config.https_base, keyring.path)
         asc_url = urljoin(config.https_base, keyring.signature)
         log.info('getting device keyring: {}', keyring_url)
-        get_keyring(
+        self._get_keyring(
             'device-signing', (keyring_url, asc_url), 'image-signing',
             self.blacklist)
         # We don't need to set the next action because it's already been done.
@@ -349,7 +514,7 @@ class State:
         try:
             log.info('Getting the image master key')
             # The image signing key must be signed by the archive master.
-            get_keyring(
+            self._get_keyring(
                 'image-master', 'gpg/image-master.tar.xz',
                 'archive-master', self.blacklist)
         except (FileNotFoundError, SignatureError, KeyringError):
@@ -368,7 +533,7 @@ class State:
         """
         try:
             # The image signing key must be signed by the image master.
-            get_keyring(
+            self._get_keyring(
                 'image-signing', 'gpg/image-signing.tar.xz', 'image-master',
                 self.blacklist)
         except (FileNotFoundError, SignatureError, KeyringError):
@@ -380,65 +545,163 @@ class State:
         # signature fails this time, it's an error.
         self._next.appendleft(partial(self._get_channel, 1))
 
+    def _get_delta_index(self, index_url, latest, keyrings):
+        # Try to bring the latest index we have from this url up to date
+        # with a delta index, returning the new index or None if that isn't
+        # possible.  Only servers configured with [service]delta_indexes
+        # provide them, and then only since the indexes they generated fairly
+        # recently, so they are probed for, by prefetching them, which
+        # tolerates failures quietly.
+        delta_url = _delta_url(index_url, latest.global_.generated_at)
+        asc_url = delta_url + '.asc'
+        self.downloader.prefetch([delta_url, asc_url])
+        if not all(self.downloader.is_prefetched(url)
+                   for url in (delta_url, asc_url)):
+            log.info('No delta index: {}', delta_url)
+            return None
+        delta_path = os.path.join(config.tempdir, 'index-delta.json')
+        asc_path = delta_path + '.asc'
+        downloads = [
+            Record(delta_url, delta_path, cached=get_cached_path(delta_url)),
+            Record(asc_url, asc_path, cached=get_cached_path(asc_url)),
+            ]
+        with ExitStack() as stack:
+            self.downloader.get_files(downloads)
+            stack.callback(safe_remove, delta_path)
+            stack.callback(safe_remove, asc_path)
+            ctx = stack.enter_context(
+                Context(*keyrings, blacklist=self.blacklist))
+            try:
+                ctx.validate(asc_path, delta_path)
+                with open(delta_path, encoding='utf-8') as fp:
+                    index = latest.merge_json(fp.read())
+            except (SignatureError, ValueError, KeyError):
+                # Fall back to the full index, which gets verified as usual.
+                log.exception('Unusable delta index: {}', delta_url)
+                return None
+        log.info('Applied delta index: {}', delta_url)
+        return index
+
     def _get_index(self, index):
         """Get and verify the index.json file."""
         index_url = urljoin(config.https_base, index)
+        # The index.json file may be signed by either the device keyring (if
+        # one exists) or the image signing key.
+        keyrings = [config.gpg.image_signing]
+        if os.path.exists(config.gpg.device_signing):
+            keyrings.append(config.gpg.device_signing)
+        keys = fingerprint(keyrings, self.blacklist)
+        # Only the images which could be part of an upgrade from this build
+        # are kept, so the index is parsed, cached, and merged for it.
+        build_number = self._target()[0]
+        cache = IndexCache()
+        # If the server publishes delta indexes, and we've seen an index from
+        # this url before, the server may be able to tell us what changed
+        # since then, which is much less to download and parse than the whole
+        # index.  That's only possible if we kept the images for the same
+        # build though.
+        latest = (cache.get_latest(index_url, keys)
+                  if config.service.delta_indexes
+                  else None)
+        if (latest is not None and
+                getattr(latest.__dict__.get('pruned'), 'build', None)
+                != build_number):
+            latest = None
+        if latest is not None:
+            delta = self._get_delta_index(index_url, latest, keyrings)
+            if delta is not None:
+                cache.put_latest(index_url, keys, delta)
+                self.index = delta
+                self.downloader.discard_prefetched()
+                self._next.append(self._calculate_winner)
+                return
         asc_url = index_url + '.asc'
         index_path = os.path.join(config.tempdir, 'index.json')
         asc_path = index_path + '.asc'
+        downloads = [
+            Record(index_url, index_path, cached=get_cached_path(index_url)),
+            Record(asc_url, asc_path, cached=get_cached_path(asc_url)),
+            ]
         with ExitStack() as stack:
-            self.downloader.get_files([
-                (index_url, index_path),
-                (asc_url, asc_path),
-                ])
+            self.downloader.get_files(downloads)
             stack.callback(os.remove, index_path)
             stack.callback(os.remove, asc_path)
-            # Check the signature of the index.json file.  It may be signed by
-            # either the device keyring (if one exists) or the image signing
-            # key.
-            keyrings = [config.gpg.image_signing]
-            if os.path.exists(config.gpg.device_signing):
-                keyrings.append(config.gpg.device_signing)
-            ctx = stack.enter_context(
-                Context(*keyrings, blacklist=self.blacklist))
-            ctx.validate(asc_path, index_path)
-            # The signature was good.
-            with open(index_path, encoding='utf-8') as fp:
-                self.index = Index.from_json(fp.read())
+            # If exactly these bytes have already been verified with exactly
+            # these keyrings, we can skip both verification and parsing.  If
+            # they have been verified but not parsed, e.g. because the parsed
+            # index was evicted, we can at least skip the verification.
+            key = cache.key(index_path, asc_path, build_number)
+            index = cache.get(key, keys)
+            if index is None:
+                if self.downloader.is_verified(downloads, keys):
+                    log.info('index.json not modified')
+                else:
+                    ctx = stack.enter_context(
+                        Context(*keyrings, blacklist=self.blacklist))
+                    ctx.validate(asc_path, index_path)
+                # The signature was good.
+                with open(index_path, encoding='utf-8') as fp:
+                    index = Index.from_json(fp.read(), build_number)
+                cache.put(key, keys, index)
+            self.downloader.cache_verified(downloads, keys)
+            self.index = index
+        if config.service.delta_indexes and (
+                latest is None or
+                latest.global_.generated_at != index.global_.generated_at):
+            cache.put_latest(index_url, keys, index)
+        self.downloader.discard_prefetched()
         self._next.append(self._calculate_winner)
 
-    def _calculate_winner(self):
-        """Given an index, calculate the paths and score a winner."""
-        # If we were tracking a channel alias, and that channel alias has
-        # changed, squash the build number to 0 before calculating the
-        # winner.  Otherwise, trust the configured build number.
+    def _target(self):
+        """Return the build number to upgrade from, and any channel switch.
+
+        If we were tracking a channel alias, and that channel alias has
+        changed, the build number is squashed to 0.  Otherwise, the
+        configured build number is trusted.
+
+        :return: A 3-tuple of the build number, the channel to score for, and
+            either None or the 2-tuple of the old and new channel names if
+            this is a channel switch.
+        """
         channel = self.channels[config.channel]
         # channel_target is the channel we're on based on the alias mapping in
         # our config files.  channel_alias is the alias mapping in the
         # channel.json file, i.e. the channel an update will put us on.
         channel_target = getattr(config.service, 'channel_target', None)
         channel_alias = getattr(channel, 'alias', None)
+        scoring_channel = (channel_target
+                           if channel_alias is None
+                           else channel_alias)
         if (    channel_alias is None or
                 channel_target is None or
                 channel_alias == channel_target):
-            build_number = config.build_number
+            return config.build_number, scoring_channel, None
+        # This is a channel switch caused by a new alias.  Unless the build
+        # number has been explicitly overridden on the command line via
+        # --build/-b, use build number 0 to force a full update.
+        build_number = (config.build_number
+                        if config.build_number_override
+                        else 0)
+        return build_number, scoring_channel, (channel_target, channel_alias)
+
+    def _calculate_winner(self):
+        """Given an index, calculate the paths and score a winner."""
+        build_number, scoring_channel, channel_switch = self._target()
+        if channel_switch is not None:
+            self.channel_switch = channel_switch
+        scorer = config.hooks.scorer()
+        if self.candidate_filter is None:
+            # Let the scorer decide whether it needs to see every candidate
+            # path or whether it can search the index directly.
+            self.winner = scorer.choose_from_index(
+                self.index, build_number, scoring_channel)
         else:
-            # This is a channel switch caused by a new alias.  Unless the
-            # build number has been explicitly overridden on the command line
-            # via --build/-b, use build number 0 to force a full update.
-            build_number = (config.build_number
-                            if config.build_number_override
-                            else 0)
-            self.channel_switch = (channel_target, channel_alias)
-        candidates = get_candidates(self.index, build_number)
-        log.debug('Candidates from build# {}: {}'.format(
-            build_number, len(candidates)))
-        if self.candidate_filter is not None:
+            # The filters work on the full list of candidate paths.
+            candidates = get_candidates(self.index, build_number)
+            log.debug('Candidates from build# {}: {}'.format(
+                build_number, len(candidates)))
             candidates = self.candidate_filter(candidates)
-        self.winner = config.hooks.scorer().choose(
-            candidates, (channel_target
-                         if channel_alias is None
-                         else channel_alias))
+            self.winner = scorer.choose(candidates, scoring_channel)
         if len(self.winner) == 0:
             log.info('Already up-to-date')
             return
@@ -469,11 +732,22 @@ class State:
         downloads = []
         signatures = []
         checksums = []
-        # For the clean ups below, preserve recovery's log files.
+        checksum_cache = ChecksumCache()
+        # Verified files are kept in a content-addressed cache, so that the
+        # same file is never downloaded twice, even if it's referenced by a
+        # different path, e.g. in another channel.  Files with the same
+        # checksum in this upgrade path are only downloaded once, and the
+        # other paths are linked to that file once it's verified.
+        payload_cache = PayloadCache()
+        payloads = {}
+        duplicates = []
+        # For the clean ups below, preserve recovery's log files, and the
+        # payload cache, which may be kept in the cache partition.
         cache_dir = config.updater.cache_partition
         preserve = set((
             os.path.join(cache_dir, 'log'),
             os.path.join(cache_dir, 'last_log'),
+            payload_cache.directory,
             ))
         for image_number, filerec in iter_path(self.winner):
             # Re-pack for arguments to get_files() and to collate the
@@ -484,25 +758,42 @@ class State:
             self.files.append((dst, (image_number, filerec.order)))
             self.files.append((asc, (image_number, filerec.order)))
             # Check the existence and signature of the file.
-            if _use_cached(dst, asc, keyrings, checksum, self.blacklist):
+            if _use_cached(dst, asc, keyrings, checksum, self.blacklist,
+                           checksum_cache):
+                preserve.add(dst)
+                preserve.add(asc)
+            elif checksum in payloads:
+                duplicates.append((dst, asc) + payloads[checksum])
+                continue
+            elif _use_cached_payload(payload_cache, dst, asc, keyrings,
+                                     checksum, self.blacklist,
+                                     checksum_cache):
                 preserve.add(dst)
                 preserve.add(asc)
             else:
-                # Add the data file, which has a checksum.
+                # Add the data file, which has a checksum.  Its size is known
+                # from the index, so the downloader needn't ask the server.
                 downloads.append(Record(
                     urljoin(config.http_base, filerec.path),
-                    dst, checksum))
+                    dst, checksum, size=getattr(filerec, 'size', None)))
                 # Add the signature file, which does not have a checksum.
                 downloads.append(Record(
                     urljoin(config.http_base, filerec.signature),
                     asc))
                 signatures.append((dst, asc))
                 checksums.append((dst, checksum))
+            payloads[checksum] = (dst, asc)
         # For any files we're about to download, we must make sure that none
         # of the destination file paths exist, otherwise the downloader will
-        # throw exceptions.
+        # throw exceptions.  The exceptions are the partial files of
+        # interrupted downloads, which the downloader can resume.
         for record in downloads:
-            safe_remove(record.destination)
+            if (self.downloader.resumable and
+                    get_journal(record) is not None):
+                preserve.add(record.destination)
+                preserve.add(record.destination + JOURNAL_SUFFIX)
+            else:
+                safe_remove(record.destination)
         # Also delete cache partition files that we no longer need.
         for filename in os.listdir(cache_dir):
             path = os.path.join(cache_dir, filename)
@@ -510,32 +801,68 @@ class State:
                 safe_remove(os.path.join(cache_dir, filename))
         # Now, download all missing or ill-signed files, providing logging
         # feedback on progress.  This download can be paused.  The downloader
-        # should also signal when the file downloads have started.
-        self.downloader.get_files(
-            downloads, pausable=True, signal_started=True)
-        with ExitStack() as stack:
-            # Set things up to remove the files if a SignatureError gets
-            # raised or if the checksums don't match.  If everything's okay,
-            # we'll clear the stack before the context manager exits so none
-            # of the files will get removed.
-            for record in downloads:
-                stack.callback(os.remove, record.destination)
-            # Although we should never get there, if the downloading step
-            # fails, clear out the self.files list so there's no possibilty
-            # we'll try to move them later.
-            stack.callback(setattr, self, 'files', [])
-            # Verify the signatures on all the downloaded files.
-            with Context(*keyrings, blacklist=self.blacklist) as ctx:
-                for dst, asc in signatures:
-                    ctx.validate(asc, dst)
-            # Verify the checksums.
-            for dst, checksum in checksums:
-                with open(dst, 'rb') as fp:
-                    got = calculate_signature(fp)
+        # should also signal when the file downloads have started.  Each data
+        # file is verified as soon as it and its signature file are
+        # downloaded, while the rest are still downloading.
+        with ExitStack() as resources:
+            ctx = resources.enter_context(
+                Context(*keyrings, blacklist=self.blacklist))
+            executor = resources.enter_context(
+                ThreadPoolExecutor(max_workers=MAX_VERIFY_WORKERS))
+            verifier = _PipelinedVerifier(
+                ctx, executor, self.downloader, signatures)
+            # If the download fails, don't bother with the verifications
+            # which haven't started yet.
+            resources.callback(verifier.cancel)
+            self.downloader.completion_callbacks.append(verifier.completed)
+            resources.callback(
+                self.downloader.completion_callbacks.remove,
+                verifier.completed)
+            self.downloader.get_files(
+                downloads, pausable=True, signal_started=True)
+            with ExitStack() as stack:
+                # Set things up to remove the files if a SignatureError gets
+                # raised or if the checksums don't match.  If everything's
+                # okay, we'll clear the stack before the context manager exits
+                # so none of the files will get removed.
+                for record in downloads:
+                    stack.callback(os.remove, record.destination)
+                # Although we should never get there, if the downloading step
+                # fails, clear out the self.files list so there's no
+                # possibilty we'll try to move them later.
+                stack.callback(setattr, self, 'files', [])
+                results = verifier.results()
+                # Check the signatures on all the downloaded files.
+                for (dst, asc), (verified, got) in zip(signatures, results):
+                    if not verified:
+                        raise SignatureError(asc, dst, ctx.keyring_paths,
+                                             ctx.blacklist_path)
+                # Check the checksums.  The downloader may already have
+                # verified them while downloading, in which case the files
+                # needn't be read again.
+                for (dst, checksum), (verified, got) in zip(
+                        checksums, results):
+                    reported = self.downloader.checksums.get(dst)
+                    if reported is not None:
+                        got = reported
+                    elif got is None:
+                        with open(dst, 'rb') as fp:
+                            got = calculate_signature(fp)
                     if got != checksum:
                         raise ChecksumError(dst, got, checksum)
-            # Everything is fine so nothing needs to be cleared.
-            stack.pop_all()
+                # Everything is fine so nothing needs to be cleared.
+                stack.pop_all()
+        # Remember the checksums, so that checking whether the files can be
+        # reused next time needn't read them again.
+        checksum_cache.update(checksums)
+        # Keep all the verified files for the next time they're needed, and
+        # put the files with the same contents in place.
+        payload_cache.update(
+            (checksum, dst, asc)
+            for checksum, (dst, asc) in payloads.items())
+        for dst, asc, src_dst, src_asc in duplicates:
+            link_or_copy(src_dst, dst)
+            link_or_copy(src_asc, asc)
         log.info('all files available in {}', cache_dir)
         # Now, copy the files from the temporary directory into the location
         # for the upgrader.
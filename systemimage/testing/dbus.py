@@ -35,8 +35,9 @@ from pathlib import Path
 from systemimage.api import Mediator
 from systemimage.config import config
 from systemimage.dbus import Service, log_and_exit
-from systemimage.helpers import MiB, makedirs, safe_remove, version_detail
+from systemimage.helpers import MiB, makedirs, version_detail
 from systemimage.logging import make_handler
+from systemimage.settings import remove_database
 from unittest.mock import patch
 
 
@@ -95,7 +96,7 @@ class _LiveTestableService(Service):
         self._rebootable = False
         self._failure_count = 0
         del config.build_number
-        safe_remove(config.system.settings_db)
+        remove_database(config.system.settings_db)
 
     @log_and_exit
     @method('com.canonical.SystemImage')
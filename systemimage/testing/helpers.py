@@ -17,6 +17,7 @@
 
 __all__ = [
     'ServerTestBase',
+    'TemporaryDirectoryTestBase',
     'chmod',
     'configuration',
     'copy',
@@ -28,15 +29,18 @@ __all__ = [
     'get_channels',
     'get_index',
     'make_http_server',
+    'read_file',
     'reset_envar',
     'setup_index',
     'setup_keyring_txz',
     'setup_keyrings',
     'sign',
+    'skip_unless_benchmark',
     'terminate_service',
     'touch_build',
     'wait_for_service',
     'write_bytes',
+    'write_file',
     ]
 
 
@@ -54,13 +58,16 @@ import unittest
 
 from contextlib import ExitStack, contextmanager, suppress
 from functools import partial, partialmethod, wraps
+from io import BytesIO
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from pathlib import Path
 from pkg_resources import resource_filename, resource_string as resource_bytes
 from socket import SHUT_RDWR
+from socketserver import ThreadingMixIn
 from systemimage.channel import Channels
 from systemimage.config import Configuration, config
-from systemimage.helpers import MiB, atomic, makedirs, temporary_directory
+from systemimage.helpers import (
+    MiB, atomic, calculate_signature, makedirs, temporary_directory)
 from systemimage.index import Index
 from threading import Thread
 from unittest.mock import patch
@@ -68,6 +75,11 @@ from unittest.mock import patch
 
 EMPTYSTRING = ''
 SPACE = ' '
+LATENCY_CHUNK_SIZE = 64 * 1024
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
 
 
 def get_index(filename):
@@ -85,7 +97,8 @@ def data_path(filename):
    resource_filename('systemimage.tests.data', filename))
 
 
-def make_http_server(directory, port, certpem=None, keypem=None):
+def make_http_server(directory, port, certpem=None, keypem=None, *,
+                     latency=None):
     """Create an HTTP/S server to vend from the file system.
 
     :param directory: The file system directory to vend files from.
@@ -96,6 +109,10 @@ def make_http_server(directory, port, certpem=None, keypem=None):
     :param keypem: For HTTPS servers, the path to the key PEM file.  If the
         file name does not start with a slash, it is considered relative to
         the test data directory.
+    :param latency: For simulating a high latency link, the number of
+        seconds to wait before sending each chunk of a file.  This limits the
+        throughput of each connection, as a real link's round trip time
+        would.  Such a server handles its connections concurrently.
     :return: A context manager that when closed, stops the server.
     """
     # We need an HTTP/S server to vend the file system, or at least parts of
@@ -121,6 +138,68 @@ def make_http_server(directory, port, certpem=None, keypem=None):
             except ConnectionResetError:
                 super().handle_one_request()
 
+        # Files are vended with a strong ETag calculated from their
+        # contents, so that conditional requests can be tested.
+        _etag = None
+
+        def send_head(self):
+            path = self.translate_path(self.path)
+            if os.path.isfile(path):
+                with open(path, 'rb') as fp:
+                    etag = '"{}"'.format(calculate_signature(fp))
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return None
+                self._etag = etag
+                # Byte ranges are supported so that interrupted downloads can
+                # be resumed, but only the simple `bytes=first-[last]` form.
+                ranges = self.headers.get('Range')
+                if ranges is not None and ranges.startswith('bytes='):
+                    return self._send_range(path, ranges[6:])
+            return super().send_head()
+
+        def _send_range(self, path, ranges):
+            first, dash, last = ranges.partition('-')
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            first = int(first)
+            last = len(data) - 1 if last == '' else min(
+                int(last), len(data) - 1)
+            if first > last:
+                self._etag = None
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(
+                    len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                first, last, len(data)))
+            self.send_header('Content-Length', str(last - first + 1))
+            self.end_headers()
+            return BytesIO(data[first:last + 1])
+
+        def copyfile(self, source, outputfile):
+            if latency is None:
+                super().copyfile(source, outputfile)
+                return
+            while True:
+                time.sleep(latency)
+                data = source.read(LATENCY_CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+                outputfile.write(data)
+
+        def end_headers(self):
+            if self._etag is not None:
+                self.send_header('ETag', self._etag)
+                self._etag = None
+            super().end_headers()
+
         def do_HEAD(self):
             # Just tell the client we have the magic file.
             if self.path == '/user-agent.txt':
@@ -169,7 +248,8 @@ def make_http_server(directory, port, certpem=None, keypem=None):
     # the Qt networking stack, causing huge slowdowns on our test teardown
     # methods.
     connections = []
-    class Server(HTTPServer):
+    base = HTTPServer if latency is None else ThreadingHTTPServer
+    class Server(base):
         def get_request(self):
             conn, addr = super().get_request()
             connections.append(conn)
@@ -305,6 +385,17 @@ def configuration(*args):
         return decorator
 
 
+def skip_unless_benchmark(cls):
+    """Class decorator which skips a benchmark unless it's asked for.
+
+    Benchmarks take a while and their timings depend on the machine, so they
+    only run when $SYSTEMIMAGE_BENCHMARK is set.
+    """
+    return unittest.skipUnless(
+        os.environ.get('SYSTEMIMAGE_BENCHMARK'),
+        'Set SYSTEMIMAGE_BENCHMARK to run the benchmarks')(cls)
+
+
 def sign(filename, pubkey_ring):
     """GPG sign the given file, producing an armored detached signature.
 
@@ -488,6 +579,22 @@ def write_bytes(path, size_in_mib):
             fp.write(b'x' * MiB)
 
 
+def read_file(path):
+    # Return the contents of the file in path as bytes.
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+def write_file(path, contents):
+    # Replace the file in path with the contents, either str or bytes.
+    if isinstance(contents, bytes):
+        with open(path, 'wb') as fp:
+            fp.write(contents)
+    else:
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(contents)
+
+
 def debuggable(fn):
     def wrapper(*args, **kws):
         try:
@@ -614,6 +721,16 @@ class ServerTestBase(unittest.TestCase):
                              'device-signing.tar.xz'))
 
 
+class TemporaryDirectoryTestBase(unittest.TestCase):
+    # Each test gets its own temporary directory, as self.tmpdir.
+
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self.tmpdir = self._resources.enter_context(temporary_directory())
+
+
 def descriptions(path):
     descriptions = []
     for image in path:
@@ -0,0 +1,128 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic index files for benchmarks."""
+
+__all__ = [
+    'synthetic_index',
+    'synthetic_index_json',
+    ]
+
+
+import json
+import random
+
+from systemimage.helpers import MiB
+from systemimage.index import Index
+
+
+GENERATED_AT = 'Mon Apr 29 18:45:27 UTC 2013'
+
+
+def _filerec(r, path, order, size):
+    return dict(
+        checksum='{:064x}'.format(r.getrandbits(256)),
+        order=order,
+        path=path,
+        signature=path + '.asc',
+        size=size,
+        )
+
+
+def synthetic_index_json(builds, *, full_every=10, fork=1, fork_every=1,
+                         chain=None, bootme_every=0, minversion_every=0,
+                         phased_percentage=None, seed=0):
+    """Generate the JSON text of a large, realistic looking index.
+
+    Build numbers run from 1 to `builds` inclusive.  Build 1 is always a
+    full image.
+
+    :param builds: The number of published build numbers.
+    :param full_every: Publish a full image for every Nth build.
+    :param fork: For builds which fork, the number of deltas published for
+        that build, with bases 1, 2, ... `fork` builds back.
+    :param fork_every: Only every Nth build forks; all others get a single
+        delta from the previous build.
+    :param chain: If given, deltas are only published for builds at most
+        this many builds past the most recent full image.
+    :param bootme_every: If non-zero, every Nth image gets a `bootme` flag.
+    :param minversion_every: If non-zero, every Nth full image gets a
+        `minversion` of half its version.
+    :param phased_percentage: If given, the `phased-percentage` of the images
+        of the newest build.
+    :param seed: The random seed, so that the same arguments always produce
+        the same index.
+    :return: The index.json contents.
+    :rtype: str
+    """
+    assert 0 < builds < (1 << 16), 'Builds must fit in 16 bits'
+    r = random.Random(seed)
+    images = []
+    last_full = 1
+    full_count = 0
+    def add_image(**image):
+        if bootme_every and len(images) % bootme_every == 0:
+            image['bootme'] = True
+        images.append(image)
+    for version in range(1, builds + 1):
+        if version == 1 or version % full_every == 0:
+            last_full = version
+            full_count += 1
+            image = dict(
+                type='full',
+                version=version,
+                description='Full {}'.format(version),
+                files=[
+                    _filerec(r, '/full/{}/device.tar.xz'.format(version),
+                             0, r.randint(50, 100) * MiB),
+                    _filerec(r, '/full/{}/ubuntu.tar.xz'.format(version),
+                             1, r.randint(200, 400) * MiB),
+                    ],
+                )
+            if minversion_every and full_count % minversion_every == 0:
+                image['minversion'] = version // 2
+            add_image(**image)
+        if version == 1:
+            continue
+        if chain is not None and version - last_full > chain:
+            continue
+        width = fork if version % fork_every == 0 else 1
+        for back in range(1, width + 1):
+            base = version - back
+            if base < 1:
+                break
+            add_image(
+                type='delta',
+                base=base,
+                version=version,
+                description='Delta {}-{}'.format(base, version),
+                files=[
+                    _filerec(r, '/delta/{}-{}/ubuntu.tar.xz'.format(
+                        base, version), 0, r.randint(1, 50) * MiB),
+                    ],
+                )
+    if phased_percentage is not None:
+        for image in images:
+            if image['version'] == builds:
+                image['phased-percentage'] = phased_percentage
+    return json.dumps({
+        'global': dict(generated_at=GENERATED_AT),
+        'images': images,
+        })
+
+
+def synthetic_index(builds, **kws):
+    """Like `synthetic_index_json()` but return a parsed `Index`."""
+    return Index.from_json(synthetic_index_json(builds, **kws))
@@ -19,10 +19,12 @@
 __all__ = [
     'TestAPI',
     'TestAPIVersionDetail',
+    'TestCheckCache',
     ]
 
 
 import os
+import time
 import unittest
 
 from pathlib import Path
@@ -178,6 +180,11 @@ unmount system
         self.assertEqual(set(os.listdir(config.updater.data_partition)), set([
             'blacklist.tar.xz',
             'blacklist.tar.xz.asc',
+            'checksums.json',
+            'index-cache',
+            'keyring-cache',
+            'metadata',
+            'payload-cache',
             ]))
 
     @configuration
@@ -288,3 +295,118 @@ class TestAPIVersionDetail(ServerTestBase):
         update = Mediator().check_for_update()
         self.assertFalse(update.is_available)
         self.assertEqual(update.version_detail, '')
+
+
+class TestCheckCache(ServerTestBase):
+    INDEX_FILE = 'api.index_01.json'
+    CHANNEL_FILE = 'api.channels_01.json'
+    CHANNEL = 'stable'
+    DEVICE = 'nexus7'
+
+    def _change_index(self):
+        index_dir = Path(self._serverdir) / self.CHANNEL / self.DEVICE
+        copy('api.index_02.json', index_dir, 'index.json')
+        sign(index_dir / 'index.json', 'device-signing.gpg')
+        setup_index('api.index_02.json', self._serverdir, 'device-signing.gpg')
+
+    def _later(self):
+        # Pretend the check's result is well past its [dbus]check_ttl.
+        return patch('systemimage.api.time.monotonic',
+                     return_value=time.monotonic() + 3600)
+
+    @configuration
+    def test_cached(self):
+        # Within [dbus]check_ttl, the result is reused without asking the
+        # server, even if its files have changed.
+        self._setup_server_keyrings()
+        mediator = Mediator()
+        update_1 = mediator.check_for_update()
+        self.assertTrue(mediator.is_cached())
+        self._change_index()
+        with patch('systemimage.api.Mediator._revalidate') as revalidate:
+            update_2 = mediator.check_for_update()
+        self.assertIs(update_1, update_2)
+        self.assertFalse(revalidate.called)
+
+    @configuration
+    def test_revalidated(self):
+        # After [dbus]check_ttl, the result is still reused if the server's
+        # files haven't changed.
+        self._setup_server_keyrings()
+        mediator = Mediator()
+        update_1 = mediator.check_for_update()
+        with self._later(), \
+             patch('systemimage.api.State') as state:
+            update_2 = mediator.check_for_update()
+        self.assertIs(update_1, update_2)
+        self.assertFalse(state.called)
+        self.assertTrue(mediator.is_cached())
+
+    @configuration
+    def test_revalidate_signatures(self):
+        # Only the signatures are requested when revalidating, so a changed
+        # file is only downloaded by the full check.
+        self._setup_server_keyrings()
+        mediator = Mediator()
+        mediator.check_for_update()
+        downloader = mediator._state.downloader
+        with self._later(), \
+             patch.object(downloader, 'get_files',
+                          wraps=downloader.get_files) as get_files:
+            mediator.check_for_update()
+        self.assertEqual(get_files.call_count, 1)
+        self.assertEqual(
+            [record.url for record in get_files.call_args[0][0]], [
+                'https://localhost:8943/channels.json.asc',
+                'https://localhost:8943/stable/nexus7/index.json.asc',
+                ])
+
+    @configuration
+    def test_revalidated_modified(self):
+        # After [dbus]check_ttl, the update is checked again in full if the
+        # server's files have changed.
+        self._setup_server_keyrings()
+        mediator = Mediator()
+        update_1 = mediator.check_for_update()
+        self._change_index()
+        with self._later():
+            update_2 = mediator.check_for_update()
+        self.assertIsNot(update_1, update_2)
+        self.assertTrue(update_2.is_available)
+        self.assertEqual(update_2.size, 180009)
+
+    @configuration
+    def test_not_cached_after_download(self):
+        self._setup_server_keyrings()
+        mediator = Mediator()
+        mediator.check_for_update()
+        mediator.download()
+        self.assertFalse(mediator.is_cached())
+
+    @configuration
+    def test_not_cached_build_changed(self, config):
+        self._setup_server_keyrings()
+        mediator = Mediator()
+        mediator.check_for_update()
+        config.build_number = 1600
+        self.assertFalse(mediator.is_cached())
+
+    @configuration
+    def test_not_cached_error(self):
+        # Failed checks aren't reused.
+        self._setup_server_keyrings()
+        mediator = Mediator()
+        with patch('systemimage.state.State.run_until',
+                   side_effect=RuntimeError('boom')):
+            update = mediator.check_for_update()
+        self.assertEqual(update.error, 'boom')
+        self.assertFalse(mediator.is_cached())
+
+    @configuration
+    def test_disabled(self, config):
+        # A [dbus]check_ttl of zero disables reuse.
+        config.dbus.update(check_ttl='0s')
+        self._setup_server_keyrings()
+        mediator = Mediator()
+        mediator.check_for_update()
+        self.assertFalse(mediator.is_cached())
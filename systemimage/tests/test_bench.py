@@ -0,0 +1,187 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the fleet upgrade simulator."""
+
+__all__ = [
+    'TestBenchMain',
+    'TestHistogram',
+    'TestSimulate',
+    ]
+
+
+import os
+import json
+import unittest
+
+from contextlib import ExitStack
+from functools import partial
+from io import StringIO
+from pkg_resources import resource_filename
+from systemimage import helpers
+from systemimage.bench import (
+    Histogram, machine_ids, main, simulate, starting_builds)
+from systemimage.candidates import get_candidates
+from systemimage.config import Configuration
+from systemimage.helpers import MiB, phased_percentage, temporary_directory
+from systemimage.scores import WeightedScorer
+from systemimage.testing.helpers import get_index
+from systemimage.testing.synthetic import synthetic_index
+from unittest.mock import patch
+
+
+class TestHistogram(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(Histogram().summary(), dict(
+            count=0, total=0.0, mean=0.0, maximum=0.0, buckets=[]))
+
+    def test_buckets(self):
+        histogram = Histogram()
+        # Bucket limits are powers of two microseconds.
+        for seconds in (0.0, 0.000001, 0.000003, 0.000004, 0.000010, 0.5):
+            histogram.add(seconds)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 6)
+        self.assertAlmostEqual(summary['total'], 0.500018)
+        self.assertAlmostEqual(summary['mean'], 0.500018 / 6)
+        self.assertEqual(summary['maximum'], 0.5)
+        self.assertEqual(summary['buckets'], [
+            (1, 1), (2, 1), (4, 1), (8, 1), (16, 1), (1 << 19, 1)])
+
+
+class TestSimulate(unittest.TestCase):
+    def test_machine_ids(self):
+        machines = machine_ids(50, seed=3)
+        self.assertEqual(len(set(machines)), 50)
+        for machine_id in machines:
+            self.assertRegex(machine_id, '^[0-9a-f]{32}$')
+        # The same seed gives the same population.
+        self.assertEqual(machine_ids(50, seed=3), machines)
+        self.assertNotEqual(machine_ids(50, seed=4), machines)
+
+    def test_starting_builds(self):
+        index = get_index('index.index_04.json')
+        self.assertEqual(starting_builds(index),
+                         [0, 1100, 1200, 1201, 1300, 1301, 1303, 1304])
+
+    def test_simulate(self):
+        index = get_index('index.index_04.json')
+        builds = starting_builds(index)
+        report = simulate(
+            index, builds, machine_ids(10), 'stable', WeightedScorer())
+        self.assertEqual(
+            [result['build'] for result in report['builds']], builds)
+        for result in report['builds']:
+            self.assertEqual(result['paths'],
+                             len(get_candidates(index, result['build'])))
+        # None of these images are phased, so every device chooses the same
+        # path.
+        self.assertEqual(report['builds'][0]['winners'], [dict(
+            path=['1200', '1200-1201', '1201-1304'],
+            size=1000 * MiB,
+            machines=10)])
+        # Only the files up to the first reboot are downloaded.
+        self.assertEqual(report['builds'][4]['winners'], [dict(
+            path=['1300-1301', '1301-1304'],
+            size=300 * MiB,
+            machines=10)])
+        self.assertEqual(report['builds'][-1]['winners'], [dict(
+            path=[], size=0, machines=10)])
+        timings = report['timings']
+        self.assertEqual(timings['candidates']['count'], len(builds))
+        self.assertEqual(timings['choose']['count'], 10 * len(builds))
+        # The report can be serialized.
+        self.assertEqual(json.loads(json.dumps(report))['builds'],
+                         report['builds'])
+
+    def test_phased(self):
+        # Only the devices whose phased percentage is within the newest
+        # build's get it.
+        index = synthetic_index(20, phased_percentage=30)
+        machines = machine_ids(100)
+        report = simulate(index, [15], machines, 'daily', WeightedScorer())
+        expected = 0
+        with temporary_directory() as tmpdir:
+            path = os.path.join(tmpdir, 'machine-id')
+            with patch('systemimage.helpers.UNIQUE_MACHINE_ID_FILES', [path]):
+                for machine_id in machines:
+                    with open(path, 'w', encoding='utf-8') as fp:
+                        fp.write(machine_id)
+                    if phased_percentage('daily', 20) <= 30:
+                        expected += 1
+        self.assertGreater(expected, 0)
+        self.assertEqual(
+            sorted((winner['path'], winner['machines'])
+                   for winner in report['builds'][0]['winners']),
+            [([], 100 - expected),
+             (['15-16', '16-17', '17-18', '18-19', '19-20'], expected)])
+        # The real machine ids are left alone.
+        self.assertEqual(helpers.UNIQUE_MACHINE_ID_FILES,
+                         ['/var/lib/dbus/machine-id', '/etc/machine-id'])
+
+
+class TestBenchMain(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        self._stdout = StringIO()
+        self._stderr = StringIO()
+        self._resources.enter_context(
+            patch('builtins.print', partial(print, file=self._stdout)))
+        self._resources.enter_context(
+            patch('argparse._sys.stderr', self._stderr))
+        # A fresh global Configuration object, as the script would see.
+        self._resources.enter_context(
+            patch('systemimage.config._config', Configuration()))
+
+    def _main(self, *args):
+        with patch('systemimage.bench.sys.argv', ['argv0'] + list(args)):
+            return main()
+
+    def test_index_file(self):
+        path = resource_filename('systemimage.tests.data',
+                                 'index.index_04.json')
+        self.assertEqual(
+            self._main('--machines', '3', '--build', '1300', path), 0)
+        self.assertEqual(self._stdout.getvalue().splitlines()[:2], [
+            '    1300        1 paths',
+            '                   100.0% 1300-1301:1301-1304 (300.0 MiB)',
+            ])
+        self.assertIn('candidates: 1 calls', self._stdout.getvalue())
+        self.assertIn('choose: 3 calls', self._stdout.getvalue())
+
+    def test_synthetic_json(self):
+        self.assertEqual(self._main(
+            '--synthetic', '30', '--fork', '2', '--fork-every', '5',
+            '--machines', '4', '--json'), 0)
+        report = json.loads(self._stdout.getvalue())
+        index = synthetic_index(30, fork=2, fork_every=5)
+        self.assertEqual([result['build'] for result in report['builds']],
+                         starting_builds(index))
+        for result in report['builds']:
+            self.assertEqual(
+                sum(winner['machines'] for winner in result['winners']), 4)
+        self.assertEqual(report['timings']['choose']['count'],
+                         4 * len(report['builds']))
+
+    def test_index_or_synthetic(self):
+        with self.assertRaises(SystemExit) as cm:
+            self._main()
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn('Give either an index file or --synthetic',
+                      self._stderr.getvalue())
+        with self.assertRaises(SystemExit):
+            self._main('--synthetic', '10', 'index.json')
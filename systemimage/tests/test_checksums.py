@@ -0,0 +1,122 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the persistent record of file checksums."""
+
+__all__ = [
+    'TestChecksumCache',
+    ]
+
+
+import os
+import json
+
+from hashlib import sha256
+from systemimage.checksums import ChecksumCache
+from systemimage.config import config
+from systemimage.testing.helpers import (
+    TemporaryDirectoryTestBase, configuration, write_file)
+from unittest.mock import patch
+
+
+class TestChecksumCache(TemporaryDirectoryTestBase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.tmpdir, 'data.bin')
+        write_file(self.path, b'abc')
+        self.checksum = sha256(b'abc').hexdigest()
+
+    @configuration
+    def test_default_path(self):
+        self.assertEqual(
+            ChecksumCache().path,
+            os.path.join(config.updater.data_partition, 'checksums.json'))
+
+    @configuration
+    def test_checksum(self):
+        # The first time, the file is read.  After that, it isn't.
+        cache = ChecksumCache()
+        self.assertIsNone(cache.get(self.path))
+        self.assertEqual(cache.checksum(self.path), self.checksum)
+        with patch('systemimage.checksums.calculate_signature') as mock:
+            self.assertEqual(
+                ChecksumCache().checksum(self.path), self.checksum)
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_put(self):
+        # Recording a checksum doesn't read the file.
+        with patch('systemimage.checksums.calculate_signature') as mock:
+            ChecksumCache().put(self.path, 'xyz')
+        self.assertFalse(mock.called)
+        self.assertEqual(ChecksumCache().get(self.path), 'xyz')
+
+    @configuration
+    def test_modified(self):
+        # A file which changed since its checksum was recorded is read again.
+        ChecksumCache().put(self.path, self.checksum)
+        write_file(self.path, b'abcd')
+        cache = ChecksumCache()
+        self.assertIsNone(cache.get(self.path))
+        self.assertEqual(
+            cache.checksum(self.path), sha256(b'abcd').hexdigest())
+
+    @configuration
+    def test_modification_time(self):
+        ChecksumCache().put(self.path, self.checksum)
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        self.assertIsNone(ChecksumCache().get(self.path))
+
+    @configuration
+    def test_replaced(self):
+        # A file which was replaced by another has a different inode.
+        ChecksumCache().put(self.path, self.checksum)
+        other = os.path.join(self.tmpdir, 'other.bin')
+        write_file(other, b'xyz')
+        stat = os.stat(self.path)
+        os.utime(other, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.rename(other, self.path)
+        self.assertIsNone(ChecksumCache().get(self.path))
+
+    @configuration
+    def test_missing_file(self):
+        cache = ChecksumCache()
+        cache.put(self.path, self.checksum)
+        os.remove(self.path)
+        self.assertIsNone(cache.get(self.path))
+
+    @configuration
+    def test_forget_missing_files(self):
+        # Files which are gone are forgotten the next time a checksum is
+        # recorded.
+        cache = ChecksumCache()
+        cache.put(self.path, self.checksum)
+        os.remove(self.path)
+        other = os.path.join(self.tmpdir, 'other.bin')
+        write_file(other, b'xyz')
+        cache.update([(other, sha256(b'xyz').hexdigest())])
+        with open(cache.path, encoding='utf-8') as fp:
+            self.assertEqual(list(json.load(fp)), [other])
+
+    @configuration
+    def test_unreadable(self):
+        cache = ChecksumCache()
+        os.makedirs(os.path.dirname(cache.path), exist_ok=True)
+        with open(cache.path, 'w', encoding='utf-8') as fp:
+            fp.write('garbage')
+        self.assertIsNone(cache.get(self.path))
+        self.assertEqual(cache.checksum(self.path), self.checksum)
+        self.assertEqual(ChecksumCache().get(self.path), self.checksum)
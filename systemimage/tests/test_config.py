@@ -29,6 +29,8 @@ import unittest
 
 from contextlib import ExitStack, contextmanager
 from datetime import timedelta
+from hashlib import md5
+from io import StringIO
 from subprocess import CalledProcessError, check_output
 from systemimage.apply import Reboot
 from systemimage.config import Configuration
@@ -61,6 +63,7 @@ class TestConfiguration(unittest.TestCase):
         self.assertEqual(config.https_base, 'https://system-image.ubports.com')
         self.assertEqual(config.service.channel, 'daily')
         self.assertEqual(config.service.build_number, 0)
+        self.assertFalse(config.service.delta_indexes)
         # [system]
         self.assertEqual(config.system.tempdir, '/tmp')
         self.assertEqual(config.system.logfile,
@@ -69,6 +72,14 @@ class TestConfiguration(unittest.TestCase):
                          (logging.INFO, logging.ERROR))
         self.assertEqual(config.system.settings_db,
                          '/var/lib/system-image/settings.db')
+        self.assertEqual(config.system.segments, 1)
+        self.assertEqual(config.system.segment_size, 16 * 1024 * 1024)
+        self.assertFalse(config.system.prefetch)
+        self.assertEqual(config.system.downloader, 'auto')
+        self.assertEqual(config.system.progress_interval,
+                         timedelta(seconds=0.5))
+        self.assertEqual(config.system.progress_step, 0)
+        self.assertEqual(config.system.payload_cache_size, 1024 * 1024 * 1024)
         # [hooks]
         self.assertEqual(config.hooks.device, SystemProperty)
         self.assertEqual(config.hooks.scorer, WeightedScorer)
@@ -90,8 +101,10 @@ class TestConfiguration(unittest.TestCase):
                          '/android/cache/recovery')
         self.assertEqual(config.updater.data_partition,
                          '/var/lib/system-image')
+        self.assertEqual(config.updater.payload_cache, '')
         # [dbus]
         self.assertEqual(config.dbus.lifetime.total_seconds(), 600)
+        self.assertEqual(config.dbus.check_ttl, timedelta(minutes=1))
 
     @configuration('config.config_01.ini')
     def test_basic_config_d(self, config):
@@ -318,6 +331,45 @@ class TestConfiguration(unittest.TestCase):
         self.assertEqual(config.service.base, 'systum-imaje.ubuntu.com')
         self.assertEqual(config.dbus.lifetime, timedelta(hours=1))
 
+    @configuration('00.ini', 'config.config_12.ini')
+    def test_segments(self, config):
+        # Large files can be downloaded in segments.
+        self.assertEqual(config.system.segments, 4)
+        self.assertEqual(config.system.segment_size, 8 * 1024 * 1024)
+
+    @configuration('00.ini', 'config.config_13.ini')
+    def test_prefetch(self, config):
+        # Metadata files can be prefetched.
+        self.assertTrue(config.system.prefetch)
+
+    @configuration('00.ini', 'config.config_14.ini')
+    def test_downloader(self, config):
+        # The download manager can be chosen.
+        self.assertEqual(config.system.downloader, 'asyncio')
+
+    @configuration('00.ini', 'config.config_15.ini')
+    def test_progress(self, config):
+        # How often download progress is reported can be configured.
+        self.assertEqual(config.system.progress_interval, timedelta(seconds=2))
+        self.assertEqual(config.system.progress_step, 5)
+
+    @configuration('00.ini', 'config.config_16.ini')
+    def test_check_ttl(self, config):
+        # How long the D-Bus service reuses a check can be configured.
+        self.assertEqual(config.dbus.check_ttl, timedelta(seconds=30))
+
+    @configuration('00.ini', 'config.config_17.ini')
+    def test_delta_indexes(self, config):
+        # Whether the server publishes delta indexes can be configured.
+        self.assertTrue(config.service.delta_indexes)
+
+    @configuration('00.ini', 'config.config_18.ini')
+    def test_payload_cache(self, config):
+        # The payload cache can be kept elsewhere, e.g. on the same file
+        # system as the cache partition.
+        self.assertEqual(config.updater.payload_cache,
+                         '/android/cache/payload-cache')
+
     @configuration
     def test_tempdir(self, config):
         # config.tempdir is randomly created.
@@ -402,3 +454,23 @@ class TestConfiguration(unittest.TestCase):
             config.user_agent,
             'Ubuntu System Image Upgrade Client: '
             'device=geddyboard;channel=devel-trio;build=2112')
+
+    def test_instance_id(self):
+        # The instance id is the first half of the md5 hash of the device's
+        # serial number.  The serial number is only looked up when the
+        # instance id is needed, only once, and without printing it.
+        with ExitStack() as resources:
+            check_output = resources.enter_context(patch(
+                'systemimage.deviceStats.subprocess.check_output',
+                return_value=b'0123456789'))
+            resources.enter_context(patch(
+                'systemimage.deviceStats.noDeviceStats', return_value=False))
+            stdout = resources.enter_context(
+                patch('sys.stdout', new_callable=StringIO))
+            config = Configuration()
+            self.assertFalse(check_output.called)
+            instance = md5(b'0123456789').hexdigest()[:16]
+            self.assertEqual(config.instance, instance)
+            self.assertEqual(config.instance, instance)
+        self.assertEqual(check_output.call_count, 1)
+        self.assertEqual(stdout.getvalue(), '')
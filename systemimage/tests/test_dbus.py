@@ -448,6 +448,11 @@ class _LiveTesting(_TestBase):
                 pass
             for filename in all_files:
                 safe_remove(os.path.join(updater_dir, filename))
+        # The cached update files would otherwise be used instead of
+        # downloading them in the next test.
+        shutil.rmtree(
+            os.path.join(self.config.updater.data_partition, 'payload-cache'),
+            ignore_errors=True)
         # Since the controller re-uses the same config_d directory, clear out
         # any touched config files that aren't the default.
         for ini_file in os.listdir(self.config.config_d):
@@ -545,6 +550,20 @@ class TestDBusCheckForUpdate(_LiveTesting):
         self.assertTrue(signal.is_available, msg=signal.error_reason)
         self.assertTrue(signal.downloading)
 
+    def test_timings(self):
+        # The cost of each step of the update check is available.
+        self.download_manually()
+        self.assertEqual(json.loads(self.iface.GetTimings())['steps'], [])
+        reactor = SignalCapturingReactor('UpdateAvailableStatus')
+        reactor.run(self.iface.CheckForUpdate)
+        timings = json.loads(self.iface.GetTimings())
+        steps = [step['step'] for step in timings['steps']]
+        self.assertEqual(steps[0], 'cleanup')
+        self.assertEqual(steps[-1], 'calculate_winner')
+        self.assertIn('get_index', steps)
+        self.assertGreater(timings['total']['bytes'], 0)
+        self.assertGreater(timings['total']['gpg'], 0)
+
 
 class TestDBusDownload(_LiveTesting):
     def test_auto_download(self):
@@ -1722,10 +1741,11 @@ class TestDBusProgress(_LiveTesting):
         reactor = ProgressRecordingReactor()
         reactor.schedule(self.iface.DownloadUpdate)
         reactor.run()
-        # The only progress we can count on is the first and last ones.  All
-        # will have an eta of 0, since that value is not calculable right now.
-        # The first progress will have percentage 0 and the last will have
-        # percentage 100.
+        # The only progress we can count on is the first and last ones.  The
+        # first progress will have percentage 0 and the last will have
+        # percentage 100.  Both will have an eta of 0, since nothing is known
+        # about the transfer rate at the start, and nothing remains at the
+        # end.
         self.assertGreaterEqual(len(reactor.progress), 2)
         percentage, eta = reactor.progress[0]
         self.assertEqual(percentage, 0)
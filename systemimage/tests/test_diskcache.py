@@ -0,0 +1,106 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the least recently used cache of files."""
+
+__all__ = [
+    'TestDiskCache',
+    ]
+
+
+import os
+
+from systemimage.config import config
+from systemimage.diskcache import DiskCache
+from systemimage.testing.helpers import (
+    TemporaryDirectoryTestBase, configuration, write_file)
+
+
+class _Cache(DiskCache):
+    suffixes = ('.data', '.done')
+    name = 'test-cache'
+
+
+class TestDiskCache(TemporaryDirectoryTestBase):
+    def _put(self, cache, key, mtime, contents=b''):
+        data_path, done_path = cache.paths(key)
+        write_file(data_path, contents)
+        write_file(done_path, b'')
+        os.utime(done_path, (mtime, mtime))
+
+    def _keys(self, cache):
+        return sorted(name[:-len('.done')]
+                      for name in os.listdir(cache.directory)
+                      if name.endswith('.done'))
+
+    @configuration
+    def test_default_directory(self):
+        self.assertEqual(
+            _Cache().directory,
+            os.path.join(config.updater.data_partition, 'test-cache'))
+
+    def test_paths(self):
+        cache = _Cache(self.tmpdir)
+        self.assertEqual(cache.paths('a'), [
+            os.path.join(self.tmpdir, 'a.data'),
+            os.path.join(self.tmpdir, 'a.done'),
+            ])
+        self.assertEqual(cache.paths('a', 'other'), [
+            os.path.join('other', 'a.data'),
+            os.path.join('other', 'a.done'),
+            ])
+
+    def test_is_complete(self):
+        cache = _Cache(self.tmpdir)
+        self.assertFalse(cache.is_complete('a'))
+        write_file(cache.paths('a')[0], b'')
+        self.assertFalse(cache.is_complete('a'))
+        self._put(cache, 'a', 100)
+        self.assertTrue(cache.is_complete('a'))
+        cache.discard('a')
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        # Discarding a missing entry is fine.
+        cache.discard('a')
+
+    def test_evict_max_entries(self):
+        cache = _Cache(self.tmpdir, max_entries=2)
+        for i, key in enumerate('abc'):
+            self._put(cache, key, 100 + i)
+        cache.touch('a')
+        cache.evict()
+        self.assertEqual(self._keys(cache), ['a', 'c'])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['a.data', 'a.done', 'c.data', 'c.done'])
+
+    def test_evict_max_size(self):
+        # The newest entries are kept while they fit.
+        cache = _Cache(self.tmpdir, max_size=25)
+        for i, key in enumerate('abc'):
+            self._put(cache, key, 100 + i, b'x' * 10)
+        cache.evict()
+        self.assertEqual(self._keys(cache), ['b', 'c'])
+
+    def test_unreadable_size(self):
+        class Cache(_Cache):
+            def entry_size(self, key, directory):
+                if key == 'b':
+                    raise ValueError
+                return super().entry_size(key, directory)
+        cache = Cache(self.tmpdir, max_size=100)
+        for i, key in enumerate('abc'):
+            self._put(cache, key, 100 + i)
+        cache.evict()
+        self.assertEqual(self._keys(cache), ['a', 'c'])
+        self.assertFalse(os.path.exists(cache.paths('b')[0]))
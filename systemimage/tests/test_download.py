@@ -16,7 +16,13 @@
 """Test asynchronous downloads."""
 
 __all__ = [
+    'TestAsyncioDownload',
+    'TestAsyncioDownloads',
+    'TestAsyncioHTTPSDownloads',
     'TestCURL',
+    'TestCompletionCallbacks',
+    'TestConditionalDownloads',
+    'TestCurlProgress',
     'TestDownload',
     'TestDownloadBigFiles',
     'TestDownloadManagerFactory',
@@ -26,28 +32,44 @@ __all__ = [
     'TestHTTPSDownloadsExpired',
     'TestHTTPSDownloadsNasty',
     'TestHTTPSDownloadsNoSelfSigned',
+    'TestETA',
+    'TestPrefetch',
+    'TestProgress',
     'TestRecord',
+    'TestResumableDownloads',
+    'TestSegmentedDownloadBenchmark',
+    'TestSegmentedDownloads',
+    'TestSizedDownloads',
     ]
 
 
 import os
+import ssl
+import sys
+import json
+import time
 import random
+import asyncio
 import unittest
 
 from contextlib import ExitStack
 from dbus.exceptions import DBusException
 from hashlib import sha256
 from systemimage.config import Configuration, config
-from systemimage.curl import CurlDownloadManager
+from systemimage.curl import (
+    CurlDownloadManager, SegmentedDownload, SingleDownload)
 from systemimage.download import (
-    Canceled, DuplicateDestinationError, Record, get_download_manager)
-from systemimage.helpers import temporary_directory
+    ETA, Canceled, DownloadManagerBase, DuplicateDestinationError, Record,
+    get_cached_path, get_download_manager, get_journal, get_validators)
+from systemimage.helpers import safe_remove, temporary_directory
 from systemimage.settings import Settings
 from systemimage.testing.controller import USING_PYCURL
 from systemimage.testing.helpers import (
-    configuration, data_path, make_http_server, reset_envar, write_bytes)
+    configuration, data_path, make_http_server, reset_envar,
+    skip_unless_benchmark, write_bytes)
 from systemimage.testing.nose import SystemImagePlugin
 from systemimage.udm import DOWNLOADER_INTERFACE, UDMDownloadManager
+from threading import Timer
 from unittest.mock import patch
 from urllib.parse import urljoin
 
@@ -168,6 +190,61 @@ class TestDownload(unittest.TestCase):
         # The file still got downloaded.
         self.assertEqual(os.listdir(config.tempdir), ['channels.json'])
 
+    @configuration
+    def test_completion_callbacks(self):
+        # Each file is completed exactly once, and by then, it's all there.
+        completed = []
+        def callback(record):
+            completed.append((os.path.basename(record.destination),
+                              os.path.getsize(record.destination)))
+        downloader = self._downloader()
+        downloader.completion_callbacks.append(callback)
+        downloader.get_files(_http_pathify([
+            ('channel.channels_05.json', 'channels.json'),
+            ('download.index_01.json', 'index.json'),
+            ]))
+        self.assertEqual(sorted(completed), [
+            ('channels.json', os.path.getsize(
+                data_path('channel.channels_05.json'))),
+            ('index.json', os.path.getsize(
+                data_path('download.index_01.json'))),
+            ])
+
+    @configuration
+    def test_bytes_received(self):
+        # The downloader keeps a running count of the bytes received.
+        downloader = self._downloader()
+        self.assertEqual(downloader.bytes_received, 0)
+        downloader.get_files(_http_pathify([
+            ('channel.channels_05.json', 'channels.json'),
+            ]))
+        size = os.path.getsize(data_path('channel.channels_05.json'))
+        self.assertEqual(downloader.bytes_received, size)
+        downloader.get_files(_http_pathify([
+            ('download.index_01.json', 'index.json'),
+            ]))
+        self.assertEqual(
+            downloader.bytes_received,
+            size + os.path.getsize(data_path('download.index_01.json')))
+
+    @configuration
+    def test_broken_completion_callback(self):
+        # If the callback raises an exception, it is logged and ignored.
+        def callback(record):
+            raise RuntimeError
+        exception = None
+        def capture(message):
+            nonlocal exception
+            exception = message
+        downloader = self._downloader()
+        downloader.completion_callbacks.append(callback)
+        with patch('systemimage.download.log.exception', capture):
+            downloader.get_files(_http_pathify([
+                ('channel.channels_05.json', 'channels.json'),
+                ]))
+        self.assertEqual(exception, 'Exception in completion callback')
+        self.assertEqual(os.listdir(config.tempdir), ['channels.json'])
+
     # This test helps bump the udm-based downloader test coverage to 100%.
     @unittest.skipIf(USING_PYCURL, 'Test is not relevant for PyCURL')
     @configuration
@@ -441,9 +518,24 @@ class TestRecord(unittest.TestCase):
         # At least two arguments must be given.
         self.assertRaises(TypeError, Record, 'src')
 
+    def test_record_cached(self):
+        # The path to a cached copy is optional, and defaults to None.
+        record = Record('src', 'dst')
+        self.assertIsNone(record.cached)
+        record = Record('src', 'dst', cached='cache')
+        self.assertEqual(record.cached, 'cache')
+
+    def test_record_size(self):
+        # The expected size is optional, and defaults to None.
+        record = Record('src', 'dst')
+        self.assertIsNone(record.size)
+        record = Record('src', 'dst', size=10)
+        self.assertEqual(record.size, 10)
+
     def test_too_many_arguments(self):
-        # No more than three arguments may be given.
-        self.assertRaises(TypeError, Record, 'src', 'dst', 'hash', 'foo')
+        # No more than five arguments may be given.
+        self.assertRaises(
+            TypeError, Record, 'src', 'dst', 'hash', 'cache', 10, 'foo')
 
 
 class TestDuplicateDownloads(unittest.TestCase):
@@ -641,6 +733,1090 @@ class TestCURL(unittest.TestCase):
             'http://localhost:8980/(channel.channels_05|index_01).json')
 
 
+@unittest.skipUnless(USING_PYCURL, 'Conditional requests need PyCURL')
+class TestConditionalDownloads(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        try:
+            self._serverdir = self._resources.enter_context(
+                temporary_directory())
+            self._resources.push(make_http_server(self._serverdir, 8980))
+        except:
+            self._resources.close()
+            raise
+
+    def tearDown(self):
+        self._resources.close()
+        super().tearDown()
+
+    def _write(self, contents):
+        with open(os.path.join(self._serverdir, 'source.dat'), 'wb') as fp:
+            fp.write(contents)
+
+    def _get(self):
+        url = urljoin(config.http_base, 'source.dat')
+        dst = os.path.join(config.tempdir, 'local.dat')
+        safe_remove(dst)
+        downloads = [Record(url, dst, cached=get_cached_path(url))]
+        downloader = CurlDownloadManager()
+        downloader.get_files(downloads)
+        with open(dst, 'rb') as fp:
+            contents = fp.read()
+        return downloader, downloads, contents
+
+    @configuration
+    def test_cached_path(self):
+        # Cached copies live in the data partition, and different urls with
+        # the same base name get different paths.
+        path_1 = get_cached_path('http://example.com/a/index.json')
+        path_2 = get_cached_path('http://example.com/b/index.json')
+        self.assertNotEqual(path_1, path_2)
+        self.assertEqual(os.path.basename(path_1)[-11:], '-index.json')
+        self.assertEqual(
+            os.path.dirname(path_1),
+            os.path.join(config.updater.data_partition, 'metadata'))
+
+    @configuration
+    def test_not_modified(self):
+        # Once a download has been verified and cached, the server is asked
+        # whether it's been modified, and if not, the cached copy is used.
+        self._write(b'abc')
+        downloader, downloads, contents = self._get()
+        self.assertEqual(contents, b'abc')
+        self.assertEqual(downloader.not_modified, set())
+        self.assertFalse(downloader.is_verified(downloads, 'keys'))
+        downloader.cache_verified(downloads, 'keys')
+        validators = get_validators(downloads[0].cached)
+        self.assertEqual(validators['url'], downloads[0].url)
+        self.assertEqual(validators['fingerprint'], 'keys')
+        self.assertIn('etag', validators)
+        downloader, downloads, contents = self._get()
+        self.assertEqual(contents, b'abc')
+        self.assertEqual(downloader.not_modified, {downloads[0].destination})
+        self.assertTrue(downloader.is_verified(downloads, 'keys'))
+        # But the cached copy was verified with different keys.
+        self.assertFalse(downloader.is_verified(downloads, 'other keys'))
+
+    @configuration
+    def test_modified(self):
+        # When the file on the server changes, it gets downloaded again.
+        self._write(b'abc')
+        downloader, downloads, contents = self._get()
+        downloader.cache_verified(downloads, 'keys')
+        self._write(b'xyz')
+        downloader, downloads, contents = self._get()
+        self.assertEqual(contents, b'xyz')
+        self.assertEqual(downloader.not_modified, set())
+        self.assertFalse(downloader.is_verified(downloads, 'keys'))
+
+    @configuration
+    def test_not_verified(self):
+        # A download which was never verified is never cached, so it's always
+        # downloaded again.
+        self._write(b'abc')
+        downloader, downloads, contents = self._get()
+        downloader, downloads, contents = self._get()
+        self.assertEqual(contents, b'abc')
+        self.assertEqual(downloader.not_modified, set())
+        self.assertIsNone(get_validators(downloads[0].cached))
+
+    @configuration
+    def test_checksum_of_cached_copy(self):
+        # The checksum of a file which isn't modified is that of the cached
+        # copy.
+        self._write(b'abc')
+        downloader, downloads, contents = self._get()
+        downloader.cache_verified(downloads, 'keys')
+        url, dst, checksum, cached, size = downloads[0]
+        downloads = [Record(url, dst, sha256(b'abc').hexdigest(), cached)]
+        safe_remove(dst)
+        downloader = CurlDownloadManager()
+        downloader.get_files(downloads)
+        self.assertEqual(downloader.not_modified, {dst})
+        downloads = [Record(url, dst, sha256(b'xyz').hexdigest(), cached)]
+        safe_remove(dst)
+        self.assertRaises(FileNotFoundError,
+                          CurlDownloadManager().get_files, downloads)
+
+
+class TestETA(unittest.TestCase):
+    def test_no_estimate(self):
+        # Nothing is known about the transfer rate from the first report.
+        self.assertEqual(ETA().update(0, 1000, now=10.0), 0)
+
+    def test_estimate(self):
+        eta = ETA(smoothing=0.5)
+        eta.update(0, 1000, now=10.0)
+        # 100 bytes per second, with 900 bytes to go.
+        self.assertEqual(eta.update(100, 1000, now=11.0), 9.0)
+        # The rate jumps to 300 bytes per second, but the smoothed rate is
+        # only 200 bytes per second.
+        self.assertEqual(eta.update(400, 1000, now=12.0), 3.0)
+
+    def test_done(self):
+        eta = ETA()
+        eta.update(0, 1000, now=10.0)
+        self.assertEqual(eta.update(1000, 1000, now=11.0), 0)
+
+    def test_stalled(self):
+        # Nothing has arrived yet, so there is no reasonable estimate.
+        eta = ETA()
+        eta.update(0, 1000, now=10.0)
+        self.assertEqual(eta.update(0, 1000, now=11.0), 0)
+
+    def test_new_download(self):
+        # When the received bytes go down, a new download has started, and
+        # the previous rate is forgotten.
+        eta = ETA(smoothing=0.5)
+        eta.update(0, 1000, now=10.0)
+        eta.update(900, 1000, now=11.0)
+        self.assertEqual(eta.update(0, 2000, now=12.0), 0)
+        self.assertEqual(eta.update(100, 2000, now=13.0), 19.0)
+
+    def test_reset(self):
+        eta = ETA()
+        eta.update(0, 1000, now=10.0)
+        eta.update(100, 1000, now=11.0)
+        eta.reset()
+        # E.g. the download was paused for a long time.
+        self.assertEqual(eta.update(100, 1000, now=100.0), 0)
+        self.assertEqual(eta.update(200, 1000, now=101.0), 8.0)
+
+
+class TestProgress(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.reports = []
+        self.downloader = DownloadManagerBase()
+        self.downloader.callbacks.append(
+            lambda received, total: self.reports.append((received, total)))
+        self.downloader.total = 1000
+        self._now = 0.0
+        self._resources = ExitStack()
+        self._resources.enter_context(patch(
+            'systemimage.download.time.monotonic', lambda: self._now))
+
+    def tearDown(self):
+        self._resources.close()
+        super().tearDown()
+
+    def _receive(self, received, now):
+        self._now = now
+        self.downloader.received = received
+        self.downloader._do_callback()
+
+    @configuration
+    def test_interval(self):
+        # Progress is reported at most once per interval.
+        config.system.update(progress_interval='1s')
+        self.downloader._start_progress()
+        self._receive(10, 0.0)
+        self._receive(20, 0.5)
+        self._receive(30, 1.0)
+        self._receive(40, 1.5)
+        self._receive(50, 1.75)
+        self.assertEqual(self.reports, [(10, 1000), (30, 1000)])
+        # The final progress is always reported.
+        self._now = 1.8
+        self.downloader._do_callback(force=True)
+        self.assertEqual(self.reports[-1], (50, 1000))
+
+    @configuration
+    def test_step(self):
+        # Progress is only reported once enough of it has been made.
+        config.system.update(progress_interval='0s', progress_step='10')
+        self.downloader._start_progress()
+        self._receive(10, 0.0)
+        self._receive(50, 1.0)
+        self._receive(110, 2.0)
+        self._receive(150, 3.0)
+        self._receive(220, 4.0)
+        self.assertEqual(self.reports, [(10, 1000), (110, 1000), (220, 1000)])
+
+    @configuration
+    def test_unknown_total(self):
+        # Without a total, there's no percentage to step by.
+        config.system.update(progress_interval='0s', progress_step='10')
+        self.downloader.total = 0
+        self.downloader._start_progress()
+        self._receive(10, 0.0)
+        self._receive(11, 1.0)
+        self.assertEqual(self.reports, [(10, 0), (11, 0)])
+
+    @configuration
+    def test_forced_once(self):
+        # A forced report isn't repeated if nothing changed.
+        config.system.update(progress_interval='1h')
+        self.downloader._start_progress()
+        self._receive(1000, 0.0)
+        self.downloader._do_callback(force=True)
+        self.assertEqual(self.reports, [(1000, 1000)])
+
+    @configuration
+    def test_new_group(self):
+        # Each group download starts reporting afresh.
+        config.system.update(progress_interval='1h')
+        self.downloader._start_progress()
+        self._receive(10, 0.0)
+        self.downloader._start_progress()
+        self.assertEqual(self.downloader.received, 0)
+        self._receive(20, 1.0)
+        self.assertEqual(self.reports, [(10, 1000), (20, 1000)])
+
+
+@unittest.skipUnless(USING_PYCURL, 'PyCURL progress accounting')
+class TestCurlProgress(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        try:
+            self._serverdir = self._resources.enter_context(
+                temporary_directory())
+            # Every 64KiB chunk of a response is delayed by 10ms.
+            self._resources.push(
+                make_http_server(self._serverdir, 8980, latency=0.01))
+        except:
+            self._resources.close()
+            raise
+        write_bytes(os.path.join(self._serverdir, 'bigfile.dat'), 1)
+
+    def tearDown(self):
+        self._resources.close()
+        super().tearDown()
+
+    def _get(self):
+        received = []
+        def callback(bytes_received, total):
+            received.append((bytes_received, total))
+        CurlDownloadManager(callback).get_files([
+            Record(urljoin(config.http_base, 'bigfile.dat'),
+                   os.path.join(config.tempdir, 'bigfile.dat'),
+                   size=1024 * 1024),
+            ])
+        return received
+
+    @configuration
+    def test_counted_as_written(self):
+        # Each write is counted as it happens.
+        config.system.update(progress_interval='0s')
+        with patch.object(SingleDownload, 'write', autospec=True,
+                          side_effect=SingleDownload.write) as write:
+            received = self._get()
+        self.assertEqual(len(received), write.call_count)
+        self.assertEqual([size for size, total in received],
+                         sorted(set(size for size, total in received)))
+        self.assertEqual(received[-1], (1024 * 1024, 1024 * 1024))
+
+    @configuration
+    def test_throttled(self):
+        # With a long interval, only the first and the final progress are
+        # reported.
+        config.system.update(progress_interval='1h')
+        received = self._get()
+        self.assertEqual(len(received), 2)
+        self.assertEqual(received[-1], (1024 * 1024, 1024 * 1024))
+
+
+@unittest.skipUnless(USING_PYCURL, 'Sized records are a PyCURL feature')
+class TestSizedDownloads(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        try:
+            self._serverdir = self._resources.enter_context(
+                temporary_directory())
+            self._resources.push(make_http_server(self._serverdir, 8980))
+        except:
+            self._resources.close()
+            raise
+        for filename, size in (('a.dat', 1000), ('b.dat', 2000)):
+            with open(os.path.join(self._serverdir, filename), 'wb') as fp:
+                fp.write(b'x' * size)
+        with open(os.path.join(self._serverdir, 'a.dat.asc'), 'wb') as fp:
+            fp.write(b'y' * 10)
+
+    def tearDown(self):
+        self._resources.close()
+        super().tearDown()
+
+    def _get(self, downloads):
+        totals = []
+        def callback(received, total):
+            totals.append(total)
+        downloader = CurlDownloadManager(callback)
+        with patch.object(CurlDownloadManager, '_head',
+                          autospec=True, side_effect=CurlDownloadManager._head
+                          ) as head:
+            downloader.get_files(downloads)
+        return head.called, totals
+
+    def _record(self, filename, size=None):
+        return Record(urljoin(config.http_base, filename),
+                      os.path.join(config.tempdir, filename),
+                      size=size)
+
+    @configuration
+    def test_all_sized(self):
+        # When every record has its size, no HEAD requests are made.
+        headed, totals = self._get([
+            self._record('a.dat', 1000),
+            self._record('b.dat', 2000),
+            ])
+        self.assertFalse(headed)
+        self.assertEqual(set(totals), {3000})
+
+    @configuration
+    def test_none_sized(self):
+        # When no record has its size, the HEAD requests get the total.
+        headed, totals = self._get([
+            self._record('a.dat'),
+            self._record('b.dat'),
+            ])
+        self.assertTrue(headed)
+        self.assertEqual(totals[-1], 3000)
+
+    @configuration
+    def test_some_sized(self):
+        # The size of the signature file isn't known up front, so it is
+        # added to the total once the server responds.
+        headed, totals = self._get([
+            self._record('a.dat', 1000),
+            self._record('a.dat.asc'),
+            ])
+        self.assertFalse(headed)
+        self.assertEqual(totals[-1], 1010)
+
+
+@unittest.skipUnless(USING_PYCURL, 'Prefetching needs PyCURL')
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        try:
+            self._serverdir = self._resources.enter_context(
+                temporary_directory())
+            self._resources.push(make_http_server(self._serverdir, 8980))
+        except:
+            self._resources.close()
+            raise
+        for filename in ('a.dat', 'b.dat'):
+            with open(os.path.join(self._serverdir, filename), 'wb') as fp:
+                fp.write(filename.encode('ascii') * 10)
+
+    def tearDown(self):
+        self._resources.close()
+        super().tearDown()
+
+    def _url(self, filename):
+        return urljoin(config.http_base, filename)
+
+    def _record(self, filename):
+        url = self._url(filename)
+        return Record(url, os.path.join(config.tempdir, filename),
+                      cached=get_cached_path(url))
+
+    def _read(self, record):
+        with open(record.destination, 'rb') as fp:
+            return fp.read()
+
+    @configuration
+    def test_prefetch(self):
+        # Prefetched files are used instead of downloading them again.
+        downloader = CurlDownloadManager()
+        downloader.prefetch([self._url('a.dat'), self._url('b.dat')])
+        records = [self._record('a.dat'), self._record('b.dat')]
+        with patch.object(downloader, '_get_files') as mock:
+            downloader.get_files(records)
+        self.assertFalse(mock.called)
+        # The bytes were counted when they were prefetched.
+        self.assertEqual(downloader.bytes_received, 100)
+        self.assertEqual(self._read(records[0]), b'a.dat' * 10)
+        self.assertEqual(self._read(records[1]), b'b.dat' * 10)
+        # What the server said about them is kept too.
+        self.assertIn('last-modified', downloader.validators[
+            records[0].destination])
+        self.assertEqual(set(os.listdir(config.tempdir)),
+                         {'a.dat', 'b.dat'})
+
+    @configuration
+    def test_missing_files_are_ignored(self):
+        # Files which can't be prefetched are downloaded as usual.
+        downloader = CurlDownloadManager()
+        downloader.prefetch([self._url('a.dat'), self._url('missing.dat')])
+        self.assertTrue(downloader.is_prefetched(self._url('a.dat')))
+        self.assertFalse(downloader.is_prefetched(self._url('missing.dat')))
+        records = [self._record('a.dat'), self._record('b.dat')]
+        with patch.object(downloader, '_get_files',
+                          wraps=downloader._get_files) as mock:
+            downloader.get_files(records)
+        self.assertEqual(mock.call_args[0][0], [records[1]])
+        # The prefetched file was used up.
+        self.assertFalse(downloader.is_prefetched(self._url('a.dat')))
+        self.assertEqual(self._read(records[1]), b'b.dat' * 10)
+        self.assertRaises(FileNotFoundError, downloader.get_files,
+                          [self._record('missing.dat')])
+
+    @configuration
+    def test_used_once(self):
+        downloader = CurlDownloadManager()
+        downloader.prefetch([self._url('a.dat')])
+        record = self._record('a.dat')
+        downloader.get_files([record])
+        os.remove(record.destination)
+        with patch.object(downloader, '_get_files') as mock:
+            downloader.get_files([record])
+        self.assertTrue(mock.called)
+
+    @configuration
+    def test_checksums_are_not_prefetched(self):
+        # Records with a checksum are always downloaded.
+        downloader = CurlDownloadManager()
+        downloader.prefetch([self._url('a.dat')])
+        record = self._record('a.dat')._replace(
+            checksum=sha256(b'a.dat' * 10).hexdigest())
+        with patch.object(downloader, '_get_files') as mock:
+            downloader.get_files([record])
+        self.assertTrue(mock.called)
+        self.assertEqual(os.listdir(config.tempdir), [])
+
+    @configuration
+    def test_discard(self):
+        downloader = CurlDownloadManager()
+        downloader.prefetch([self._url('a.dat'), self._url('b.dat')])
+        self.assertEqual(len(os.listdir(config.tempdir)), 2)
+        downloader.discard_prefetched()
+        self.assertEqual(os.listdir(config.tempdir), [])
+
+    @configuration
+    def test_failure_removes_prefetched_files(self):
+        # get_files() is still all or nothing.
+        downloader = CurlDownloadManager()
+        downloader.prefetch([self._url('a.dat')])
+        self.assertRaises(FileNotFoundError, downloader.get_files, [
+            self._record('a.dat'), self._record('missing.dat')])
+        self.assertEqual(os.listdir(config.tempdir), [])
+
+
+@unittest.skipUnless(USING_PYCURL, 'Resuming downloads needs PyCURL')
+class TestResumableDownloads(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        try:
+            self._serverdir = self._resources.enter_context(
+                temporary_directory())
+            self._resources.push(make_http_server(self._serverdir, 8980))
+        except:
+            self._resources.close()
+            raise
+        self._contents = bytes(random.randrange(256) for i in range(100000))
+        with open(os.path.join(self._serverdir, 'source.dat'), 'wb') as fp:
+            fp.write(self._contents)
+
+    def tearDown(self):
+        self._resources.close()
+        super().tearDown()
+
+    def _record(self, size=None):
+        return Record(urljoin(config.http_base, 'source.dat'),
+                      os.path.join(config.tempdir, 'local.dat'),
+                      sha256(self._contents).hexdigest(),
+                      size=size)
+
+    def _interrupt(self, record, partial, journaled, **journal):
+        # Leave behind what an interrupted download would have.
+        with open(record.destination, 'wb') as fp:
+            fp.write(partial)
+        contents = dict(url=record.url, checksum=record.checksum,
+                        bytes=journaled)
+        contents.update(journal)
+        with open(record.destination + '.journal', 'w') as fp:
+            json.dump(contents, fp)
+
+    def _read(self, record):
+        with open(record.destination, 'rb') as fp:
+            return fp.read()
+
+    @configuration
+    def test_resume(self):
+        # An interrupted download picks up where its journal says it left
+        # off, and its checksum covers the whole file.
+        record = self._record(len(self._contents))
+        self._interrupt(record, self._contents[:40000], 30000)
+        received = []
+        def callback(bytes_received, total):
+            received.append(bytes_received)
+        downloader = CurlDownloadManager(callback)
+        downloader.get_files([record])
+        self.assertEqual(self._read(record), self._contents)
+        self.assertEqual(os.listdir(config.tempdir), ['local.dat'])
+        self.assertEqual(downloader.checksums,
+                         {record.destination: record.checksum})
+        # The previously downloaded bytes count as received.
+        self.assertEqual([size for size in received if 0 < size < 30000], [])
+        self.assertEqual(received[-1], len(self._contents))
+
+    @configuration
+    def test_resumed_bytes_are_kept(self):
+        # Only the rest of the file is requested, so a corrupt partial file
+        # is caught by the checksum.  Then the download starts over.
+        record = self._record()
+        self._interrupt(record, b'x' * 30000, 30000)
+        with self.assertRaises(FileNotFoundError) as cm:
+            CurlDownloadManager().get_files([record])
+        self.assertEqual(cm.exception.args[0][:11], 'HASH ERROR:')
+        self.assertIsNone(get_journal(record))
+        CurlDownloadManager().get_files([record])
+        self.assertEqual(self._read(record), self._contents)
+
+    @configuration
+    def test_journal_mismatch(self):
+        # A partial file being downloaded with another checksum can't be
+        # resumed.
+        record = self._record()
+        self._interrupt(record, b'x' * 30000, 30000, checksum='abc')
+        self.assertIsNone(get_journal(record))
+        CurlDownloadManager().get_files([record])
+        self.assertEqual(self._read(record), self._contents)
+
+    @configuration
+    def test_complete_but_journaled(self):
+        # The journal says everything was downloaded, yet the download never
+        # finished.  There's nothing left for the server to send, so the
+        # partial file is complete as long as its checksum matches.
+        record = self._record()
+        self._interrupt(record, self._contents, len(self._contents))
+        CurlDownloadManager().get_files([record])
+        self.assertEqual(self._read(record), self._contents)
+        self.assertIsNone(get_journal(record))
+        # If the size is known, the download just starts over.
+        record = self._record(len(self._contents))
+        self._interrupt(record, b'x' * len(self._contents),
+                        len(self._contents))
+        CurlDownloadManager().get_files([record])
+        self.assertEqual(self._read(record), self._contents)
+
+    @configuration
+    def test_get_journal(self):
+        record = self._record()
+        self.assertIsNone(get_journal(record))
+        self._interrupt(record, b'x' * 100, 50)
+        self.assertEqual(get_journal(record)['bytes'], 50)
+        # Downloads without a checksum are never resumed.
+        self.assertIsNone(get_journal(record._replace(checksum='')))
+        # Nor those from another url.
+        self._interrupt(record, b'x' * 100, 50, url='http://example.com')
+        self.assertIsNone(get_journal(record))
+        # The journal can't vouch for bytes which aren't there.
+        self._interrupt(record, b'x' * 100, 101)
+        self.assertIsNone(get_journal(record))
+
+    @configuration
+    def test_cancel_keeps_partial_download(self):
+        # Canceling a download keeps what has been downloaded so far, and the
+        # download resumes from there.  Files without a checksum are removed.
+        write_bytes(os.path.join(self._serverdir, 'bigfile.dat'), 10)
+        with open(os.path.join(self._serverdir, 'bigfile.dat'), 'rb') as fp:
+            checksum = sha256(fp.read()).hexdigest()
+        downloads = [
+            Record(urljoin(config.http_base, 'bigfile.dat'),
+                   os.path.join(config.tempdir, 'bigfile.dat'),
+                   checksum, size=10 * 1024 * 1024),
+            Record(urljoin(config.http_base, 'source.dat'),
+                   os.path.join(config.tempdir, 'source.dat')),
+            ]
+        class Canceling(CurlDownloadManager):
+            def _do_once(self, multi, handles):
+                if os.path.getsize(downloads[0].destination) > 0:
+                    self.cancel()
+                return super()._do_once(multi, handles)
+        self.assertRaises(Canceled, Canceling().get_files, downloads)
+        self.assertEqual(os.listdir(config.tempdir),
+                         ['bigfile.dat', 'bigfile.dat.journal'])
+        journal = get_journal(downloads[0])
+        self.assertGreater(journal['bytes'], 0)
+        self.assertLess(journal['bytes'], 10 * 1024 * 1024)
+        CurlDownloadManager().get_files(downloads)
+        self.assertEqual(set(os.listdir(config.tempdir)),
+                         {'bigfile.dat', 'source.dat'})
+
+
+@unittest.skipUnless(USING_PYCURL, 'Segmented downloads need PyCURL')
+class TestSegmentedDownloads(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        try:
+            self._serverdir = self._resources.enter_context(
+                temporary_directory())
+            self._resources.push(make_http_server(self._serverdir, 8980))
+        except:
+            self._resources.close()
+            raise
+        self._contents = bytes(random.randrange(256) for i in range(500000))
+        with open(os.path.join(self._serverdir, 'source.dat'), 'wb') as fp:
+            fp.write(self._contents)
+
+    def tearDown(self):
+        self._resources.close()
+        super().tearDown()
+
+    def _record(self, filename='source.dat', contents=None):
+        if contents is None:
+            contents = self._contents
+        return Record(urljoin(config.http_base, filename),
+                      os.path.join(config.tempdir, 'local.dat'),
+                      sha256(contents).hexdigest(),
+                      size=len(contents))
+
+    def _read(self, record):
+        with open(record.destination, 'rb') as fp:
+            return fp.read()
+
+    @configuration
+    def test_not_segmented_by_default(self):
+        download = CurlDownloadManager()._make_download(self._record())
+        self.assertIsInstance(download, SingleDownload)
+
+    @configuration
+    def test_segments(self):
+        # The file is split into contiguous segments covering all of it.
+        config.system.update(segments='3', segment_size='100k')
+        download = CurlDownloadManager()._make_download(self._record())
+        self.assertIsInstance(download, SegmentedDownload)
+        self.assertEqual(
+            [(segment.first, segment.last) for segment in download.segments],
+            [(0, 166666), (166667, 333333), (333334, 499999)])
+
+    @configuration
+    def test_segment_size(self):
+        # No segment is smaller than the segment size, and no more segments
+        # are used than there are connections.
+        config.system.update(segments='8', segment_size='200k')
+        download = CurlDownloadManager()._make_download(self._record())
+        self.assertEqual(len(download.segments), 2)
+        config.system.update(segments='8', segment_size='1')
+        download = CurlDownloadManager()._make_download(self._record())
+        self.assertEqual(len(download.segments), 4)
+        # Files whose size isn't known aren't segmented.
+        download = CurlDownloadManager()._make_download(
+            self._record()._replace(size=None))
+        self.assertIsInstance(download, SingleDownload)
+        # Neither are files too small to split.
+        config.system.update(segments='8', segment_size='300k')
+        download = CurlDownloadManager()._make_download(self._record())
+        self.assertIsInstance(download, SingleDownload)
+
+    @configuration
+    def test_download(self):
+        config.system.update(segments='4', segment_size='100k')
+        record = self._record()
+        received = []
+        def callback(bytes_received, total):
+            received.append((bytes_received, total))
+        CurlDownloadManager(callback).get_files([
+            record,
+            Record(urljoin(config.http_base, 'source.dat'),
+                   os.path.join(config.tempdir, 'other.dat')),
+            ])
+        self.assertEqual(self._read(record), self._contents)
+        self.assertEqual(set(os.listdir(config.tempdir)),
+                         {'local.dat', 'other.dat'})
+        self.assertEqual(received[-1], (1000000, 1000000))
+
+    @configuration
+    def test_checksums(self):
+        # The checksums verified while downloading are reported.
+        config.system.update(segments='4', segment_size='100k')
+        record = self._record()
+        downloader = CurlDownloadManager()
+        downloader.get_files([
+            record,
+            Record(urljoin(config.http_base, 'source.dat'),
+                   os.path.join(config.tempdir, 'other.dat')),
+            ])
+        self.assertEqual(downloader.checksums,
+                         {record.destination: record.checksum})
+
+    @configuration
+    def test_checksum_mismatch(self):
+        config.system.update(segments='4', segment_size='100k')
+        record = self._record()._replace(checksum='abc')
+        with self.assertRaises(FileNotFoundError) as cm:
+            CurlDownloadManager().get_files([record])
+        self.assertEqual(cm.exception.args[0][:11], 'HASH ERROR:')
+
+    @configuration
+    def test_failure_removes_file(self):
+        # Segmented downloads can't be resumed.
+        config.system.update(segments='4', segment_size='100k')
+        records = [
+            self._record(),
+            Record(urljoin(config.http_base, 'missing.dat'),
+                   os.path.join(config.tempdir, 'missing.dat'),
+                   'abc', size=1000),
+            ]
+        self.assertRaises(FileNotFoundError,
+                          CurlDownloadManager().get_files, records)
+        self.assertEqual(os.listdir(config.tempdir), [])
+
+    @configuration
+    def test_server_ignores_ranges(self):
+        # The magic user-agent.txt file is always vended in full, so only
+        # the first segment is used.
+        config.system.update(segments='4', segment_size='1')
+        contents = config.user_agent.encode('utf-8')
+        record = self._record('user-agent.txt', contents)
+        CurlDownloadManager().get_files([record])
+        self.assertEqual(self._read(record), contents)
+
+    @configuration
+    def test_resume_is_not_segmented(self):
+        # A partial download is resumed over a single connection.
+        config.system.update(segments='4', segment_size='100k')
+        record = self._record()
+        with open(record.destination, 'wb') as fp:
+            fp.write(self._contents[:1000])
+        with open(record.destination + '.journal', 'w') as fp:
+            json.dump(dict(url=record.url, checksum=record.checksum,
+                           bytes=1000), fp)
+        download = CurlDownloadManager()._make_download(record)
+        self.assertIsInstance(download, SingleDownload)
+
+
+@unittest.skipUnless(USING_PYCURL, 'Only PyCURL completes files early')
+class TestCompletionCallbacks(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        try:
+            self._serverdir = self._resources.enter_context(
+                temporary_directory())
+            # Every 64KiB chunk of a response is delayed by 10ms.
+            self._resources.push(
+                make_http_server(self._serverdir, 8980, latency=0.01))
+        except:
+            self._resources.close()
+            raise
+        write_bytes(os.path.join(self._serverdir, 'bigfile.dat'), 2)
+        with open(os.path.join(self._serverdir, 'small.dat'), 'wb') as fp:
+            fp.write(b'small')
+
+    def tearDown(self):
+        self._resources.close()
+        super().tearDown()
+
+    def _records(self, small_checksum=sha256(b'small').hexdigest()):
+        return [
+            Record(urljoin(config.http_base, 'bigfile.dat'),
+                   os.path.join(config.tempdir, 'bigfile.dat')),
+            Record(urljoin(config.http_base, 'small.dat'),
+                   os.path.join(config.tempdir, 'small.dat'),
+                   small_checksum),
+            ]
+
+    @configuration
+    def test_completed_early(self):
+        # The small file is completed while the big one is still
+        # downloading, and its checksum has already been verified.
+        downloader = CurlDownloadManager()
+        completed = []
+        def callback(record):
+            completed.append((
+                os.path.basename(record.destination),
+                downloader.received,
+                downloader.checksums.get(record.destination)))
+        downloader.completion_callbacks.append(callback)
+        downloader.get_files(self._records())
+        self.assertEqual([name for name, received, checksum in completed],
+                         ['small.dat', 'bigfile.dat'])
+        name, received, checksum = completed[0]
+        self.assertLess(received, 2 * 1024 * 1024)
+        self.assertEqual(checksum, sha256(b'small').hexdigest())
+
+    @configuration
+    def test_checksum_mismatch_is_not_completed(self):
+        completed = []
+        downloader = CurlDownloadManager()
+        downloader.completion_callbacks.append(completed.append)
+        with self.assertRaises(FileNotFoundError) as cm:
+            downloader.get_files(self._records('abc'))
+        self.assertEqual(cm.exception.args[0][:11], 'HASH ERROR:')
+        self.assertEqual([os.path.basename(record.destination)
+                          for record in completed],
+                         ['bigfile.dat'])
+
+    @configuration
+    def test_cancel_after_completion(self):
+        # A file which was completed before the group download was canceled
+        # is kept for next time, along with its journal.
+        records = self._records()
+        downloader = CurlDownloadManager()
+        def callback(record):
+            downloader.cancel()
+        downloader.completion_callbacks.append(callback)
+        self.assertRaises(Canceled, downloader.get_files, records)
+        self.assertEqual(os.listdir(config.tempdir),
+                         ['small.dat', 'small.dat.journal'])
+        self.assertEqual(get_journal(records[1])['bytes'], 5)
+
+
+@skip_unless_benchmark
+@unittest.skipUnless(USING_PYCURL, 'Segmented downloads need PyCURL')
+class TestSegmentedDownloadBenchmark(unittest.TestCase):
+    @configuration
+    def test_benchmark(self):
+        with ExitStack() as resources:
+            serverdir = resources.enter_context(temporary_directory())
+            # Every 64KiB chunk of a response is delayed by 10ms.
+            resources.push(
+                make_http_server(serverdir, 8980, latency=0.01))
+            write_bytes(os.path.join(serverdir, 'bigfile.dat'), 8)
+            with open(os.path.join(serverdir, 'bigfile.dat'), 'rb') as fp:
+                checksum = sha256(fp.read()).hexdigest()
+            record = Record(urljoin(config.http_base, 'bigfile.dat'),
+                            os.path.join(config.tempdir, 'bigfile.dat'),
+                            checksum, size=8 * 1024 * 1024)
+            times = []
+            for segments in ('1', '4'):
+                config.system.update(segments=segments, segment_size='1M')
+                safe_remove(record.destination)
+                start = time.perf_counter()
+                CurlDownloadManager().get_files([record])
+                times.append(time.perf_counter() - start)
+        print('\n8MiB at 10ms per 64KiB: single {:.3f}s, '
+              '4 segments {:.3f}s'.format(*times))
+        self.assertLess(times[1], times[0])
+
+
+# The asyncio based downloader needs Python 3.5.3.
+skip_unless_asyncio = unittest.skipIf(
+    sys.version_info < (3, 5, 3), 'The asyncio downloader needs Python 3.5.3')
+
+
+def _asyncio_downloader(*args):
+    from systemimage.aio import AsyncioDownloadManager
+    return AsyncioDownloadManager(*args)
+
+
+@skip_unless_asyncio
+class TestAsyncioDownload(TestDownload):
+    """Test the asyncio based downloader with the common download tests."""
+
+    def _downloader(self, *args):
+        return _asyncio_downloader(*args)
+
+    @unittest.skip('Test is not relevant for asyncio')
+    def test_timeout(self):
+        pass                                        # pragma: no cover
+
+
+@skip_unless_asyncio
+class TestAsyncioDownloads(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._resources = ExitStack()
+        try:
+            self._serverdir = self._resources.enter_context(
+                temporary_directory())
+            # Every 64KiB chunk of a response is delayed by 10ms.
+            self._resources.push(
+                make_http_server(self._serverdir, 8980, latency=0.01))
+        except:
+            self._resources.close()
+            raise
+        write_bytes(os.path.join(self._serverdir, 'bigfile.dat'), 1)
+        with open(os.path.join(self._serverdir, 'small.dat'), 'wb') as fp:
+            fp.write(b'small')
+
+    def tearDown(self):
+        self._resources.close()
+        super().tearDown()
+
+    def _record(self, filename, checksum='', **kws):
+        return Record(urljoin(config.http_base, filename),
+                      os.path.join(config.tempdir, filename),
+                      checksum, **kws)
+
+    @configuration
+    def test_checksums(self):
+        # The checksums are calculated while downloading.
+        downloader = _asyncio_downloader()
+        record = self._record('small.dat', sha256(b'small').hexdigest())
+        downloader.get_files([record])
+        self.assertEqual(downloader.checksums, {
+            record.destination: sha256(b'small').hexdigest()})
+
+    @configuration
+    def test_checksum_mismatch(self):
+        # All or nothing: the good file is thrown away too.
+        with self.assertRaises(FileNotFoundError) as cm:
+            _asyncio_downloader().get_files([
+                self._record('bigfile.dat'),
+                self._record('small.dat', 'abc'),
+                ])
+        self.assertEqual(cm.exception.args[0][:11], 'HASH ERROR:')
+        self.assertEqual(os.listdir(config.tempdir), [])
+
+    @configuration
+    def test_not_found(self):
+        # All or nothing: a missing file fails the whole group.
+        self.assertRaises(
+            FileNotFoundError, _asyncio_downloader().get_files, [
+                self._record('small.dat'),
+                self._record('missing.dat'),
+                ])
+        self.assertEqual(os.listdir(config.tempdir), [])
+
+    @configuration
+    def test_sized(self):
+        # The total is known up front from the sizes of the records, and the
+        # sizes of the others are added as their responses arrive.
+        totals = []
+        def callback(received, total):
+            totals.append(total)
+        _asyncio_downloader(callback).get_files([
+            self._record('bigfile.dat', size=1024 * 1024),
+            self._record('small.dat'),
+            ])
+        self.assertGreaterEqual(min(totals), 1024 * 1024)
+        self.assertEqual(totals[-1], 1024 * 1024 + 5)
+
+    @configuration
+    def test_progress_is_event_driven(self):
+        # Progress is reported as the data arrives, not on a timer.
+        config.system.update(progress_interval='0s')
+        received = []
+        def callback(now, total):
+            received.append(now)
+        _asyncio_downloader(callback).get_files([
+            self._record('bigfile.dat'),
+            ])
+        self.assertEqual(received, sorted(received))
+        self.assertEqual(received[-1], 1024 * 1024)
+        # The final progress isn't reported twice.
+        self.assertEqual(len(set(received)), len(received))
+
+    @configuration
+    def test_cancel(self):
+        # Canceling stops the group download, and throws away what was
+        # already downloaded.
+        downloader = _asyncio_downloader()
+        def callback(record):
+            downloader.cancel()
+        downloader.completion_callbacks.append(callback)
+        self.assertRaises(Canceled, downloader.get_files, [
+            self._record('bigfile.dat'),
+            self._record('small.dat'),
+            ])
+        self.assertEqual(os.listdir(config.tempdir), [])
+        # Once canceled, nothing more is downloaded.
+        self.assertRaises(Canceled, downloader.get_files, [
+            self._record('small.dat'),
+            ])
+
+    @configuration
+    def test_pause_and_resume(self):
+        # A pausable download waits while it's paused.
+        downloader = _asyncio_downloader()
+        paused = []
+        def callback(received, total):
+            if len(paused) == 0:
+                paused.append(time.perf_counter())
+                downloader.pause()
+                # Resume from another thread, as the D-Bus service might.
+                Timer(0.5, downloader.resume).start()
+        downloader.callbacks.append(callback)
+        downloader.get_files([self._record('bigfile.dat')], pausable=True)
+        self.assertGreaterEqual(time.perf_counter() - paused[0], 0.5)
+        self.assertEqual(
+            os.path.getsize(os.path.join(config.tempdir, 'bigfile.dat')),
+            1024 * 1024)
+
+    @configuration
+    def test_not_modified(self):
+        # Verified, cached copies are downloaded conditionally.
+        url = urljoin(config.http_base, 'small.dat')
+        records = [self._record('small.dat', cached=get_cached_path(url))]
+        downloader = _asyncio_downloader()
+        downloader.get_files(records)
+        self.assertIn('etag', downloader.validators[records[0].destination])
+        downloader.cache_verified(records, 'keys')
+        safe_remove(records[0].destination)
+        downloader = _asyncio_downloader()
+        downloader.get_files(records)
+        self.assertEqual(downloader.not_modified, {records[0].destination})
+        self.assertTrue(downloader.is_verified(records, 'keys'))
+        with open(records[0].destination, 'rb') as fp:
+            self.assertEqual(fp.read(), b'small')
+
+    @configuration
+    def test_not_modified_without_cache(self):
+        # A server saying that a file which wasn't requested conditionally
+        # is not modified leaves nothing to use, so the file is missing.
+        from systemimage.aio import _Download
+        record = self._record('small.dat')
+        with open(record.destination, 'wb') as fp:
+            fp.write(b'partial')
+        download = _Download(record, pausable=False)
+        self.assertEqual(download.request_headers(), {})
+        self.assertRaises(FileNotFoundError, download.finish, 304, {})
+        self.assertFalse(os.path.exists(record.destination))
+
+    @configuration
+    def test_stalled(self):
+        # A download which stops receiving data fails.
+        with patch('systemimage.aio.LOW_SPEED_TIME', 0.001):
+            self.assertRaises(
+                FileNotFoundError, _asyncio_downloader().get_files, [
+                    self._record('bigfile.dat'),
+                    ])
+        self.assertEqual(os.listdir(config.tempdir), [])
+
+    @configuration
+    def test_event_loop_left_alone(self):
+        # The downloader uses its own event loop, leaving the current one
+        # alone.
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        _asyncio_downloader().get_files([self._record('small.dat')])
+        self.assertIs(asyncio.get_event_loop(), loop)
+        self.assertFalse(loop.is_closed())
+
+
+@skip_unless_asyncio
+class TestAsyncioHTTPSDownloads(unittest.TestCase):
+    def setUp(self):
+        self._directory = os.path.dirname(data_path('__init__.py'))
+
+    def _get(self, ssl_context):
+        with ExitStack() as stack:
+            stack.push(make_http_server(
+                self._directory, 8943, 'cert.pem', 'key.pem'))
+            stack.enter_context(patch(
+                'systemimage.aio.make_ssl_context',
+                return_value=ssl_context))
+            _asyncio_downloader().get_files(_https_pathify([
+                ('channel.channels_05.json', 'channels.json'),
+                ]))
+
+    @configuration
+    def test_good_path(self):
+        # The self-signed certificate is accepted when it's trusted.
+        self._get(ssl.create_default_context(cafile=data_path('cert.pem')))
+        self.assertEqual(os.listdir(config.tempdir), ['channels.json'])
+
+    @configuration
+    def test_cert_not_trusted(self):
+        # Otherwise it isn't.
+        self.assertRaises(FileNotFoundError,
+                          self._get, ssl.create_default_context())
+        self.assertEqual(os.listdir(config.tempdir), [])
+
+
 class TestDownloadManagerFactory(unittest.TestCase):
     """We have a factory for creating the download manager to use."""
 
@@ -670,6 +1846,53 @@ class TestDownloadManagerFactory(unittest.TestCase):
             os.environ['SYSTEMIMAGE_PYCURL'] = 'nope'
             self.assertIsInstance(get_download_manager(), UDMDownloadManager)
 
+    @skip_unless_asyncio
+    def test_get_downloader_by_name(self):
+        # SYSTEMIMAGE_DOWNLOADER selects a download manager by name, and
+        # takes precedence over SYSTEMIMAGE_PYCURL.
+        from systemimage.aio import AsyncioDownloadManager
+        with ExitStack() as resources:
+            resources.enter_context(reset_envar('SYSTEMIMAGE_DOWNLOADER'))
+            resources.enter_context(reset_envar('SYSTEMIMAGE_PYCURL'))
+            os.environ['SYSTEMIMAGE_PYCURL'] = '1'
+            os.environ['SYSTEMIMAGE_DOWNLOADER'] = 'asyncio'
+            self.assertIsInstance(
+                get_download_manager(), AsyncioDownloadManager)
+            os.environ['SYSTEMIMAGE_DOWNLOADER'] = 'udm'
+            self.assertIsInstance(get_download_manager(), UDMDownloadManager)
+            os.environ['SYSTEMIMAGE_PYCURL'] = '0'
+            os.environ['SYSTEMIMAGE_DOWNLOADER'] = 'Curl'
+            self.assertIsInstance(get_download_manager(), CurlDownloadManager)
+
+    @skip_unless_asyncio
+    @configuration
+    def test_get_downloader_from_config(self, config):
+        # Without either environment variable, the configuration says which
+        # download manager to use.
+        from systemimage.aio import AsyncioDownloadManager
+        with ExitStack() as resources:
+            resources.enter_context(reset_envar('SYSTEMIMAGE_DOWNLOADER'))
+            resources.enter_context(reset_envar('SYSTEMIMAGE_PYCURL'))
+            os.environ.pop('SYSTEMIMAGE_DOWNLOADER', None)
+            os.environ.pop('SYSTEMIMAGE_PYCURL', None)
+            config.system.update(downloader='asyncio')
+            self.assertIsInstance(
+                get_download_manager(), AsyncioDownloadManager)
+
+    def test_get_downloader_asyncio_too_old(self):
+        # Python 3.4 can't run the asyncio downloader.
+        with ExitStack() as resources:
+            resources.enter_context(reset_envar('SYSTEMIMAGE_DOWNLOADER'))
+            resources.enter_context(
+                patch('systemimage.download.sys.version_info', (3, 4, 3)))
+            os.environ['SYSTEMIMAGE_DOWNLOADER'] = 'asyncio'
+            self.assertRaises(ValueError, get_download_manager)
+
+    def test_get_downloader_unknown(self):
+        with reset_envar('SYSTEMIMAGE_DOWNLOADER'):
+            os.environ['SYSTEMIMAGE_DOWNLOADER'] = 'carrier-pigeon'
+            self.assertRaises(ValueError, get_download_manager)
+
     def test_auto_detect_udm(self):
         # If the environment variable is not set, we do auto-detection.  For
         # backward compatibility, if udm is available on the system bus, we
@@ -16,6 +16,9 @@
 """Test that we can verify GPG signatures."""
 
 __all__ = [
+    'TestBatchVerification',
+    'TestBatchVerificationBenchmark',
+    'TestContextPool',
     'TestKeyrings',
     'TestSignature',
     'TestSignatureError',
@@ -25,6 +28,7 @@ __all__ = [
 
 import os
 import sys
+import time
 import hashlib
 import unittest
 import traceback
@@ -32,10 +36,12 @@ import traceback
 from contextlib import ExitStack
 from io import StringIO
 from systemimage.config import config
-from systemimage.gpg import Context, SignatureError
+from systemimage.gpg import Context, SignatureError, _pool
 from systemimage.helpers import temporary_directory
 from systemimage.testing.helpers import (
-    configuration, copy, setup_keyring_txz, setup_keyrings, sign)
+    configuration, copy, setup_keyring_txz, setup_keyrings, sign,
+    skip_unless_benchmark)
+from unittest.mock import patch
 
 
 class TestKeyrings(unittest.TestCase):
@@ -613,3 +619,206 @@ class TestSignatureWithOverrides(unittest.TestCase):
                                   channels_asc, channels_json)
                 config.skip_gpg_verification = True
                 ctx.validate(channels_asc, channels_json)
+
+
+class TestContextPool(unittest.TestCase):
+    """Verification contexts are pooled."""
+
+    ARCHIVE_MASTER = set(['289518ED3A0C4CFE975A0B32E0979A7EADE8E880'])
+    IMAGE_MASTER = set(['47691DEF271FB2B1FD3364513BC6AF1818E7F5FB'])
+
+    @configuration
+    def test_reused(self):
+        # Contexts for the same keyrings share the same gpg instance, and its
+        # keys are only listed once.
+        copy('archive-master.gpg', config.tempdir)
+        with Context(config.gpg.archive_master) as ctx:
+            gpg = ctx._ctx
+            self.assertEqual(ctx.fingerprints, self.ARCHIVE_MASTER)
+        with patch.object(gpg, 'list_keys') as mock:
+            with Context(config.gpg.archive_master) as ctx:
+                self.assertIs(ctx._ctx, gpg)
+                self.assertEqual(ctx.fingerprints, self.ARCHIVE_MASTER)
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_nested(self):
+        # The same keyrings can be in use by more than one context at once.
+        copy('archive-master.gpg', config.tempdir)
+        with Context(config.gpg.archive_master) as ctx_1:
+            with Context(config.gpg.archive_master) as ctx_2:
+                self.assertIs(ctx_1._ctx, ctx_2._ctx)
+                self.assertEqual(ctx_1._context.refcount, 2)
+            self.assertEqual(ctx_1._context.refcount, 1)
+            self.assertEqual(ctx_1.fingerprints, self.ARCHIVE_MASTER)
+
+    @configuration
+    def test_keyring_changed(self):
+        # The pool is keyed by the contents of the keyrings, so changing a
+        # keyring file gets a different context.
+        copy('archive-master.gpg', config.tempdir)
+        with Context(config.gpg.archive_master) as ctx:
+            self.assertEqual(ctx.fingerprints, self.ARCHIVE_MASTER)
+        copy('image-master.gpg', config.tempdir, 'archive-master.gpg')
+        with Context(config.gpg.archive_master) as ctx:
+            self.assertEqual(ctx.fingerprints, self.IMAGE_MASTER)
+
+    @configuration
+    def test_blacklist_fingerprints(self):
+        # The fingerprints of the blacklist are only listed once too.
+        copy('archive-master.gpg', config.tempdir)
+        copy('image-master.gpg', config.tempdir, 'blacklist.gpg')
+        # The .gpg file is already unpacked, so the tarball isn't read.
+        blacklist = os.path.join(config.tempdir, 'blacklist.tar.xz')
+        with open(blacklist, 'wb'):
+            pass
+        Context(config.gpg.archive_master, blacklist=blacklist)
+        with patch('systemimage.gpg.gnupg.GPG.list_keys') as mock:
+            ctx = Context(config.gpg.archive_master, blacklist=blacklist)
+        self.assertEqual(ctx._blacklisted_fingerprints, self.IMAGE_MASTER)
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_idle_contexts_are_evicted(self):
+        copy('archive-master.gpg', config.tempdir)
+        copy('image-master.gpg', config.tempdir)
+        with patch('systemimage.gpg.MAX_IDLE_CONTEXTS', 1):
+            with Context(config.gpg.archive_master) as ctx:
+                archive_home = ctx._context.home
+            with Context(config.gpg.image_master) as ctx:
+                image_home = ctx._context.home
+                # The archive master context is idle, but there's room for
+                # one idle context.
+                self.assertTrue(os.path.exists(archive_home))
+            # Now the image master context is idle too.
+            self.assertFalse(os.path.exists(archive_home))
+            self.assertTrue(os.path.exists(image_home))
+
+    @configuration
+    def test_new_temporary_directory(self):
+        # The pool lives in the temporary directory.
+        copy('archive-master.gpg', config.tempdir)
+        with Context(config.gpg.archive_master) as ctx:
+            self.assertEqual(
+                os.path.dirname(os.path.dirname(ctx._context.home)),
+                config.tempdir)
+            self.assertIn(ctx._context, _pool._contexts.values())
+
+
+class TestBatchVerification(unittest.TestCase):
+    """Verify several signatures at once."""
+
+    def setUp(self):
+        self._stack = ExitStack()
+        self.addCleanup(self._stack.close)
+        self._tmpdir = self._stack.enter_context(temporary_directory())
+
+    def _make_files(self, *pubkey_rings):
+        # Create a data file for each keyring, signed with that keyring.
+        pairs = []
+        for i, pubkey_ring in enumerate(pubkey_rings):
+            data_path = os.path.join(self._tmpdir, 'file_{:02d}.txt'.format(i))
+            with open(data_path, 'w', encoding='utf-8') as fp:
+                print('This is file {}'.format(i), file=fp)
+            sign(data_path, pubkey_ring)
+            pairs.append((data_path + '.asc', data_path))
+        return pairs
+
+    def _keyring(self):
+        keyring = os.path.join(self._tmpdir, 'image-signing.tar.xz')
+        setup_keyring_txz('image-signing.gpg', 'image-master.gpg',
+                          dict(type='image-signing'), keyring)
+        return keyring
+
+    @configuration
+    def test_verify_all(self):
+        pairs = self._make_files(*['image-signing.gpg'] * 5)
+        with Context(self._keyring()) as ctx:
+            self.assertEqual(ctx.verify_all(pairs), [True] * 5)
+
+    @configuration
+    def test_verify_all_results(self):
+        # The results are in the order of the pairs.
+        pairs = self._make_files(
+            'image-signing.gpg', 'device-signing.gpg',
+            'image-signing.gpg', 'device-signing.gpg')
+        with Context(self._keyring()) as ctx:
+            self.assertEqual(ctx.verify_all(pairs), [True, False, True, False])
+            self.assertEqual(ctx.verify_all(pairs, max_workers=1),
+                             [True, False, True, False])
+
+    @configuration
+    def test_verify_none(self):
+        with Context(self._keyring()) as ctx:
+            self.assertEqual(ctx.verify_all([]), [])
+            self.assertEqual(ctx.validate_all([]), [])
+
+    @configuration
+    def test_verify_serially(self):
+        # With a single worker, no threads are needed.
+        pairs = self._make_files('device-signing.gpg', 'device-signing.gpg')
+        with ExitStack() as resources:
+            mock = resources.enter_context(
+                patch('systemimage.gpg.ThreadPoolExecutor'))
+            ctx = resources.enter_context(Context(self._keyring()))
+            self.assertEqual(ctx.verify_all(pairs, max_workers=1),
+                             [False, False])
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_validate_all(self):
+        # All the signatures are verified, but the exception describes only
+        # the first one which failed.
+        pairs = self._make_files(
+            'device-signing.gpg', 'image-master.gpg', 'device-signing.gpg')
+        with Context(self._keyring()) as ctx:
+            with patch.object(ctx._ctx, 'verify_file',
+                              wraps=ctx._ctx.verify_file) as mock:
+                with self.assertRaises(SignatureError) as cm:
+                    ctx.validate_all(pairs)
+        self.assertEqual(mock.call_count, 3)
+        self.assertEqual(cm.exception.signature_path, pairs[0][0])
+        self.assertEqual(cm.exception.data_path, pairs[0][1])
+
+    @configuration
+    def test_skip_verification(self, config):
+        pairs = self._make_files('device-signing.gpg', 'image-master.gpg')
+        config.skip_gpg_verification = True
+        with Context(self._keyring()) as ctx:
+            with patch.object(ctx._ctx, 'verify_file') as mock:
+                self.assertEqual(ctx.validate_all(pairs), [True, True])
+        self.assertFalse(mock.called)
+
+
+@skip_unless_benchmark
+class TestBatchVerificationBenchmark(unittest.TestCase):
+    """Compare verifying 50 signatures one at a time and in a batch."""
+
+    FILES = 50
+
+    @configuration
+    def test_benchmark(self):
+        with temporary_directory() as tmpdir:
+            pairs = []
+            for i in range(self.FILES):
+                data_path = os.path.join(tmpdir, 'delta_{:02d}.tar.xz'.format(i))
+                with open(data_path, 'wb') as fp:
+                    fp.write(os.urandom(64 * 1024))
+                sign(data_path, 'image-signing.gpg')
+                pairs.append((data_path + '.asc', data_path))
+            keyring = os.path.join(tmpdir, 'image-signing.tar.xz')
+            setup_keyring_txz('image-signing.gpg', 'image-master.gpg',
+                              dict(type='image-signing'), keyring)
+            with Context(keyring) as ctx:
+                # Warm up the keyring fingerprints.
+                ctx.fingerprints
+                start = time.perf_counter()
+                for signature_path, data_path in pairs:
+                    ctx.validate(signature_path, data_path)
+                serial = time.perf_counter() - start
+                start = time.perf_counter()
+                ctx.validate_all(pairs)
+                batch = time.perf_counter() - start
+        print('\n{} signatures: one at a time {:.2f}s, batch {:.2f}s'.format(
+            self.FILES, serial, batch), file=sys.stderr)
+        self.assertLess(batch, serial)
@@ -0,0 +1,161 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the upgrade graph."""
+
+__all__ = [
+    'TestUpgradeGraph',
+    'TestUpgradeGraphBenchmark',
+    ]
+
+
+import time
+import unittest
+
+from collections import deque
+from pkg_resources import resource_listdir
+from systemimage.candidates import get_candidates
+from systemimage.testing.helpers import get_index, skip_unless_benchmark
+from systemimage.testing.synthetic import synthetic_index
+
+
+def scan_candidates(index, build):
+    # This is the original candidate path algorithm, which scans all the
+    # deltas at every step of every path.  It serves as the reference against
+    # which the graph is checked.
+    fulls = set()
+    deltas = set()
+    for image in index.images:
+        if image.type == 'full':
+            if getattr(image, 'minversion', 0) <= build:
+                fulls.add(image)
+        elif image.type == 'delta':
+            deltas.add(image)
+    paths = deque()
+    for image in fulls:
+        if image.version > build:
+            paths.appendleft([image])
+    for image in deltas:
+        if image.base == build:
+            paths.appendleft([image])
+    candidates = []
+    while paths:
+        path = paths.pop()
+        current = path[-1]
+        while True:
+            next_steps = [delta for delta in deltas
+                          if delta.base == current.version]
+            if len(next_steps) == 0:
+                candidates.append(path)
+                break
+            elif len(next_steps) == 1:
+                current = next_steps[0]
+                path.append(current)
+            else:
+                current = next_steps.pop()
+                for fork in next_steps:
+                    new_path = path.copy()
+                    new_path.append(fork)
+                    paths.appendleft(new_path)
+                path.append(current)
+    return candidates
+
+
+def _describe(candidates):
+    # Images compare equal on version and base only, so compare everything
+    # the scorer and the state machine look at.
+    return [[(image.type, image.version, getattr(image, 'base', None),
+              tuple(image.descriptions.values()))
+             for image in path]
+            for path in candidates]
+
+
+class TestUpgradeGraph(unittest.TestCase):
+    def test_graph_is_cached(self):
+        # The graph is built only once per index.
+        index = get_index('candidates.index_09.json')
+        self.assertIs(index.graph, index.graph)
+
+    def test_successors(self):
+        index = get_index('candidates.index_13.json')
+        successors = index.graph.successors(300)
+        self.assertEqual([image.version for image in successors], [301])
+        self.assertEqual(index.graph.successors(304), ())
+
+    def test_roots(self):
+        # Full images are roots only when the device satisfies their
+        # minversion.
+        index = get_index('candidates.index_02.json')
+        self.assertEqual(index.graph.roots(100), [])
+        roots = index.graph.roots(800)
+        self.assertEqual([image.version for image in roots], [1300])
+
+    def test_identical_to_scan(self):
+        # For every test index and every interesting build number, the graph
+        # calculates exactly the same candidate paths, in exactly the same
+        # order, as the original algorithm.
+        # Skip the two index files which intentionally contain images that
+        # cannot participate in an upgrade path (old-style version numbers
+        # and a delta without a base).
+        skip = {'dbus.index_05.json', 'index.index_05.json'}
+        filenames = [filename
+                     for filename in resource_listdir(
+                         'systemimage.tests.data', '')
+                     if (filename.endswith('.json') and
+                         '.index_' in filename and
+                         filename not in skip)]
+        self.assertGreater(len(filenames), 0)
+        for filename in sorted(filenames):
+            index = get_index(filename)
+            builds = {0, 1}
+            for image in index.images:
+                builds.add(image.version)
+                builds.add(image.version - 1)
+                builds.add(getattr(image, 'base', 0))
+                builds.add(getattr(image, 'minversion', 0))
+            for build in sorted(builds):
+                self.assertEqual(
+                    _describe(get_candidates(index, build)),
+                    _describe(scan_candidates(index, build)),
+                    '{} from build {}'.format(filename, build))
+
+    def test_identical_to_scan_synthetic(self):
+        index = synthetic_index(
+            120, full_every=25, fork=3, fork_every=40, minversion_every=2)
+        for build in (0, 1, 37, 50, 79, 100, 119, 120):
+            self.assertEqual(
+                _describe(get_candidates(index, build)),
+                _describe(scan_candidates(index, build)))
+
+
+@skip_unless_benchmark
+class TestUpgradeGraphBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        # A long-lived channel: 10000 builds with a full every 100 builds and
+        # a forked delta every 50 builds, i.e. well over 10k images.
+        index = synthetic_index(
+            10000, full_every=100, fork=2, fork_every=50)
+        self.assertGreater(len(index.images), 10000)
+        build = 9800
+        start = time.perf_counter()
+        expected = scan_candidates(index, build)
+        scan_time = time.perf_counter() - start
+        start = time.perf_counter()
+        got = get_candidates(index, build)
+        graph_time = time.perf_counter() - start
+        self.assertEqual(_describe(got), _describe(expected))
+        print('\n{} images, {} paths: scan {:.3f}s, graph {:.3f}s'.format(
+            len(index.images), len(got), scan_time, graph_time))
+        self.assertLess(graph_time, scan_time)
@@ -38,9 +38,9 @@ from pathlib import Path
 from systemimage.bag import Bag
 from systemimage.config import Configuration
 from systemimage.helpers import (
-    MiB, NO_PORT, as_loglevel, as_object, as_port, as_stripped, as_timedelta,
-    calculate_signature, last_update_date, phased_percentage,
-    temporary_directory, version_detail)
+    MiB, NO_PORT, as_bool, as_loglevel, as_object, as_port, as_size,
+    as_stripped, as_timedelta, calculate_signature, last_update_date,
+    phased_percentage, temporary_directory, version_detail)
 from systemimage.testing.helpers import configuration, data_path, touch_build
 from unittest.mock import patch
 
@@ -126,6 +126,27 @@ class TestConverters(unittest.TestCase):
     def test_stripped(self):
         self.assertEqual(as_stripped('   field   '), 'field')
 
+    def test_as_size(self):
+        self.assertEqual(as_size('100'), 100)
+        self.assertEqual(as_size('2k'), 2048)
+        self.assertEqual(as_size('16M'), 16 * MiB)
+        self.assertEqual(as_size(' 1G '), 1024 * MiB)
+
+    def test_as_bad_size(self):
+        self.assertRaises(ValueError, as_size, '1.5M')
+        self.assertRaises(ValueError, as_size, '-1')
+        self.assertRaises(ValueError, as_size, '10MiB')
+
+    def test_as_bool(self):
+        for value in ('yes', 'True', 'ON', ' 1 '):
+            self.assertIs(as_bool(value), True)
+        for value in ('no', 'False', 'OFF', ' 0 '):
+            self.assertIs(as_bool(value), False)
+
+    def test_as_bad_bool(self):
+        self.assertRaises(ValueError, as_bool, 'maybe')
+        self.assertRaises(ValueError, as_bool, '')
+
 
 class TestLastUpdateDate(unittest.TestCase):
     @configuration
@@ -16,14 +16,24 @@
 """Test Image objects."""
 
 __all__ = [
+    'TestCompactImageBenchmark',
+    'TestFileRecord',
     'TestImage',
     'TestNewVersionRegime',
     ]
 
 
+import json
+import time
+import pickle
 import unittest
+import tracemalloc
 
-from systemimage.image import Image
+from systemimage.bag import Bag
+from systemimage.image import FileRecord, Image
+from systemimage.index import Index
+from systemimage.testing.helpers import skip_unless_benchmark
+from systemimage.testing.synthetic import synthetic_index_json
 
 
 class TestImage(unittest.TestCase):
@@ -78,6 +88,75 @@ class TestImage(unittest.TestCase):
         image = Image(**kws)
         self.assertEqual(image.phased_percentage, 39)
 
+    def test_default_version_detail(self):
+        image = Image(type='full', version=10)
+        self.assertEqual(image.version_detail, '')
+
+    def test_missing_attribute(self):
+        # Attributes which weren't given raise AttributeError, so getattr()
+        # with a default works as it does for Bags.
+        image = Image(type='full', version=10)
+        self.assertRaises(AttributeError, getattr, image, 'base')
+        self.assertRaises(AttributeError, getattr, image, 'bogus')
+        self.assertEqual(getattr(image, 'minversion', 0), 0)
+
+    def test_unknown_keys(self):
+        # Keys which aren't known to images are still available, munged in
+        # the same way as for Bags.
+        kws = {'type': 'full', 'version': 10, 'new-key': 1, 'global': 2}
+        image = Image(**kws)
+        self.assertEqual(image.new_key, 1)
+        self.assertEqual(image.global_, 2)
+
+    def test_immutable(self):
+        image = Image(type='full', version=10)
+        with self.assertRaises(AttributeError):
+            image.version = 11
+        with self.assertRaises(AttributeError):
+            image.base = 9
+        with self.assertRaises(AttributeError):
+            del image.version
+        self.assertEqual(image.version, 10)
+
+    def test_no_instance_dictionary(self):
+        image = Image(type='full', version=10)
+        self.assertFalse(hasattr(image, '__dict__'))
+
+    def test_pickle(self):
+        kws = {'type': 'delta', 'version': 10, 'base': 9, 'new-key': 1}
+        kws['phased-percentage'] = '39'
+        image = Image(files=(FileRecord(path='/a', size=1),), **kws)
+        copy = pickle.loads(pickle.dumps(image))
+        self.assertEqual(copy, image)
+        self.assertEqual(copy.base, 9)
+        self.assertEqual(copy.phased_percentage, 39)
+        self.assertEqual(copy.new_key, 1)
+        self.assertEqual(copy.files[0].path, '/a')
+        self.assertRaises(AttributeError, getattr, copy, 'minversion')
+
+
+class TestFileRecord(unittest.TestCase):
+    def test_attributes(self):
+        filerec = FileRecord(checksum='abc', order=1, path='/a.tar.xz',
+                             signature='/a.tar.xz.asc', size=100)
+        self.assertEqual(filerec.checksum, 'abc')
+        self.assertEqual(filerec.order, 1)
+        self.assertEqual(filerec.path, '/a.tar.xz')
+        self.assertEqual(filerec.signature, '/a.tar.xz.asc')
+        self.assertEqual(filerec.size, 100)
+
+    def test_immutable(self):
+        filerec = FileRecord(path='/a.tar.xz')
+        with self.assertRaises(AttributeError):
+            filerec.path = '/b.tar.xz'
+
+    def test_index_files(self):
+        index = Index.from_json(synthetic_index_json(2))
+        image = index.images[0]
+        self.assertEqual(len(image.files), 2)
+        for filerec in image.files:
+            self.assertIsInstance(filerec, FileRecord)
+
 
 class TestNewVersionRegime(unittest.TestCase):
     """LP: #1218612"""
@@ -142,3 +221,53 @@ class TestNewVersionRegime(unittest.TestCase):
     def test_mixed_regime_reversed_rejects(self):
         self.assertRaises(AssertionError, hash,
                           Image(type='delta', version=20130899, base=3))
+
+
+def _bag_images(data):
+    # This is how the index was parsed before images were made compact.
+    images = []
+    for image_data in json.loads(data)['images']:
+        descriptions = {}
+        for key in list(image_data):
+            if key.startswith('description'):
+                descriptions[key] = image_data.pop(key)
+        files = image_data.pop('files', [])
+        bundles = [Bag(**bundle_data) for bundle_data in files]
+        images.append(Bag(converters={'phased-percentage': int},
+                          files=bundles, descriptions=descriptions,
+                          **image_data))
+    return images
+
+
+def _compact_images(data):
+    return Index.from_json(data).images
+
+
+def _measure(function, data):
+    # Time the function without tracing, since tracing skews the timings.
+    start = time.perf_counter()
+    function(data)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        result = function(data)
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, size
+
+
+@skip_unless_benchmark
+class TestCompactImageBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        # A long-lived channel with about 20k images.
+        data = synthetic_index_json(10000, full_every=10, fork=2)
+        bags, bag_time, bag_size = _measure(_bag_images, data)
+        images, compact_time, compact_size = _measure(_compact_images, data)
+        self.assertEqual(len(bags), len(images))
+        print('\n{} images: Bag {:.3f}s {:.1f} MiB, '
+              'compact {:.3f}s {:.1f} MiB'.format(
+                  len(images), bag_time, bag_size / (1 << 20),
+                  compact_time, compact_size / (1 << 20)))
+        self.assertLess(compact_size, bag_size)
+        self.assertLess(compact_time, bag_time)
@@ -16,23 +16,36 @@
 """Test channel/device index parsing."""
 
 __all__ = [
-    'TestIndex',
+    'TestDeltaIndex',
     'TestDownloadIndex',
+    'TestIndex',
+    'TestPrunedIndex',
+    'TestPrunedIndexBenchmark',
     ]
 
 
 import os
+import json
+import time
 import unittest
+import tracemalloc
 
 from contextlib import ExitStack
 from datetime import datetime, timezone
+from pkg_resources import resource_listdir
+from pkg_resources import resource_string as resource_bytes
+from systemimage.candidates import get_candidates
 from systemimage.gpg import SignatureError
 from systemimage.helpers import temporary_directory
+from systemimage.index import Index
+from systemimage.scores import WeightedScorer
 from systemimage.state import State
 from systemimage.testing.helpers import (
     configuration, copy, get_index, make_http_server, makedirs,
-    setup_keyring_txz, setup_keyrings, sign)
+    setup_keyring_txz, setup_keyrings, sign, skip_unless_benchmark)
 from systemimage.testing.nose import SystemImagePlugin
+from systemimage.testing.synthetic import synthetic_index_json
+from unittest.mock import patch
 
 
 class TestIndex(unittest.TestCase):
@@ -111,6 +124,194 @@ class TestIndex(unittest.TestCase):
             })
 
 
+
+def _data(filename):
+    return resource_bytes('systemimage.tests.data', filename).decode('utf-8')
+
+
+class TestDeltaIndex(unittest.TestCase):
+    def test_merge(self):
+        index = get_index('index.index_03.json')
+        merged = index.merge_json(_data('index.delta_01.json'))
+        self.assertEqual(
+            merged.global_.generated_at,
+            datetime(2013, 4, 30, 9, 0, 0, tzinfo=timezone.utc))
+        # Full build 1 was removed, full build 2 was replaced, and there's
+        # a new delta.
+        self.assertEqual(
+            [(image.type, image.version) for image in merged.images],
+            [('full', 1400), ('delta', 1500)])
+        self.assertEqual(merged.images[0].descriptions,
+                         {'description': 'Rebuilt full build 2'})
+        self.assertEqual(merged.images[1].base, 1400)
+        self.assertEqual(merged.images[1].files[0].checksum, 'fed')
+        # The original index is unchanged.
+        self.assertEqual(len(index.images), 2)
+        self.assertEqual(index.images[1].descriptions,
+                         {'description': 'New full build 2'})
+
+    def test_merge_graph(self):
+        # The merged index has its own upgrade graph.
+        index = get_index('index.index_03.json')
+        self.assertEqual(len(index.graph.fulls), 2)
+        merged = index.merge_json(_data('index.delta_01.json'))
+        self.assertEqual(len(merged.graph.fulls), 1)
+        self.assertEqual(
+            [image.version for image in merged.graph.successors(1400)],
+            [1500])
+
+    def test_merge_wrong_base(self):
+        # A delta index must be since the index's generated_at timestamp.
+        index = get_index('index.index_03.json')
+        self.assertRaises(
+            ValueError, index.merge_json, _data('index.delta_02.json'))
+
+def _describe(paths):
+    return [[(image.type, image.version, getattr(image, 'base', None))
+             for image in path]
+            for path in paths]
+
+
+def _builds(index):
+    # The build numbers at which the candidate paths change.
+    builds = {0, 1}
+    for image in index.images:
+        builds.add(image.version)
+        builds.add(image.version - 1)
+        builds.add(getattr(image, 'base', 0))
+        builds.add(getattr(image, 'minversion', 0))
+    return sorted(builds)
+
+
+class TestPrunedIndex(unittest.TestCase):
+    def assertIdentical(self, data, name):
+        # An index pruned for a build gives exactly the same candidate paths,
+        # in exactly the same order, and the same winner, as the whole index.
+        index = Index.from_json(data)
+        for build in _builds(index):
+            pruned = Index.from_json(data, build)
+            message = '{} from build {}'.format(name, build)
+            self.assertEqual(
+                _describe(get_candidates(pruned, build)),
+                _describe(get_candidates(index, build)),
+                message)
+            self.assertEqual(
+                _describe([WeightedScorer().choose_from_index(
+                    pruned, build, 'stable')]),
+                _describe([WeightedScorer().choose_from_index(
+                    index, build, 'stable')]),
+                message)
+
+    def test_identical(self):
+        # Skip the two index files which intentionally contain images that
+        # cannot participate in an upgrade path (old-style version numbers
+        # and a delta without a base).
+        skip = {'dbus.index_05.json', 'index.index_05.json'}
+        filenames = [filename
+                     for filename in resource_listdir(
+                         'systemimage.tests.data', '')
+                     if (filename.endswith('.json') and
+                         '.index_' in filename and
+                         filename not in skip)]
+        self.assertGreater(len(filenames), 0)
+        for filename in sorted(filenames):
+            self.assertIdentical(_data(filename), filename)
+
+    def test_identical_synthetic(self):
+        for builds, kws in (
+                (16, dict(full_every=10, fork=2)),
+                (24, dict(full_every=5, fork=3, fork_every=4,
+                          minversion_every=1)),
+                (60, dict(full_every=10, fork=2, fork_every=6,
+                          bootme_every=3)),
+                (300, dict(full_every=25, minversion_every=2, chain=10))):
+            self.assertIdentical(
+                synthetic_index_json(builds, **kws),
+                'synthetic {} {}'.format(builds, kws))
+
+    def test_pruned_images(self):
+        # Full images at or below the build, or whose minimum version is
+        # above it, and deltas from below the build are dropped.
+        index = Index.from_json(_data('index.index_04.json'), 1300)
+        self.assertEqual(
+            sorted((image.type, image.version, getattr(image, 'base', None))
+                   for image in index.images),
+            [('delta', 1301, 1300), ('delta', 1304, 1301)])
+
+    def test_wrong_build(self):
+        # A pruned index can only answer for its own build.
+        index = Index.from_json(_data('index.index_04.json'), 1300)
+        self.assertRaises(ValueError, get_candidates, index, 1200)
+
+    def test_merge(self):
+        # A delta index applied to a pruned index gives a pruned index for
+        # the same build, with the same candidates as the merged whole index.
+        data = _data('index.index_03.json')
+        delta = _data('index.delta_01.json')
+        merged = Index.from_json(data).merge_json(delta)
+        for build in (0, 1100, 1300, 1400, 1500):
+            pruned = Index.from_json(data, build).merge_json(delta)
+            self.assertEqual(
+                _describe(get_candidates(pruned, build)),
+                _describe(get_candidates(merged, build)),
+                'from build {}'.format(build))
+            self.assertRaises(ValueError, get_candidates, pruned, build + 1)
+
+    def test_malformed(self):
+        data = _data('index.index_04.json')
+        for bad in (data[:-10], data + '{}', data.replace(',', ';', 1),
+                    '[]', '', '{"images": [{"type": "full"',
+                    '{"images": []'):
+            self.assertRaises(ValueError, Index.from_json, bad, 1300)
+        # Whitespace is allowed anywhere between tokens.
+        index = Index.from_json(
+            '\n{ "global" : {"generated_at": "Mon Apr 29 18:45:27 UTC 2013"}'
+            ' , "images" : [ ] }\n', 1300)
+        self.assertEqual(index.images, [])
+
+
+def _measure(function, *args):
+    # Time the function without tracing, since tracing skews the timings.
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+@skip_unless_benchmark
+class TestPrunedIndexBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        # A long-lived channel with a 20 MiB index, for a device which is a
+        # few builds behind.
+        data = synthetic_index_json(
+            60000, full_every=10, fork=2, fork_every=50)
+        build = 59950
+        # Before the index was parsed a piece at a time, the whole document
+        # was decoded first, which alone costs at least this much.
+        mapping, loads_time, loads_peak = _measure(json.loads, data)
+        index, whole_time, whole_peak = _measure(Index.from_json, data)
+        pruned, pruned_time, pruned_peak = _measure(
+            Index.from_json, data, build)
+        self.assertEqual(_describe(get_candidates(pruned, build)),
+                         _describe(get_candidates(index, build)))
+        print('\n{:.1f} MiB, {} images: json.loads {:.3f}s {:.1f} MiB peak, '
+              'whole {:.3f}s {:.1f} MiB peak, '
+              'pruned to {} images {:.3f}s {:.1f} MiB peak'.format(
+                  len(data) / (1 << 20), len(mapping['images']),
+                  loads_time, loads_peak / (1 << 20),
+                  whole_time, whole_peak / (1 << 20),
+                  len(pruned.images), pruned_time, pruned_peak / (1 << 20)))
+        self.assertLess(pruned_peak, loads_peak)
+        self.assertLess(pruned_peak, whole_peak)
+        self.assertLess(pruned_time, whole_time)
+
+
 class TestDownloadIndex(unittest.TestCase):
     maxDiff = None
 
@@ -241,6 +442,133 @@ class TestDownloadIndex(unittest.TestCase):
         state.run_until('get_index')
         self.assertRaises(SignatureError, next, state)
 
+    @configuration
+    def test_load_index_cached(self):
+        # The second time the same index is loaded, it comes from the cache
+        # without checking its signature again.
+        self._copysign(
+            'index.channels_05.json', 'channels.json', 'image-signing.gpg')
+        self._copysign(
+            'index.index_04.json', 'stable/nexus7/index.json',
+            'image-signing.gpg')
+        setup_keyrings()
+        State().run_thru('get_index')
+        state = State()
+        state.run_until('get_index')
+        with patch('systemimage.state.Context') as mock:
+            next(state)
+        self.assertFalse(mock.called)
+        self.assertEqual(
+            state.index.images[0].files[1].checksum, 'bcd')
+
+    @configuration
+    def test_load_index_cache_blacklist(self):
+        # The index is cached, but then the key which signed it is
+        # blacklisted, so it must be verified again.
+        self._copysign(
+            'index.channels_02.json', 'channels.json', 'image-signing.gpg')
+        self._copysign(
+            'index.index_04.json', 'stable/nexus7/index.json',
+            'device-signing.gpg')
+        setup_keyrings()
+        setup_keyring_txz(
+            'device-signing.gpg', 'image-signing.gpg',
+            dict(type='device-signing'),
+            os.path.join(self._serverdir, 'stable', 'nexus7', 'device.tar.xz'))
+        State().run_thru('get_index')
+        setup_keyring_txz(
+            'device-signing.gpg', 'image-master.gpg', dict(type='blacklist'),
+            os.path.join(self._serverdir, 'gpg', 'blacklist.tar.xz'))
+        state = State()
+        state.run_until('get_index')
+        self.assertRaises(SignatureError, next, state)
+
+    @configuration
+    def test_load_index_delta(self):
+        # Once an index has been loaded, a delta index since it is used
+        # instead of the whole index.
+        self._copysign(
+            'index.channels_05.json', 'channels.json', 'image-signing.gpg')
+        self._copysign(
+            'index.index_04.json', 'stable/nexus7/index.json',
+            'image-signing.gpg')
+        setup_keyrings()
+        State().run_thru('get_index')
+        self._copysign(
+            'index.delta_01.json',
+            'stable/nexus7/index-since-20130429T184527Z.json',
+            'image-signing.gpg')
+        # The whole index isn't needed any more.
+        os.remove(os.path.join(self._serverdir, 'stable/nexus7/index.json'))
+        state = State()
+        state.run_thru('get_index')
+        self.assertEqual(
+            state.index.global_.generated_at,
+            datetime(2013, 4, 30, 9, 0, 0, tzinfo=timezone.utc))
+        versions = [(image.type, image.version)
+                    for image in state.index.images]
+        self.assertNotIn(('full', 1300), versions)
+        self.assertIn(('delta', 1500), versions)
+        self.assertEqual(len(versions), 9)
+        # The merged index is the base for the next delta index.
+        os.remove(os.path.join(
+            self._serverdir,
+            'stable/nexus7/index-since-20130429T184527Z.json'))
+        self._copysign(
+            'index.index_04.json', 'stable/nexus7/index.json',
+            'image-signing.gpg')
+        state = State()
+        with patch('systemimage.state.State._get_delta_index',
+                   return_value=None) as mock:
+            state.run_thru('get_index')
+        latest = mock.call_args[0][1]
+        self.assertEqual(
+            latest.global_.generated_at,
+            datetime(2013, 4, 30, 9, 0, 0, tzinfo=timezone.utc))
+
+    @configuration
+    def test_load_index_delta_bad_signature(self):
+        # A delta index which isn't properly signed is ignored in favor of
+        # the whole index.
+        self._copysign(
+            'index.channels_05.json', 'channels.json', 'image-signing.gpg')
+        self._copysign(
+            'index.index_04.json', 'stable/nexus7/index.json',
+            'image-signing.gpg')
+        setup_keyrings()
+        State().run_thru('get_index')
+        self._copysign(
+            'index.delta_01.json',
+            'stable/nexus7/index-since-20130429T184527Z.json',
+            'spare.gpg')
+        state = State()
+        state.run_thru('get_index')
+        self.assertEqual(
+            state.index.global_.generated_at,
+            datetime(2013, 4, 29, 18, 45, 27, tzinfo=timezone.utc))
+        self.assertEqual(
+            state.index.images[0].files[1].checksum, 'bcd')
+
+    @configuration
+    def test_load_index_delta_wrong_base(self):
+        # A delta index since some other index is ignored.
+        self._copysign(
+            'index.channels_05.json', 'channels.json', 'image-signing.gpg')
+        self._copysign(
+            'index.index_04.json', 'stable/nexus7/index.json',
+            'image-signing.gpg')
+        setup_keyrings()
+        State().run_thru('get_index')
+        self._copysign(
+            'index.delta_02.json',
+            'stable/nexus7/index-since-20130429T184527Z.json',
+            'image-signing.gpg')
+        state = State()
+        state.run_thru('get_index')
+        self.assertEqual(
+            state.index.global_.generated_at,
+            datetime(2013, 4, 29, 18, 45, 27, tzinfo=timezone.utc))
+
     @configuration
     def test_missing_channel(self):
         # The system's channel does not exist.
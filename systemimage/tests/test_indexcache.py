@@ -0,0 +1,213 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the cache of verified, parsed indexes."""
+
+__all__ = [
+    'TestIndexCache',
+    'TestIndexCacheBenchmark',
+    ]
+
+
+import os
+import time
+import unittest
+
+from datetime import datetime, timezone
+from systemimage.config import config
+from systemimage.index import Index
+from systemimage.indexcache import IndexCache
+from systemimage.testing.helpers import (
+    TemporaryDirectoryTestBase, configuration, get_index,
+    skip_unless_benchmark, write_file)
+from systemimage.testing.synthetic import synthetic_index_json
+
+
+class TestIndexCache(TemporaryDirectoryTestBase):
+    def setUp(self):
+        super().setUp()
+        self.index_path = os.path.join(self.tmpdir, 'index.json')
+        self.asc_path = self.index_path + '.asc'
+        write_file(self.index_path, 'index')
+        write_file(self.asc_path, 'signature')
+        self.keyring = os.path.join(self.tmpdir, 'image-signing.tar.xz')
+        write_file(self.keyring, 'keyring')
+        self.blacklist = os.path.join(self.tmpdir, 'blacklist.tar.xz')
+        write_file(self.blacklist, 'blacklist')
+
+    @configuration
+    def test_default_directory(self):
+        self.assertEqual(
+            IndexCache().directory,
+            os.path.join(config.updater.data_partition, 'index-cache'))
+
+    @configuration
+    def test_miss(self):
+        cache = IndexCache()
+        key = cache.key(self.index_path, self.asc_path)
+        fingerprint = cache.fingerprint([self.keyring], self.blacklist)
+        self.assertIsNone(cache.get(key, fingerprint))
+
+    @configuration
+    def test_hit(self):
+        cache = IndexCache()
+        key = cache.key(self.index_path, self.asc_path)
+        fingerprint = cache.fingerprint([self.keyring], self.blacklist)
+        cache.put(key, fingerprint, get_index('index.index_04.json'))
+        index = IndexCache().get(key, fingerprint)
+        self.assertEqual(
+            index.global_.generated_at,
+            datetime(2013, 4, 29, 18, 45, 27, tzinfo=timezone.utc))
+        self.assertEqual(index.images[0].files[1].checksum, 'bcd')
+
+    def test_key_covers_index_and_signature(self):
+        key = IndexCache.key(self.index_path, self.asc_path)
+        write_file(self.asc_path, 'another signature')
+        asc_key = IndexCache.key(self.index_path, self.asc_path)
+        self.assertNotEqual(key, asc_key)
+        write_file(self.index_path, 'another index')
+        self.assertNotEqual(
+            IndexCache.key(self.index_path, self.asc_path), asc_key)
+
+    def test_key_covers_build(self):
+        # An index pruned for one build can't be used for another.
+        key = IndexCache.key(self.index_path, self.asc_path)
+        build_key = IndexCache.key(self.index_path, self.asc_path, 1200)
+        self.assertNotEqual(key, build_key)
+        self.assertNotEqual(
+            IndexCache.key(self.index_path, self.asc_path, 1300), build_key)
+        self.assertEqual(
+            IndexCache.key(self.index_path, self.asc_path, 1200), build_key)
+
+    def test_fingerprint_covers_keyrings_and_blacklist(self):
+        fingerprint = IndexCache.fingerprint([self.keyring], self.blacklist)
+        self.assertNotEqual(
+            IndexCache.fingerprint([self.keyring], None), fingerprint)
+        # The blacklist cannot pose as a signing keyring.
+        self.assertNotEqual(
+            IndexCache.fingerprint([self.keyring, self.blacklist]),
+            fingerprint)
+        write_file(self.blacklist, 'another blacklist')
+        self.assertNotEqual(
+            IndexCache.fingerprint([self.keyring], self.blacklist),
+            fingerprint)
+
+    def test_fingerprint_missing_keyring(self):
+        # A missing device keyring is not the same as an empty one.
+        device = os.path.join(self.tmpdir, 'device-signing.tar.xz')
+        fingerprint = IndexCache.fingerprint([self.keyring, device])
+        write_file(device, '')
+        self.assertNotEqual(
+            IndexCache.fingerprint([self.keyring, device]), fingerprint)
+
+    @configuration
+    def test_keyring_change_invalidates(self):
+        cache = IndexCache()
+        key = cache.key(self.index_path, self.asc_path)
+        fingerprint = cache.fingerprint([self.keyring], self.blacklist)
+        cache.put(key, fingerprint, get_index('index.index_04.json'))
+        write_file(self.keyring, 'new keyring')
+        new_fingerprint = cache.fingerprint([self.keyring], self.blacklist)
+        self.assertIsNone(cache.get(key, new_fingerprint))
+        # Even changing the keyring back doesn't resurrect the entry.
+        self.assertIsNone(cache.get(key, fingerprint))
+        self.assertEqual(os.listdir(cache.directory), [])
+
+    @configuration
+    def test_eviction(self):
+        cache = IndexCache(max_entries=2)
+        fingerprint = cache.fingerprint([self.keyring])
+        index = get_index('index.index_04.json')
+        for key in ('a', 'b', 'c'):
+            cache.put(key, fingerprint, index)
+            # Make sure the modification times differ.
+            time.sleep(0.01)
+        self.assertIsNone(cache.get('a', fingerprint))
+        self.assertIsNotNone(cache.get('b', fingerprint))
+        time.sleep(0.01)
+        # Since 'b' was just used, 'c' is the least recently used entry.
+        cache.put('d', fingerprint, index)
+        self.assertIsNotNone(cache.get('b', fingerprint))
+        self.assertIsNone(cache.get('c', fingerprint))
+        self.assertIsNotNone(cache.get('d', fingerprint))
+
+    @configuration
+    def test_unreadable_entry(self):
+        cache = IndexCache()
+        fingerprint = cache.fingerprint([self.keyring])
+        cache.put('a', fingerprint, get_index('index.index_04.json'))
+        path = os.path.join(cache.directory, fingerprint, 'a.pickle')
+        write_file(path, 'garbage')
+        self.assertIsNone(cache.get('a', fingerprint))
+        self.assertFalse(os.path.exists(path))
+
+    @configuration
+    def test_cached_graph(self):
+        # The cached index calculates the same candidates.
+        cache = IndexCache()
+        fingerprint = cache.fingerprint([self.keyring])
+        index = get_index('candidates.index_13.json')
+        cache.put('a', fingerprint, index)
+        cached = cache.get('a', fingerprint)
+        self.assertEqual(
+            [[image.version for image in path]
+             for path in cached.graph.candidates(300)],
+            [[image.version for image in path]
+             for path in index.graph.candidates(300)])
+
+    @configuration
+    def test_latest(self):
+        # The latest index from each url is kept, apart from the entries.
+        cache = IndexCache(max_entries=1)
+        fingerprint = cache.fingerprint([self.keyring])
+        url = 'https://example.com/stable/nexus7/index.json'
+        self.assertIsNone(cache.get_latest(url, fingerprint))
+        cache.put_latest(url, fingerprint, get_index('index.index_03.json'))
+        cache.put('a', fingerprint, get_index('index.index_04.json'))
+        cache.put('b', fingerprint, get_index('index.index_04.json'))
+        index = IndexCache().get_latest(url, fingerprint)
+        self.assertEqual(len(index.images), 2)
+        self.assertIsNone(cache.get_latest(
+            'https://example.com/stable/mako/index.json', fingerprint))
+
+    @configuration
+    def test_latest_keyring_change_invalidates(self):
+        cache = IndexCache()
+        fingerprint = cache.fingerprint([self.keyring])
+        url = 'https://example.com/stable/nexus7/index.json'
+        cache.put_latest(url, fingerprint, get_index('index.index_03.json'))
+        write_file(self.keyring, 'new keyring')
+        new_fingerprint = cache.fingerprint([self.keyring])
+        self.assertIsNone(cache.get_latest(url, new_fingerprint))
+
+
+@skip_unless_benchmark
+class TestIndexCacheBenchmark(unittest.TestCase):
+    @configuration
+    def test_benchmark(self):
+        data = synthetic_index_json(10000, full_every=10, fork=2)
+        cache = IndexCache()
+        fingerprint = cache.fingerprint([])
+        start = time.perf_counter()
+        index = Index.from_json(data)
+        parse_time = time.perf_counter() - start
+        cache.put('a', fingerprint, index)
+        start = time.perf_counter()
+        cached = cache.get('a', fingerprint)
+        cache_time = time.perf_counter() - start
+        self.assertEqual(len(cached.images), len(index.images))
+        print('\n{} images: parse {:.3f}s, cached {:.3f}s'.format(
+            len(index.images), parse_time, cache_time))
+        self.assertLess(cache_time, parse_time)
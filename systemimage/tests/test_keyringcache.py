@@ -0,0 +1,124 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the cache of unpacked keyrings."""
+
+__all__ = [
+    'TestKeyringCache',
+    ]
+
+
+import os
+import time
+
+from systemimage.config import config
+from systemimage.gpg import Context
+from systemimage.keyringcache import KeyringCache
+from systemimage.testing.helpers import (
+    TemporaryDirectoryTestBase, configuration, data_path, read_file,
+    setup_keyring_txz, write_file)
+from unittest.mock import patch
+
+
+class TestKeyringCache(TemporaryDirectoryTestBase):
+    def setUp(self):
+        super().setUp()
+        self.keyring = os.path.join(self.tmpdir, 'image-signing.tar.xz')
+        setup_keyring_txz(
+            'image-signing.gpg', 'image-master.gpg',
+            dict(type='image-signing', model='nexus7', expiry=1234),
+            self.keyring)
+
+    @configuration
+    def test_default_directory(self):
+        self.assertEqual(
+            KeyringCache().directory,
+            os.path.join(config.updater.data_partition, 'keyring-cache'))
+
+    @configuration
+    def test_get(self):
+        info = KeyringCache().get(self.keyring)
+        self.assertEqual(info.type, 'image-signing')
+        self.assertEqual(info.model, 'nexus7')
+        self.assertEqual(info.expiry, 1234)
+        self.assertEqual(read_file(info.gpg_path),
+                         read_file(data_path('image-signing.gpg')))
+
+    @configuration
+    def test_optional_keys(self):
+        setup_keyring_txz('image-signing.gpg', 'image-master.gpg',
+                          dict(type='image-signing'), self.keyring)
+        info = KeyringCache().get(self.keyring)
+        self.assertEqual(info.type, 'image-signing')
+        self.assertIsNone(info.model)
+        self.assertIsNone(info.expiry)
+
+    @configuration
+    def test_unpacked_once(self):
+        info = KeyringCache().get(self.keyring)
+        with patch('systemimage.keyringcache.tarfile.open') as mock:
+            self.assertEqual(KeyringCache().get(self.keyring), info)
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_changed_keyring(self):
+        # The cache is keyed by the contents of the .tar.xz file.
+        info = KeyringCache().get(self.keyring)
+        setup_keyring_txz('device-signing.gpg', 'image-signing.gpg',
+                          dict(type='device-signing'), self.keyring)
+        new_info = KeyringCache().get(self.keyring)
+        self.assertNotEqual(new_info.gpg_path, info.gpg_path)
+        self.assertEqual(new_info.type, 'device-signing')
+        self.assertEqual(read_file(new_info.gpg_path),
+                         read_file(data_path('device-signing.gpg')))
+
+    @configuration
+    def test_eviction(self):
+        cache = KeyringCache(max_entries=2)
+        paths = []
+        for keyring_type in ('image-signing', 'device-signing', 'blacklist'):
+            path = os.path.join(self.tmpdir, keyring_type + '.tar.xz')
+            setup_keyring_txz('image-signing.gpg', 'image-master.gpg',
+                              dict(type=keyring_type), path)
+            cache.get(path)
+            paths.append(path)
+            # Make sure the modification times differ.
+            time.sleep(0.01)
+        # Only the two most recently used entries are left.
+        self.assertEqual(len(os.listdir(cache.directory)), 4)
+        with patch('systemimage.keyringcache.tarfile.open') as mock:
+            cache.get(paths[1])
+            cache.get(paths[2])
+        self.assertFalse(mock.called)
+
+    @configuration
+    def test_unreadable_entry(self):
+        cache = KeyringCache()
+        info = cache.get(self.keyring)
+        json_path = info.gpg_path[:-len('.gpg')] + '.json'
+        write_file(json_path, 'garbage')
+        self.assertEqual(cache.get(self.keyring), info)
+
+    @configuration
+    def test_context_uses_cache(self):
+        # Verification contexts get the .gpg file from the cache, so it's
+        # only ever unpacked once.
+        KeyringCache().get(self.keyring)
+        with patch('systemimage.keyringcache.tarfile.open') as mock:
+            with Context(self.keyring) as ctx:
+                self.assertEqual(
+                    ctx.fingerprints,
+                    set(['C5E39F07D159687BA3E82BD15A0DE8A4F1F1846F']))
+        self.assertFalse(mock.called)
@@ -29,6 +29,8 @@ __all__ = [
     'TestCLIProgress',
     'TestCLISettings',
     'TestCLISignatures',
+    'TestCLIStartup',
+    'TestCLIStartupBenchmark',
     'TestDBusMain',
     'TestDBusMainNoConfigD',
     ]
@@ -56,8 +58,8 @@ from systemimage.settings import Settings
 from systemimage.testing.controller import USING_PYCURL
 from systemimage.testing.helpers import (
     ServerTestBase, chmod, configuration, copy, data_path, find_dbus_process,
-    sign, temporary_directory, terminate_service, touch_build,
-    wait_for_service)
+    sign, skip_unless_benchmark, temporary_directory, terminate_service,
+    touch_build, wait_for_service)
 from systemimage.testing.nose import SystemImagePlugin
 from textwrap import dedent
 from unittest.mock import MagicMock, patch
@@ -66,6 +68,31 @@ from unittest.mock import MagicMock, patch
 SPACE = ' '
 TIMESTAMP = datetime(2013, 8, 1, 12, 11, 10).timestamp()
 
+# The modules which are slow to import, so that the quick commands, e.g.
+# --info and the settings commands, must not import them.
+SLOW_MODULES = (
+    'dbus',
+    'gi',
+    'gnupg',
+    'pkg_resources',
+    'pycurl',
+    'systemimage.download',
+    'systemimage.gpg',
+    'systemimage.state',
+    )
+# Run the command line script, then dump the names of the imported modules to
+# the file named by the first argument.
+STARTUP_SCRIPT = """\
+import sys, json
+from systemimage.main import main
+path = sys.argv.pop(1)
+try:
+    main()
+finally:
+    with open(path, 'w', encoding='utf-8') as fp:
+        json.dump(sorted(sys.modules), fp)
+"""
+
 
 @contextmanager
 def umask(new_mask):
@@ -389,7 +416,7 @@ class TestCLIMain(unittest.TestCase):
                 raise StopIteration
         self._resources.enter_context(argv('-C', config.config_d))
         self._resources.enter_context(
-            patch('systemimage.main.State', FakeState))
+            patch('systemimage.state.State', FakeState))
         cli_main()
         self.assertTrue(os.path.exists(config.system.logfile))
         with open(config.system.logfile, encoding='utf-8') as fp:
@@ -993,6 +1020,11 @@ class TestCLINoReboot(ServerTestBase):
         self.assertEqual(set(os.listdir(config.updater.data_partition)), set([
             'blacklist.tar.xz',
             'blacklist.tar.xz.asc',
+            'checksums.json',
+            'index-cache',
+            'keyring-cache',
+            'metadata',
+            'payload-cache',
             ]))
         self.assertEqual(set(os.listdir(config.updater.cache_partition)), set([
             '5.txt',
@@ -1047,6 +1079,11 @@ unmount system
         self.assertEqual(set(os.listdir(config.updater.data_partition)), set([
             'blacklist.tar.xz',
             'blacklist.tar.xz.asc',
+            'checksums.json',
+            'index-cache',
+            'keyring-cache',
+            'metadata',
+            'payload-cache',
             ]))
         self.assertEqual(set(os.listdir(config.updater.cache_partition)), set([
             '5.txt',
@@ -1757,6 +1794,35 @@ class TestCLIProgress(ServerTestBase):
         lines = self._stdout.getvalue().splitlines()
         self.assertEqual(len(lines), 0)
 
+    @configuration
+    def test_timings(self, config_d):
+        # --timings prints the cost of each step as JSON when done.
+        self._setup_server_keyrings()
+        with argv('-C', config_d, '-b', '0', '--no-apply', '--timings'):
+            cli_main()
+        lines = self._stdout.getvalue().splitlines()
+        record = json.loads(lines[-1])
+        self.assertEqual(record['type'], 'timings')
+        steps = [step['step'] for step in record['steps']]
+        self.assertEqual(steps[0], 'cleanup')
+        self.assertEqual(steps[-1], 'prepare_recovery')
+        download = record['steps'][steps.index('download_files')]
+        self.assertGreater(download['bytes'], 0)
+        self.assertGreater(download['gpg'], 0)
+        self.assertEqual(record['total']['bytes'],
+                         sum(step['bytes'] for step in record['steps']))
+
+    @configuration
+    def test_dry_run_timings(self, config_d):
+        # --timings works with --dry-run too.
+        self._setup_server_keyrings()
+        with argv('-C', config_d, '-b', '0', '--dry-run', '--timings'):
+            cli_main()
+        lines = self._stdout.getvalue().splitlines()
+        record = json.loads(lines[-1])
+        self.assertEqual(record['type'], 'timings')
+        self.assertEqual(record['steps'][-1]['step'], 'calculate_winner')
+
 
 @unittest.skipIf(USING_PYCURL, 'UDM-only tests')
 class TestCLIGSMOverride(ServerTestBase):
@@ -1803,3 +1869,97 @@ class TestCLIGSMOverride(ServerTestBase):
         # call args.
         args, kws = mock.call_args
         self.assertTrue(kws['allow_gsm'])
+
+
+def _subprocess_env():
+    # The command line script must be run from the same code as the tests.
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+
+
+class TestCLIStartup(unittest.TestCase):
+    """The quick commands don't import what they don't need."""
+
+    def _imported(self, *args):
+        # Run the command line script in a fresh interpreter, returning the
+        # slow modules it imported.
+        with temporary_directory() as tempdir:
+            path = os.path.join(tempdir, 'modules.json')
+            subprocess.check_call(
+                (sys.executable, '-c', STARTUP_SCRIPT, path) + args,
+                env=_subprocess_env(), stdout=subprocess.DEVNULL)
+            with open(path, encoding='utf-8') as fp:
+                modules = json.load(fp)
+        return [module for module in SLOW_MODULES if module in modules]
+
+    @configuration
+    def test_info(self, config_d):
+        touch_build(1701, TIMESTAMP)
+        self.assertEqual(self._imported('-C', config_d, '--info'), [])
+
+    @configuration
+    def test_settings(self, config_d):
+        self.assertEqual(
+            self._imported('-C', config_d, '--set', 'peart=neil'), [])
+        self.assertEqual(self._imported('-C', config_d, '--get', 'peart'), [])
+        self.assertEqual(self._imported('-C', config_d, '--show-settings'), [])
+        self.assertEqual(self._imported('-C', config_d, '--del', 'peart'), [])
+
+
+@skip_unless_benchmark
+@unittest.skipUnless(sys.version_info >= (3, 7),
+                     '-X importtime requires Python 3.7')
+class TestCLIStartupBenchmark(unittest.TestCase):
+    # What the command line script used to import up front.
+    BASELINE = ('dbus.mainloop.glib', 'pkg_resources', 'systemimage.state')
+
+    def _import_time(self, *modules):
+        # The total import time in seconds of the command line script and the
+        # given modules, as reported by -X importtime.  The best of several
+        # runs is taken.
+        statement = '; '.join('import ' + module for module in
+                              ('systemimage.main',) + modules)
+        times = []
+        for i in range(5):
+            stderr = subprocess.run(
+                (sys.executable, '-X', 'importtime', '-c', statement),
+                env=_subprocess_env(), stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE, universal_newlines=True,
+                check=True).stderr
+            total = 0
+            for line in stderr.splitlines():
+                if not line.startswith('import time:'):
+                    continue
+                self_time, cumulative, name = line[12:].split('|')
+                # Only count the top level imports, since their cumulative
+                # times include the nested ones.  Skip the header too.
+                if name.startswith('  ') or not cumulative.strip().isdigit():
+                    continue
+                total += int(cumulative)
+            times.append(total / 1e6)
+        return min(times)
+
+    def _run_time(self, *args):
+        # The best wall clock time in seconds of several runs of the command
+        # line script.
+        times = []
+        with temporary_directory() as tempdir:
+            path = os.path.join(tempdir, 'modules.json')
+            for i in range(5):
+                start = time.perf_counter()
+                subprocess.check_call(
+                    (sys.executable, '-c', STARTUP_SCRIPT, path) + args,
+                    env=_subprocess_env(), stdout=subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+        return min(times)
+
+    @configuration
+    def test_benchmark(self, config_d):
+        touch_build(1701, TIMESTAMP)
+        baseline = self._import_time(*self.BASELINE)
+        lazy = self._import_time()
+        info = self._run_time('-C', config_d, '--info')
+        settings = self._run_time('-C', config_d, '--show-settings')
+        print('\nimport time: baseline {:.3f}s, lazy {:.3f}s; '
+              'run time: --info {:.3f}s, --show-settings {:.3f}s'.format(
+                  baseline, lazy, info, settings))
+        self.assertLess(lazy, baseline)
@@ -0,0 +1,225 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the content-addressed cache of update files."""
+
+__all__ = [
+    'TestLinkOrCopy',
+    'TestPayloadCache',
+    ]
+
+
+import os
+import errno
+
+from contextlib import ExitStack
+from hashlib import sha256
+from systemimage.config import config
+from systemimage.payloadcache import PayloadCache, link_or_copy
+from systemimage.testing.helpers import (
+    TemporaryDirectoryTestBase, configuration, read_file, write_file)
+from unittest.mock import patch
+
+
+class TestLinkOrCopy(TemporaryDirectoryTestBase):
+    def setUp(self):
+        super().setUp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        self.dst = os.path.join(self.tmpdir, 'dst')
+        write_file(self.src, b'payload')
+
+    def test_link(self):
+        # On the same file system, the file is hard linked.
+        link_or_copy(self.src, self.dst)
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+
+    def test_replace(self):
+        # An existing file is replaced.
+        write_file(self.dst, b'stale')
+        link_or_copy(self.src, self.dst)
+        self.assertEqual(read_file(self.dst), b'payload')
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['dst', 'src'])
+
+    def test_copy(self):
+        # Across file systems, which don't support reflinks, the file is
+        # copied.
+        with patch('systemimage.payloadcache.os.link', side_effect=OSError), \
+             patch('systemimage.payloadcache.fcntl.ioctl',
+                   side_effect=OSError) as ioctl:
+            link_or_copy(self.src, self.dst)
+        self.assertTrue(ioctl.called)
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+        self.assertEqual(read_file(self.dst), b'payload')
+
+
+class TestPayloadCache(TemporaryDirectoryTestBase):
+    def setUp(self):
+        super().setUp()
+        self.directory = os.path.join(self.tmpdir, 'payload-cache')
+        self.cache = PayloadCache(self.directory, max_size=1000)
+
+    def _payload(self, name, contents):
+        # Create a data file and its signature file, returning the entry for
+        # update().
+        dst = os.path.join(self.tmpdir, name)
+        write_file(dst, contents)
+        write_file(dst + '.asc', b'signature of ' + contents)
+        return sha256(contents).hexdigest(), dst, dst + '.asc'
+
+    def _touch(self, checksum, mtime):
+        path = os.path.join(self.directory, checksum + '.json')
+        os.utime(path, (mtime, mtime))
+
+    def test_miss(self):
+        dst = os.path.join(self.tmpdir, 'a.txt')
+        self.assertFalse(self.cache.get('0' * 64, dst, dst + '.asc'))
+        self.assertFalse(os.path.exists(dst))
+
+    def test_get(self):
+        # A cached file can be retrieved under any name.
+        checksum, dst, asc = self._payload('a.txt', b'aaa')
+        self.cache.update([(checksum, dst, asc)])
+        other = os.path.join(self.tmpdir, 'b.txt')
+        self.assertTrue(self.cache.get(checksum, other, other + '.asc'))
+        self.assertEqual(read_file(other), b'aaa')
+        self.assertEqual(read_file(other + '.asc'), b'signature of aaa')
+        # The files were linked, not copied.
+        self.assertTrue(os.path.samefile(dst, other))
+
+    def test_survives_removal(self):
+        # The cached files are kept even when the originals are removed.
+        checksum, dst, asc = self._payload('a.txt', b'aaa')
+        self.cache.update([(checksum, dst, asc)])
+        os.remove(dst)
+        os.remove(asc)
+        self.assertTrue(self.cache.get(checksum, dst, asc))
+        self.assertEqual(read_file(dst), b'aaa')
+
+    def test_already_cached(self):
+        # Updating an entry which is already cached leaves the files alone.
+        checksum, dst, asc = self._payload('a.txt', b'aaa')
+        self.cache.update([(checksum, dst, asc)])
+        os.utime(dst, (1, 1))
+        os.utime(asc, (1, 1))
+        self._touch(checksum, 1)
+        self.cache.update([(checksum, dst, asc)])
+        self.assertEqual(os.stat(dst).st_mtime, 1)
+        self.assertEqual(os.stat(asc).st_mtime, 1)
+        # But the entry was used.
+        json_path = os.path.join(self.directory, checksum + '.json')
+        self.assertGreater(os.stat(json_path).st_mtime, 1)
+
+    def test_discard(self):
+        checksum, dst, asc = self._payload('a.txt', b'aaa')
+        self.cache.update([(checksum, dst, asc)])
+        self.cache.discard(checksum)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertFalse(self.cache.get(checksum, dst, asc))
+        # Discarding a missing entry is fine.
+        self.cache.discard(checksum)
+
+    def test_evict_least_recently_used(self):
+        # Each entry here is 103 + 116 bytes, so only four of them fit.
+        entries = [self._payload('{}.txt'.format(i), bytes([i]) * 103)
+                   for i in range(4)]
+        self.cache.update(entries)
+        for i, (checksum, dst, asc) in enumerate(entries):
+            self._touch(checksum, 100 + i)
+        # Use the oldest entry again.
+        other = os.path.join(self.tmpdir, 'other.txt')
+        self.assertTrue(self.cache.get(entries[0][0], other, other + '.asc'))
+        # Adding a fifth entry evicts what is now the least recently used.
+        entries.append(self._payload('4.txt', bytes([4]) * 103))
+        self.cache.update(entries[-1:])
+        cached = [self.cache.get(checksum, other, other + '.asc')
+                  for checksum, dst, asc in entries]
+        self.assertEqual(cached, [True, False, True, True, True])
+
+    def test_too_big(self):
+        # An entry larger than the cache isn't kept.
+        checksum, dst, asc = self._payload('a.txt', b'a' * 1000)
+        self.cache.update([(checksum, dst, asc)])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_incomplete_entries(self):
+        # Incomplete entries and temporary files are thrown away.
+        os.makedirs(self.directory)
+        for name in ('abc', 'def.asc', 'ghi.tmp', 'jkl.json.tmp'):
+            write_file(os.path.join(self.directory, name), b'x')
+        checksum, dst, asc = self._payload('a.txt', b'aaa')
+        self.cache.update([(checksum, dst, asc)])
+        self.assertEqual(sorted(os.listdir(self.directory)), [
+            checksum, checksum + '.asc', checksum + '.json'])
+
+    def test_unreadable_entry(self):
+        checksum, dst, asc = self._payload('a.txt', b'aaa')
+        self.cache.update([(checksum, dst, asc)])
+        write_file(os.path.join(self.directory, checksum + '.json'),
+                   'not json')
+        self.cache.update([])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_other_file_system(self):
+        # Files on another file system than the cache, which can't be hard
+        # linked into it, are copied there instead.
+        checksum, dst, asc = self._payload('a.txt', b'aaa')
+        os.makedirs(self.directory)
+        device = os.stat(self.directory).st_dev
+        stat = os.stat
+        def other_device(path, *args, **kws):
+            result = stat(path, *args, **kws)
+            if path not in (dst, asc):
+                return result
+            fields = list(result)
+            fields[2] = device + 1
+            return os.stat_result(fields)
+        with ExitStack() as resources:
+            resources.enter_context(patch(
+                'systemimage.payloadcache.os.stat', side_effect=other_device))
+            resources.enter_context(patch(
+                'systemimage.payloadcache.os.link',
+                side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')))
+            self.cache.update([(checksum, dst, asc)])
+            self.assertNotEqual(os.stat(dst).st_dev, device)
+        self.assertEqual(sorted(os.listdir(self.directory)), [
+            checksum, checksum + '.asc', checksum + '.json'])
+        other = os.path.join(self.tmpdir, 'b.txt')
+        self.assertTrue(self.cache.get(checksum, other, other + '.asc'))
+        self.assertEqual(read_file(other), b'aaa')
+        self.assertEqual(read_file(other + '.asc'), b'signature of aaa')
+        self.assertFalse(os.path.samefile(
+            dst, os.path.join(self.directory, checksum)))
+
+    def test_disabled(self):
+        # A maximum size of 0 disables the cache.
+        cache = PayloadCache(self.directory, max_size=0)
+        checksum, dst, asc = self._payload('a.txt', b'aaa')
+        cache.update([(checksum, dst, asc)])
+        self.assertFalse(os.path.exists(self.directory))
+        self.assertFalse(cache.get(checksum, dst, asc))
+
+    @configuration
+    def test_defaults(self):
+        cache = PayloadCache()
+        self.assertEqual(cache.directory, os.path.join(
+            config.updater.data_partition, 'payload-cache'))
+        self.assertEqual(cache.max_size, 1024 * 1024 * 1024)
+
+    @configuration
+    def test_configured_directory(self):
+        directory = os.path.join(
+            config.updater.cache_partition, 'payload-cache')
+        config.updater.payload_cache = directory
+        self.assertEqual(PayloadCache().directory, directory)
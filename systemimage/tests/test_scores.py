@@ -15,19 +15,65 @@
 
 __all__ = [
     'TestPhasedUpdates',
+    'TestShortestPathScorer',
+    'TestShortestPathScorerBenchmark',
     'TestVersionDetail',
     'TestWeightedScorer',
+    'TestWeightedScorerBenchmark',
     ]
 
 
+import time
+import logging
 import unittest
+import tracemalloc
 
+from itertools import count
+from pkg_resources import resource_listdir
 from systemimage.candidates import get_candidates
-from systemimage.scores import WeightedScorer
-from systemimage.testing.helpers import descriptions, get_index
+from systemimage.helpers import MiB
+from systemimage.scores import ShortestPathScorer, WeightedScorer
+from systemimage.testing.helpers import (
+    descriptions, get_index, skip_unless_benchmark)
+from systemimage.testing.synthetic import synthetic_index
 from unittest.mock import patch
 
 
+def _reference_score(candidates):
+    # This is how WeightedScorer scored the paths before it cached the
+    # metrics of each image.
+    max_build = 0
+    min_size = None
+    candidate_data = []
+    for path in candidates:
+        build = path[-1].version
+        size = 0
+        for image in path:
+            size += sum(filerec.size for filerec in image.files)
+        reboots = sum(1 for image in path
+                      if getattr(image, 'bootme', False))
+        candidate_data.append((build, size, reboots))
+        max_build = max(build, max_build)
+        min_size = (size if (min_size is None or size < min_size)
+                    else min_size)
+    scores = []
+    for build, size, reboots in candidate_data:
+        distance = max_build - build
+        scores.append((100 * reboots) + ((size - min_size) // MiB) +
+                      (9000 * distance) + distance)
+    return scores
+
+
+def _reference_choose(candidates, device_percentage):
+    # And this is how Scorer.choose() picked the winner.
+    for score, i, path in sorted(
+            zip(_reference_score(candidates), count(), candidates)):
+        image_percentage = path[-1].phased_percentage
+        if image_percentage > 0 and device_percentage <= image_percentage:
+            return path
+    return []
+
+
 class TestWeightedScorer(unittest.TestCase):
     def setUp(self):
         self.scorer = WeightedScorer()
@@ -88,6 +134,64 @@ class TestWeightedScorer(unittest.TestCase):
         self.assertEqual(path[0].version, 1800)
 
 
+    def test_identical_to_reference(self):
+        # The scores and winners are exactly those of the original scorer,
+        # for every test index and a few synthetic ones.
+        skip = {'dbus.index_05.json', 'index.index_05.json'}
+        indexes = [(filename, get_index(filename))
+                   for filename in sorted(resource_listdir(
+                       'systemimage.tests.data', ''))
+                   if (filename.endswith('.json') and
+                       '.index_' in filename and
+                       filename not in skip)]
+        indexes.extend([
+            ('synthetic 1', synthetic_index(
+                120, full_every=25, fork=3, fork_every=40, bootme_every=7,
+                minversion_every=2)),
+            ('synthetic 2', synthetic_index(
+                24, full_every=10, fork=2, fork_every=3, bootme_every=3)),
+            ])
+        for name, index in indexes:
+            builds = {0, 1}
+            builds.update(image.version for image in index.images)
+            for build in sorted(builds):
+                candidates = get_candidates(index, build)
+                message = '{} from build {}'.format(name, build)
+                self.assertEqual(self.scorer.score(candidates),
+                                 _reference_score(candidates), message)
+                for percentage in (0, 50, 100):
+                    with patch('systemimage.scores.phased_percentage',
+                               return_value=percentage):
+                        winner = self.scorer.choose(candidates, 'devel')
+                    expected = _reference_choose(candidates, percentage)
+                    # The very same images, since equal images may be in
+                    # different paths.
+                    self.assertEqual(list(map(id, winner)),
+                                     list(map(id, expected)), message)
+
+    def test_equal_images(self):
+        # Paths may contain images which are equal but not identical, e.g.
+        # from two parses of the same index.
+        first = get_candidates(get_index('scores.index_03.json'), 600)
+        second = get_candidates(get_index('scores.index_03.json'), 600)
+        self.assertEqual(self.scorer.score(first + second),
+                         _reference_score(first + second))
+
+    def test_debug_logging(self):
+        # The candidate paths are only formatted for the log when debug
+        # logging is enabled.
+        candidates = get_candidates(get_index('scores.index_03.json'), 600)
+        with patch('systemimage.scores.log') as log:
+            log.isEnabledFor.return_value = False
+            winner = self.scorer.choose(candidates, 'devel')
+        self.assertEqual(log.debug.call_count, 0)
+        with patch('systemimage.scores.log') as log:
+            log.isEnabledFor.return_value = True
+            self.assertIs(self.scorer.choose(candidates, 'devel'), winner)
+        log.isEnabledFor.assert_called_with(logging.DEBUG)
+        self.assertEqual(log.debug.call_count, len(candidates) + 2)
+
+
 class TestPhasedUpdates(unittest.TestCase):
     def setUp(self):
         self.scorer = WeightedScorer()
@@ -198,3 +302,144 @@ class TestVersionDetail(unittest.TestCase):
         self.assertEqual(descriptions(winner),
                          ['Full B', 'Delta B.1', 'Delta B.2'])
         self.assertEqual(winner[-1].version_detail, '')
+
+
+class TestShortestPathScorer(unittest.TestCase):
+    def setUp(self):
+        self.scorer = ShortestPathScorer()
+
+    def test_choose_no_candidates(self):
+        index = get_index('candidates.index_01.json')
+        self.assertEqual(self.scorer.choose_from_index(index, 1400, 'devel'),
+                         [])
+
+    def test_one_path(self):
+        index = get_index('scores.index_02.json')
+        winner = self.scorer.choose_from_index(index, 600, 'devel')
+        self.assertEqual([image.version for image in winner], [1300, 1301])
+
+    def test_three_paths(self):
+        # See TestWeightedScorer.test_three_paths().  Path B wins.
+        index = get_index('scores.index_03.json')
+        winner = self.scorer.choose_from_index(index, 600, 'devel')
+        self.assertEqual([image.version for image in winner],
+                         [1200, 1201, 1304])
+        self.assertEqual(descriptions(winner),
+                         ['Full B', 'Delta B.1', 'Delta B.2'])
+
+    def test_tied_candidates(self):
+        index = get_index('scores.index_04.json')
+        path = self.scorer.choose_from_index(index, 1, 'devel')
+        self.assertEqual(len(path), 1)
+        self.assertEqual(path[0].version, 1800)
+
+    def test_inside_phase_gets_update(self):
+        index = get_index('scores.index_05.json')
+        with patch('systemimage.scores.phased_percentage', return_value=22):
+            winner = self.scorer.choose_from_index(index, 100, 'devel')
+        self.assertEqual(descriptions(winner),
+                         ['Full B', 'Delta B.1', 'Delta B.2'])
+
+    def test_outside_phase_gets_update(self):
+        # The best path's target is outside the device's phase, so the
+        # scorer falls back to the next best target.
+        index = get_index('scores.index_05.json')
+        with patch('systemimage.scores.phased_percentage', return_value=66):
+            winner = self.scorer.choose_from_index(index, 100, 'devel')
+        self.assertEqual(descriptions(winner),
+                         ['Full A', 'Delta A.1', 'Delta A.2'])
+
+    def test_pulled_update(self):
+        index = get_index('scores.index_01.json')
+        with patch('systemimage.scores.phased_percentage', return_value=0):
+            winner = self.scorer.choose_from_index(index, 100, 'devel')
+        self.assertEqual(descriptions(winner),
+                         ['Full A', 'Delta A.1', 'Delta A.2'])
+
+    def test_pulled_update_insanely_positive_randint(self):
+        index = get_index('scores.index_01.json')
+        with patch('systemimage.scores.phased_percentage', return_value=1000):
+            winner = self.scorer.choose_from_index(index, 100, 'devel')
+        self.assertEqual(winner, [])
+
+    def test_same_winner_as_weighted_scorer(self):
+        # On a forked graph with reboots and minversions, the winner is the
+        # same one the WeightedScorer picks from the full list of candidates.
+        index = synthetic_index(
+            120, full_every=25, fork=3, fork_every=40, bootme_every=7,
+            minversion_every=2)
+        weighted = WeightedScorer()
+        for build in (0, 1, 37, 50, 79, 100, 119, 120):
+            for percentage in (0, 50, 100):
+                with patch('systemimage.scores.phased_percentage',
+                           return_value=percentage):
+                    expected = weighted.choose(
+                        get_candidates(index, build), 'devel')
+                    got = self.scorer.choose_from_index(index, build, 'devel')
+                self.assertEqual(descriptions(got), descriptions(expected))
+
+    def test_default_choose_from_index(self):
+        # Other scorers choose from the full list of candidates.
+        index = get_index('scores.index_03.json')
+        winner = WeightedScorer().choose_from_index(index, 600, 'devel')
+        self.assertEqual(descriptions(winner),
+                         ['Full B', 'Delta B.1', 'Delta B.2'])
+
+
+@skip_unless_benchmark
+class TestShortestPathScorerBenchmark(unittest.TestCase):
+    def _measure(self, function):
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return result, elapsed, peak
+
+    def test_benchmark(self):
+        # Every 10th build forks three ways, so there are 3**9 candidate
+        # paths from build 1030.
+        index = synthetic_index(
+            1120, full_every=200, fork=3, fork_every=10, bootme_every=11)
+        index.graph
+        build = 1030
+        with patch('systemimage.scores.phased_percentage', return_value=50):
+            expected, weighted_time, weighted_peak = self._measure(
+                lambda: WeightedScorer().choose_from_index(
+                    index, build, 'devel'))
+            got, graph_time, graph_peak = self._measure(
+                lambda: ShortestPathScorer().choose_from_index(
+                    index, build, 'devel'))
+        self.assertEqual(descriptions(got), descriptions(expected))
+        print('\nweighted: {:.3f}s {}KiB, '
+              'shortest path: {:.3f}s {}KiB'.format(
+                  weighted_time, weighted_peak // 1024,
+                  graph_time, graph_peak // 1024))
+        self.assertLess(graph_time, weighted_time)
+        self.assertLess(graph_peak, weighted_peak)
+
+
+@skip_unless_benchmark
+class TestWeightedScorerBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        # Every other build forks two ways, so there are 2**17 candidate
+        # paths from build 46.
+        index = synthetic_index(
+            80, full_every=200, fork=2, fork_every=2, bootme_every=11)
+        candidates = get_candidates(index, 46)
+        self.assertGreater(len(candidates), 100000)
+        scorer = WeightedScorer()
+        with patch('systemimage.scores.phased_percentage', return_value=50):
+            start = time.perf_counter()
+            expected = _reference_choose(candidates, 50)
+            reference_time = time.perf_counter() - start
+            start = time.perf_counter()
+            got = scorer.choose(candidates, 'devel')
+            choose_time = time.perf_counter() - start
+        self.assertIs(got, expected)
+        print('\n{} paths: reference {:.3f}s, weighted {:.3f}s'.format(
+            len(candidates), reference_time, choose_time))
+        self.assertLess(choose_time, reference_time)
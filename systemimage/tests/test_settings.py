@@ -21,12 +21,13 @@ __all__ = [
 
 
 import os
+import sqlite3
 import unittest
 
 from contextlib import ExitStack
 from pathlib import Path
 from systemimage.helpers import temporary_directory
-from systemimage.settings import Settings
+from systemimage.settings import SCHEMA_VERSION, Settings, remove_database
 from systemimage.testing.helpers import chmod, configuration
 from unittest.mock import patch
 
@@ -102,6 +103,104 @@ class TestSettings(unittest.TestCase):
         keyval.sort()
         self.assertEqual(keyval, [('a', 'ant'), ('b', 'bee'), ('c', 'cat')])
 
+    @configuration
+    def test_update_many(self):
+        # Several keys can be set at once.
+        settings = Settings()
+        settings.set('a', 'aardvark')
+        settings.update([('a', 'ant'), ('b', 'bee')])
+        self.assertEqual(sorted(settings), [('a', 'ant'), ('b', 'bee')])
+
+    @configuration
+    def test_update_is_atomic(self):
+        # If any of the keys can't be set, none of them are.
+        settings = Settings()
+        with self.assertRaises(sqlite3.Error):
+            settings.update([('a', 'ant'), ('b', object())])
+        self.assertEqual(list(settings), [])
+
+    @configuration
+    def test_no_duplicates(self, config):
+        # Creating Settings objects doesn't add rows to the database.
+        for i in range(3):
+            Settings().set('animal', 'ant')
+        with sqlite3.connect(config.system.settings_db) as conn:
+            rows = conn.execute('select * from settings').fetchall()
+        conn.close()
+        self.assertEqual(sorted(rows), [
+            ('__version__', SCHEMA_VERSION), ('animal', 'ant')])
+
+    @configuration
+    def test_migrate_duplicates(self, config):
+        # Version 1 databases could contain duplicate rows.  They are
+        # collapsed, with the last one winning.
+        with sqlite3.connect(config.system.settings_db) as conn:
+            conn.execute('create table settings (key, value)')
+            conn.executemany('insert into settings values (?, ?)', [
+                ('__version__', '1'),
+                ('animal', 'ant'),
+                ('__version__', '1'),
+                ('animal', 'bee'),
+                ('auto_download', '0'),
+                ])
+        conn.close()
+        settings = Settings()
+        self.assertEqual(sorted(settings), [
+            ('animal', 'bee'), ('auto_download', '0')])
+        settings.set('animal', 'cat')
+        with sqlite3.connect(config.system.settings_db) as conn:
+            rows = conn.execute('select * from settings').fetchall()
+        conn.close()
+        self.assertEqual(sorted(rows), [
+            ('__version__', SCHEMA_VERSION),
+            ('animal', 'cat'),
+            ('auto_download', '0'),
+            ])
+
+    @configuration
+    def test_wal(self, config):
+        Settings()
+        with sqlite3.connect(config.system.settings_db) as conn:
+            mode = conn.execute('pragma journal_mode').fetchone()[0]
+        conn.close()
+        self.assertEqual(mode, 'wal')
+
+    @configuration
+    def test_connection_reused(self):
+        # All Settings objects share one connection to the database.
+        Settings()
+        with patch('systemimage.settings.sqlite3.connect') as connect:
+            settings = Settings()
+            settings.set('animal', 'ant')
+            self.assertEqual(Settings().get('animal'), 'ant')
+        self.assertFalse(connect.called)
+
+    @configuration
+    def test_database_replaced(self, config):
+        # If the database file is replaced, e.g. removed and created again,
+        # a new connection is made.
+        Settings().set('animal', 'ant')
+        for suffix in ('', '-wal', '-shm'):
+            path = config.system.settings_db + suffix
+            if os.path.exists(path):
+                os.remove(path)
+        self.assertEqual(Settings().get('animal'), '')
+        self.assertTrue(os.path.exists(config.system.settings_db))
+
+    @configuration
+    def test_remove_database(self, config):
+        # Removing the database also removes the write-ahead log files and
+        # closes the shared connection.
+        Settings().set('animal', 'ant')
+        self.assertTrue(os.path.exists(config.system.settings_db + '-wal'))
+        remove_database(config.system.settings_db)
+        for suffix in ('', '-wal', '-shm'):
+            self.assertFalse(
+                os.path.exists(config.system.settings_db + suffix))
+        self.assertEqual(Settings().get('animal'), '')
+        # Removing a missing database is fine.
+        remove_database(config.system.settings_db)
+
     @unittest.skipIf(os.getuid() == 0, 'Test cannot succeed when run as root')
     @configuration
     def test_settings_db_permission_denied(self, config):
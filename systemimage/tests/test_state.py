@@ -26,6 +26,7 @@ __all__ = [
     'TestMaximumImage',
     'TestMiscellaneous',
     'TestPhasedUpdates',
+    'TestPipelinedVerifier',
     'TestState',
     'TestStateDuplicateDestinations',
     'TestStateNewChannelsFormat',
@@ -38,23 +39,25 @@ import shutil
 import hashlib
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from datetime import datetime, timedelta, timezone
 from functools import partial
 from subprocess import CalledProcessError
 from systemimage.candidates import version_filter
 from systemimage.config import config
-from systemimage.download import DuplicateDestinationError
+from systemimage.download import DuplicateDestinationError, Record
 from systemimage.gpg import Context, SignatureError
 from systemimage.helpers import calculate_signature
-from systemimage.state import ChecksumError, State
+from systemimage.state import ChecksumError, State, _PipelinedVerifier
 from systemimage.testing.demo import DemoDevice
 from systemimage.testing.helpers import (
     ServerTestBase, configuration, copy, data_path, descriptions, get_index,
     make_http_server, setup_keyring_txz, setup_keyrings, sign,
     temporary_directory, touch_build)
+from systemimage.testing.controller import USING_PYCURL
 from systemimage.testing.nose import SystemImagePlugin
-from unittest.mock import call, patch
+from unittest.mock import Mock, call, patch
 
 BAD_SIGNATURE = 'f' * 64
 
@@ -1435,6 +1438,64 @@ class TestCachedFiles(ServerTestBase):
                 path = os.path.join(config.updater.cache_partition, filename)
                 self.assertEqual(mtimes[filename], os.stat(path).st_mtime_ns)
 
+    @configuration
+    def test_payload_cache(self):
+        # Verified files are kept in the payload cache, so even once they're
+        # gone from the cache partition, e.g. because an update from another
+        # channel was downloaded in the meantime, they aren't downloaded
+        # again.
+        self._setup_server_keyrings()
+        touch_build(0)
+        State().run_thru('download_files')
+        cache_dir = config.updater.cache_partition
+        for filename in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, filename))
+        state = State()
+        state.run_thru('calculate_winner')
+        def get_files(downloads, *args, **kws):
+            if len(downloads) != 0:
+                raise AssertionError('get_files() was called with downloads')
+        state.downloader.get_files = get_files
+        state.run_thru('download_files')
+        self.assertEqual(set(os.listdir(cache_dir)),
+                         set(('5.txt', '6.txt', '7.txt',
+                              '5.txt.asc', '6.txt.asc', '7.txt.asc')))
+
+    @configuration
+    def test_bad_payload_cache(self):
+        # A cached file which doesn't verify is downloaded again, and thrown
+        # out of the payload cache.
+        self._setup_server_keyrings()
+        touch_build(0)
+        State().run_thru('download_files')
+        cache_dir = config.updater.cache_partition
+        for filename in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, filename))
+        # The cached copy of 6.txt gets corrupted.
+        with open(os.path.join(self._serverdir, '4/5/6.txt'), 'rb') as fp:
+            checksum = calculate_signature(fp)
+        path = os.path.join(
+            config.updater.data_partition, 'payload-cache', checksum)
+        os.remove(path)
+        with open(path, 'wb') as fp:
+            fp.write(b'corrupt')
+        state = State()
+        state.run_thru('calculate_winner')
+        old_get_files = state.downloader.get_files
+        def get_files(downloads, *args, **kws):
+            if (sorted(os.path.basename(record.destination)
+                       for record in downloads) != ['6.txt', '6.txt.asc']):
+                raise AssertionError('Unexpected get_files() call')
+            return old_get_files(downloads, *args, **kws)
+        state.downloader.get_files = get_files
+        state.run_thru('download_files')
+        self.assertEqual(set(os.listdir(cache_dir)),
+                         set(('5.txt', '6.txt', '7.txt',
+                              '5.txt.asc', '6.txt.asc', '7.txt.asc')))
+        # The downloaded file replaced the corrupt one in the payload cache.
+        with open(path, 'rb') as fp:
+            self.assertEqual(calculate_signature(fp), checksum)
+
     @configuration
     def test_cleanup_in_download(self):
         # Any residual cache partition files which aren't used in the current
@@ -1705,7 +1766,13 @@ class TestMiscellaneous(ServerTestBase):
         # give us a good hook into the post-download, pre-checksum logic.  We
         # can't corrupt the server file because the lower-level downloading
         # logic will complain.  Instead, we mock the calculate_signature()
-        # function to produce a broken checksum for one of the files.
+        # function to produce a broken checksum for one of the files.  The
+        # downloader may have reported the checksums it verified while
+        # downloading, so forget those to force the files to be read.
+        real_get_files = state.downloader.get_files
+        def get_files(*args, **kws):
+            real_get_files(*args, **kws)
+            state.downloader.checksums.clear()
         real_signature = None
         def broken_calc(fp, hash_class=None):
             nonlocal real_signature
@@ -1714,7 +1781,11 @@ class TestMiscellaneous(ServerTestBase):
                 real_signature = signature
                 return BAD_SIGNATURE
             return signature
-        with patch('systemimage.state.calculate_signature', broken_calc):
+        with ExitStack() as resources:
+            resources.enter_context(
+                patch('systemimage.state.calculate_signature', broken_calc))
+            resources.enter_context(
+                patch.object(state.downloader, 'get_files', get_files))
             with self.assertRaises(ChecksumError) as cm:
                 state.run_thru('download_files')
         self.assertEqual(os.path.basename(cm.exception.destination), '6.txt')
@@ -1722,6 +1793,88 @@ class TestMiscellaneous(ServerTestBase):
         self.assertIsNotNone(real_signature)
         self.assertEqual(cm.exception.expected, real_signature)
 
+    @configuration
+    def test_reported_checksum_error(self):
+        # The checksums which the downloader reports are verified too.
+        self._setup_server_keyrings()
+        state = State()
+        state.run_until('download_files')
+        real_get_files = state.downloader.get_files
+        def get_files(downloads, **kws):
+            real_get_files(downloads, **kws)
+            for record in downloads:
+                if os.path.basename(record.destination) == '6.txt':
+                    state.downloader.checksums[record.destination] = (
+                        BAD_SIGNATURE)
+        with patch.object(state.downloader, 'get_files', get_files):
+            with self.assertRaises(ChecksumError) as cm:
+                state.run_thru('download_files')
+        self.assertEqual(os.path.basename(cm.exception.destination), '6.txt')
+        self.assertEqual(cm.exception.got, BAD_SIGNATURE)
+
+    @unittest.skipUnless(USING_PYCURL,
+                         'Only PyCURL reports the downloaded checksums')
+    @configuration
+    def test_downloaded_files_are_not_read_again(self):
+        # The checksums calculated while downloading the files are used,
+        # and they are remembered, so on the next run, checking whether the
+        # downloaded files can be reused doesn't read them again either.
+        self._setup_server_keyrings()
+        with patch('systemimage.state.calculate_signature') as mock:
+            State().run_thru('download_files')
+        self.assertFalse(mock.called)
+        with patch('systemimage.checksums.calculate_signature') as mock:
+            state = State()
+            state.run_thru('download_files')
+        self.assertFalse(mock.called)
+        # Nothing needed to be downloaded the second time.
+        self.assertEqual(state.downloader.checksums, {})
+
+    @unittest.skipUnless(USING_PYCURL, 'Only PyCURL completes files early')
+    @configuration
+    def test_verified_while_downloading(self):
+        # Each data file is verified as soon as it and its signature are
+        # downloaded, while the other files are still downloading.
+        self._setup_server_keyrings()
+        state = State()
+        state.run_until('download_files')
+        downloading = False
+        early = []
+        real_get_files = state.downloader.get_files
+        def get_files(*args, **kws):
+            nonlocal downloading
+            downloading = True
+            try:
+                real_get_files(*args, **kws)
+            finally:
+                downloading = False
+        real_submit = _PipelinedVerifier._submit
+        def submit(verifier, indexes):
+            early.append(downloading)
+            real_submit(verifier, indexes)
+        with ExitStack() as resources:
+            resources.enter_context(
+                patch.object(state.downloader, 'get_files', get_files))
+            resources.enter_context(
+                patch('systemimage.state._PipelinedVerifier._submit', submit))
+            state.run_thru('download_files')
+        self.assertTrue(any(early))
+
+    @configuration
+    def test_prefetch_metadata(self):
+        # With prefetching, the metadata files are downloaded in two groups,
+        # ahead of the steps which verify them, to the same effect.
+        self._setup_server_keyrings()
+        config.system.update(prefetch='yes')
+        state = State()
+        with patch.object(state.downloader, 'prefetch',
+                          wraps=state.downloader.prefetch) as mock:
+            state.run_thru('get_index')
+        self.assertEqual(mock.call_count, 2)
+        self.assertIsNotNone(state.index)
+        # Nothing prefetched is left over.
+        self.assertEqual(state.downloader._prefetched, {})
+
     @configuration
     def test_get_blacklist_2_finds_no_blacklist(self):
         # Getting the blacklist can fail even the second time.  That's fine,
@@ -1759,3 +1912,27 @@ update 7.txt 7.txt.asc
 update 5.txt 5.txt.asc
 unmount system
 """)
+
+
+class TestPipelinedVerifier(unittest.TestCase):
+    def test_batches(self):
+        # The pairs completed by each downloaded file are verified as a
+        # batch, and so are the ones the downloader never completed.
+        signatures = [('a', 'a.asc'), ('b', 'b.asc'), ('c', 'c.asc')]
+        ctx = Mock()
+        ctx.verify_all.side_effect = lambda pairs: [
+            asc != 'c.asc' for asc, dst in pairs]
+        downloader = Mock(checksums=dict(a=None, b=None, c=None))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            verifier = _PipelinedVerifier(
+                ctx, executor, downloader, signatures)
+            verifier.completed(Record('', 'a.asc'))
+            self.assertFalse(ctx.verify_all.called)
+            verifier.completed(Record('', 'a'))
+            verifier.completed(Record('', 'b'))
+            results = verifier.results()
+        self.assertEqual(results, [(True, None), (True, None), (False, None)])
+        self.assertEqual(ctx.verify_all.call_args_list, [
+            call([('a.asc', 'a')]),
+            call([('b.asc', 'b'), ('c.asc', 'c')]),
+            ])
@@ -0,0 +1,84 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the instrumentation of the state machine's steps."""
+
+__all__ = [
+    'TestTimings',
+    ]
+
+
+import json
+import unittest
+
+from systemimage.download import DownloadManagerBase
+from systemimage.timings import Timings, gpg_invocations
+from unittest.mock import patch
+
+
+class TestTimings(unittest.TestCase):
+    def setUp(self):
+        self.downloader = DownloadManagerBase()
+        self.timings = Timings(self.downloader)
+
+    def test_no_steps(self):
+        self.assertEqual(self.timings.summary(), dict(
+            steps=[], total=dict(wall=0, cpu=0, bytes=0, gpg=0)))
+
+    def test_measure(self):
+        with self.timings.measure('get_index'):
+            self.downloader.bytes_received += 100
+            gpg_invocations.increment()
+            gpg_invocations.increment()
+        self.assertEqual(len(self.timings.steps), 1)
+        timing = self.timings.steps[0]
+        self.assertEqual(timing.step, 'get_index')
+        self.assertEqual(timing.bytes, 100)
+        self.assertEqual(timing.gpg, 2)
+        self.assertGreaterEqual(timing.wall, 0)
+        self.assertGreaterEqual(timing.cpu, 0)
+
+    def test_exception(self):
+        # A step which fails is still recorded.
+        with self.assertRaises(RuntimeError):
+            with self.timings.measure('get_channel'):
+                self.downloader.bytes_received += 10
+                raise RuntimeError
+        self.assertEqual(
+            [(timing.step, timing.bytes) for timing in self.timings.steps],
+            [('get_channel', 10)])
+
+    def test_summary(self):
+        times = iter([1.0, 10.0, 1.5, 10.25, 2.0, 20.0, 4.0, 20.5])
+        with patch('systemimage.timings.time.perf_counter',
+                   side_effect=lambda: next(times)), \
+             patch('systemimage.timings.time.process_time',
+                   side_effect=lambda: next(times)):
+            # The clocks are read wall then cpu at the start, and again at
+            # the end, of each step.
+            with self.timings.measure('cleanup'):
+                pass
+            with self.timings.measure('get_index'):
+                self.downloader.bytes_received += 512
+                gpg_invocations.increment()
+        summary = self.timings.summary()
+        self.assertEqual(summary, dict(
+            steps=[
+                dict(step='cleanup', wall=0.5, cpu=0.25, bytes=0, gpg=0),
+                dict(step='get_index', wall=2.0, cpu=0.5, bytes=512, gpg=1),
+                ],
+            total=dict(wall=2.5, cpu=0.75, bytes=512, gpg=1)))
+        # The summary can be serialized.
+        self.assertEqual(json.loads(json.dumps(summary)), summary)
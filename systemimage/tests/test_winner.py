@@ -112,6 +112,20 @@ class TestWinnerDownloads(unittest.TestCase):
             descriptions.extend(image.descriptions.values())
         self.assertEqual(descriptions, ['Full B', 'Delta B.1', 'Delta B.2'])
 
+    @configuration('00.ini', 'winner.config_01.ini')
+    def test_calculate_winner_shortest_path(self):
+        # The shortest path scorer picks the same winner without calculating
+        # all the candidate paths.
+        setup_keyrings()
+        state = State()
+        touch_build(100)
+        state.run_thru('calculate_winner')
+        descriptions = []
+        for image in state.winner:
+            # There's only one description per image so order doesn't matter.
+            descriptions.extend(image.descriptions.values())
+        self.assertEqual(descriptions, ['Full B', 'Delta B.1', 'Delta B.2'])
+
     @configuration
     def test_download_winners(self):
         # Check that all the winning path's files are downloaded.
@@ -0,0 +1,105 @@
+# Copyright (C) 2013-2016 Canonical Ltd.
+# Author: Barry Warsaw <barry@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Instrumentation of the state machine's steps."""
+
+__all__ = [
+    'StepTiming',
+    'Timings',
+    'gpg_invocations',
+    ]
+
+
+import time
+import logging
+
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import Lock
+
+
+log = logging.getLogger('systemimage')
+
+
+StepTiming = namedtuple('StepTiming', 'step wall cpu bytes gpg')
+
+
+class _Counter:
+    # A running count which can be bumped from any thread.
+    def __init__(self):
+        self._lock = Lock()
+        self.value = 0
+
+    def increment(self):
+        with self._lock:
+            self.value += 1
+
+
+# The number of times gpg has been run by this process.
+gpg_invocations = _Counter()
+
+
+class Timings:
+    """The cost of each step run by a state machine.
+
+    For each step, this records the elapsed wall clock time, the CPU time
+    used by this process (not including the gpg processes it ran), the
+    number of bytes received by the downloader, and the number of times gpg
+    was run.
+    """
+
+    def __init__(self, downloader):
+        self._downloader = downloader
+        self.steps = []
+
+    @contextmanager
+    def measure(self, name):
+        """Record the cost of the step run in the body of the with-statement.
+
+        The step is recorded even if it raises an exception.
+
+        :param name: The name of the step.
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        received = self._downloader.bytes_received
+        gpg = gpg_invocations.value
+        try:
+            yield
+        finally:
+            timing = StepTiming(
+                name,
+                time.perf_counter() - wall,
+                time.process_time() - cpu,
+                self._downloader.bytes_received - received,
+                gpg_invocations.value - gpg)
+            self.steps.append(timing)
+            log.debug('<- {0.step}: {0.wall:.3f}s wall, {0.cpu:.3f}s cpu, '
+                      '{0.bytes} bytes, {0.gpg} gpg'.format(timing))
+
+    def summary(self):
+        """Return the recorded timings, suitable for serializing as JSON.
+
+        :return: A dictionary with a `steps` key, the list of the recorded
+            steps in the order they were run, and a `total` key, the sums
+            over all the steps.  Each step is a dictionary with the keys
+            `step`, `wall`, `cpu`, `bytes`, and `gpg`, and the totals have
+            all but the `step` key.  Times are in seconds.
+        :rtype: dict
+        """
+        steps = [dict(timing._asdict()) for timing in self.steps]
+        total = {key: sum(step[key] for step in steps)
+                 for key in StepTiming._fields[1:]}
+        return dict(steps=steps, total=total)
@@ -136,8 +136,10 @@ class UDMDownloadManager(DownloadManagerBase):
         bus = dbus.SystemBus()
         service = bus.get_object(DOWNLOADER_INTERFACE, '/')
         iface = dbus.Interface(service, MANAGER_INTERFACE)
+        # udm knows nothing about conditional requests, so it only gets the
+        # url, destination, and checksum of each record.
         object_path = iface.createDownloadGroup(
-            records,
+            [record[:3] for record in records],
             'sha256',
             False,        # Don't allow GSM yet.
             # https://bugs.freedesktop.org/show_bug.cgi?id=55594